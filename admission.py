@@ -0,0 +1,81 @@
+from typing import Dict, List, Tuple
+
+from groups import Groups
+from links import Links
+from physical_link_allocate import AllocationResult
+
+
+class AdmissionReport:
+    """
+    准入检查的结果
+
+    result是分配器最好可能得到的结果（上界）：FAILURE表示一定放不下。
+    bottleneck_pairs / bottleneck_groups列出达不到下一档结果的原因。
+    """
+
+    def __init__(self, result: AllocationResult):
+        self.result = result
+        # [(group_id_1, group_id_2, 需要的链路数, 可分配链路数上界)]
+        self.bottleneck_pairs: List[Tuple[int, int, int, int]] = []
+        # [(group_id, 需要的链路数, 空闲链路数)]
+        self.bottleneck_groups: List[Tuple[int, int, int]] = []
+
+    def to_dict(self) -> Dict:
+        return {
+            'result': self.result.name,
+            'bottleneck_pairs': self.bottleneck_pairs,
+            'bottleneck_groups': self.bottleneck_groups,
+        }
+
+
+def has_enough_gpus(group: Groups, job_gpu_count) -> bool:
+    """空闲GPU总数是否足够，不足时任何放置都不可能成功"""
+    return group.total_available_gpus >= job_gpu_count
+
+
+def get_result_bound(links: Links, link_demand: List[Tuple[int, int, int, int]]) -> AllocationResult:
+    """
+    不做试分配，由计数器给出分配结果的上界，每对组只需几次O(1)查表
+
+    一对组最多能得到 sum_o min(两组在ocs o上的空闲端口) 条链路（Links维护的可分配链路数），
+    一个组在所有组对上得到的链路数之和不超过它的空闲链路数。
+    分配器先为每对组分配min_links再追加max_links，满足最佳链路数共需min+max条。
+    事务中的分配只会更少，因此对事务同样是上界。
+    """
+    return check_link_demand(links, link_demand, explain=False).result
+
+
+def check_link_demand(
+    links: Links, link_demand: List[Tuple[int, int, int, int]], explain: bool = True
+) -> AdmissionReport:
+    """
+    计算链路需求的结果上界，explain为True时列出所有瓶颈组对和组
+
+    Args:
+        links: 链路状态
+        link_demand: [(group_id_1, group_id_2, min_links, max_links), ...]
+        explain: 为False时发现瓶颈即返回，不收集原因
+    """
+    report = AdmissionReport(AllocationResult.MEETMAX)
+    for demand_index, result in ((0, AllocationResult.FAILURE), (1, AllocationResult.MEETMIN)):
+        num_links_for_group = {}
+        for group_id_1, group_id_2, min_demand, max_demand in link_demand:
+            demand = min_demand if demand_index == 0 else min_demand + max_demand
+            num_links_for_group[group_id_1] = num_links_for_group.get(group_id_1, 0) + demand
+            num_links_for_group[group_id_2] = num_links_for_group.get(group_id_2, 0) + demand
+            num_allocatable_links = links.get_num_allocatable_links(group_id_1, group_id_2)
+            if num_allocatable_links < demand:
+                report.result = result
+                if not explain:
+                    return report
+                report.bottleneck_pairs.append((group_id_1, group_id_2, demand, num_allocatable_links))
+        for group_id, num_links in num_links_for_group.items():
+            num_idle_links = links.get_num_idle_links_fo_group(group_id)
+            if num_idle_links < num_links:
+                report.result = result
+                if not explain:
+                    return report
+                report.bottleneck_groups.append((group_id, num_links, num_idle_links))
+        if report.result != AllocationResult.MEETMAX:
+            return report
+    return report
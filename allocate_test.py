@@ -1,57 +1,1019 @@
-from typing import List, Tuple
+from typing import Dict, List
 import numpy as np
+from bitarray import bitarray
 
+import asyncio
+import csv
+import gzip
+import json
+import os
+import random
+import sys
+import tempfile
+from collections import deque
+
+from admission import check_link_demand, get_result_bound
+from checkpoint import PAGE_SIZE, CheckpointWriter, load, save
+from daemon import AllocationDaemon, generate_load
+from defrag import apply_defrag, get_total_capacity, plan_defrag
 from groups import Groups
-from jobs import Jobs
-from links import Links
-from gpu_allocate import gpu_allocate
+from instrumentation import instrumentation
+from jobs import Job, Jobs, TraceJobs, generate_jobs
+from links import PORT_DTYPE, Links, pack_idle_links
+from gpu_allocate import (
+    FLOW_BATCHES_PER_SECOND,
+    GPUS_PER_COMM_GROUP,
+    GPUS_PER_TRAFFIC_GROUP,
+    MB_TO_GBITS,
+    MESSAGE_SIZE,
+    TRAFFIC_BATCHES_PER_SECOND,
+    LinkDemandCache,
+    calculate_link_demand,
+    calculate_ring_edges,
+    gpu_allocate,
+)
+from simulator import SchedulingPolicy, Simulator
+from placement_search import PlacementSearch
+from reconfig import MockOcsController, OcsBatch, ReconfigurationError, dispatch, record
+from shard import PodShard
+from sweep import Topology, aggregate, make_cases, run_sweep
+from upgrade import LinkUpgrader
 from physical_link_allocate import (
     AllocationResult,
     PhysicalLinkeAllocatingAlthrighm,
+    allocate_for_two_groups_bulk,
+    allocate_for_two_groups_numpy,
+    allocate_for_two_groups_optimize,
     physical_link_allocate,
 )
 
 
-def allocate_test():
-    links = Links()
+def test_allocate():
     group = Groups()
+    links = Links(group)
     jobs = Jobs()
-    time = 0
-    while jobs.has_more_jobs():
-        jobs_by_time = jobs.get_jobs_by_time(time)
-        for job in jobs_by_time:
-            links.free_link_for_job(job)
-            group.free_gpu_for_job(job)
-            job.finish()
-
-        while True:
-            job = jobs.get_next_job()
-            if job is None:
-                break
-            # link_demand : [(group_id_1, group_id_2, min_links, max_links), ...]
-            link_demand: List[Tuple[int, int, int, int]] = gpu_allocate(
-                job.gpu_count, group
-            )
+    simulator = Simulator(jobs, links, group, verbose=True)
+    print(simulator.run())
+
+
+def test_link_transaction():
+    # writes stay in the transaction until commit, a rollback leaves Links untouched,
+    # and a nested transaction merges into its parent only when it commits
+    group = Groups()
+    links = Links(group)
+    idle_links = links.get_idle_links_bytes()
+    job_1, job_2, job_3 = Job(8, 1, job_id=1), Job(8, 1, job_id=2), Job(8, 1, job_id=3)
+    # switch s owns the ocs range of spine s % 4, 128 ocs each
+    link_1, link_2, link_3 = (0, 0, 1, 0, 5), (0, 1, 1, 1, 130), (0, 2, 1, 2, 300)
+
+    transaction = links.begin()
+    transaction.allocate_link_for_job(job_1, [link_1])
+    assert not transaction.peek_row(0, 0)[5] and not transaction[1][0][5]
+    assert links.get_idle_links_bytes() == idle_links
+    transaction.rollback()
+    assert links.get_idle_links_bytes() == idle_links
+    assert not links.get_links_for_jobs()
+
+    outer = links.begin()
+    inner = outer.begin()
+    inner.allocate_link_for_job(job_1, [link_1])
+    assert outer.peek_row(0, 0)[5]
+    inner.commit()
+    assert not outer.peek_row(0, 0)[5]
+    inner = outer.begin()
+    inner.allocate_link_for_job(job_2, [link_2])
+    inner.rollback()
+    assert outer.peek_row(0, 1)[130]
+    # an allocator writes through get_row and passes the links it claimed to commit
+    inner = outer.begin()
+    inner.get_row(0, 2)[300] = 0
+    inner.get_row(1, 2)[300] = 0
+    assert outer.peek_row(0, 2)[300] and links.get_idle_links_bytes() == idle_links
+    inner.commit(job_3, [link_3])
+    assert links.get_idle_links_bytes() == idle_links
+    outer.commit()
+
+    assert set(links.get_links_for_jobs()) == {job_1, job_3}
+    assert links.get_links_for_job(job_3).tolist() == [link_3]
+    assert links.get_num_idle_links_fo_group(0) == links.get_num_idle_links_fo_group(2) - 2
+    expected = Links(Groups())
+    expected.allocate_link_for_job(job_1, [link_1])
+    expected.allocate_link_for_job(job_3, [link_3])
+    assert links.get_idle_links_bytes() == expected.get_idle_links_bytes()
+    print("transactions commit, roll back and nest")
+
+# gpu_allocate used to build these dense 64x64 matrices, calculate_ring_edges must give their nonzero entries
+def dense_traffic_matrix(allocation):
+    """
+    计算单个任务在集群间的流量矩阵，采用环形通信模式
+    :param allocation: 单个任务的GPU分配方案
+    :return: 该任务的流量矩阵 (单位: Gbps)
+    """
+    GROUP_COUNT = len(allocation)
+    
+    flow_matrix = [[0] * GROUP_COUNT for _ in range(GROUP_COUNT)]
+    
+    # 找出所有有分配GPU的组
+    active_groups = [i for i, gpus in enumerate(allocation) if gpus > 0]
+    if len(active_groups) <= 1:
+        return flow_matrix
+        
+    # 计算数据并行组的数量
+    total_gpus = sum(allocation)
+    dp_groups = (total_gpus + GPUS_PER_TRAFFIC_GROUP - 1) // GPUS_PER_TRAFFIC_GROUP
+    
+    if dp_groups <= 1:
+        return flow_matrix
+        
+    # 计算一个batch需要的通信量（单位：MB）
+    base_volume = MESSAGE_SIZE * 2 * (dp_groups - 1)  # 128MB * 2 * (dp_groups-1)
+    
+    # 转换为每秒流量（Gbps）
+    base_volume_gbps = (base_volume * TRAFFIC_BATCHES_PER_SECOND * MB_TO_GBITS)
+    
+    # 环形通信：记录相邻集群之间的总流量
+    for i in range(len(active_groups)):
+        group1 = active_groups[i]
+        group2 = active_groups[(i + 1) % len(active_groups)]
+        
+        # 更新流量矩阵（双向相同）
+        flow_matrix[group1][group2] += base_volume_gbps
+        flow_matrix[group2][group1] += base_volume_gbps
+    
+    return flow_matrix
+
+
+def dense_flow_count_matrix(allocation):
+    """
+    计算单个任务在集群间的流数矩阵，采用环形通信模式
+    :param allocation: 单个任务的GPU分配方案
+    :return: 该任务的流数矩阵 (单位: flows/s)
+    """
+    GROUP_COUNT = len(allocation)
+    
+    flow_matrix = [[0] * GROUP_COUNT for _ in range(GROUP_COUNT)]
+    
+    # 找出所有有分配GPU的组
+    active_groups = [i for i, gpus in enumerate(allocation) if gpus > 0]
+    if len(active_groups) <= 1:
+        return flow_matrix
+        
+    # 计算数据并行组的数量
+    total_gpus = sum(allocation)
+    dp_groups = (total_gpus + GPUS_PER_COMM_GROUP - 1) // GPUS_PER_COMM_GROUP
+    
+    if dp_groups <= 1:
+        return flow_matrix
+    
+    # 每个batch产生2*(dp_groups-1)个流
+    flows_per_batch = 2 * (dp_groups - 1)
+    flows_per_second = flows_per_batch * FLOW_BATCHES_PER_SECOND
+    
+    # 环形通信：记录相邻集群之间的流数
+    for i in range(len(active_groups)):
+        group1 = active_groups[i]
+        group2 = active_groups[(i + 1) % len(active_groups)]
+        
+        # 更新流数矩阵（双向相同）
+        flow_matrix[group1][group2] += flows_per_second
+        flow_matrix[group2][group1] += flows_per_second
+    
+    return flow_matrix
+
+
+def test_ring_edges_match_dense(num_states: int = 3000, seed: int = 0):
+    rng = random.Random(seed)
+    num_groups = Groups().num_groups
+    for _ in range(num_states):
+        allocation = [0] * num_groups
+        for group_id in rng.sample(range(num_groups), rng.randint(0, 10)):
+            allocation[group_id] = rng.choice([rng.randint(1, 128), rng.randint(1, 1024)])
+        traffic = np.zeros((num_groups, num_groups))
+        flows = np.zeros((num_groups, num_groups))
+        for group_id_1, group_id_2, edge_traffic, edge_flows in zip(*calculate_ring_edges(dict(enumerate(allocation)))):
+            assert group_id_1 < group_id_2
+            traffic[group_id_1, group_id_2] = traffic[group_id_2, group_id_1] = edge_traffic
+            flows[group_id_1, group_id_2] = flows[group_id_2, group_id_1] = edge_flows
+        assert (traffic == np.array(dense_traffic_matrix(allocation))).all(), allocation
+        assert (flows == np.array(dense_flow_count_matrix(allocation))).all(), allocation
+
+
+def compare_allocators(
+    alghrithms: List[PhysicalLinkeAllocatingAlthrighm], seed: int = 0
+) -> Dict[PhysicalLinkeAllocatingAlthrighm, Dict[AllocationResult, int]]:
+    # same job sequence for every algorithm, jobs are admitted until the cluster is full
+    results = {}
+    for alghrithm in alghrithms:
+        group = Groups()
+        links = Links(group)
+        jobs = Jobs(seed)
+        counts = {result: 0 for result in AllocationResult}
+        for job in jobs.jobs:
+            link_demand = gpu_allocate(job.gpu_count, group)
             if not link_demand:
-                break
-            used_kinks = []
+                continue
+            used_links = []
+            transaction = links.begin()
             allocation_result = physical_link_allocate(
-                links.get_temp_idle_links(),
+                transaction,
                 link_demand,
-                used_kinks,
-                PhysicalLinkeAllocatingAlthrighm.OPTIMIZE,
+                used_links,
+                alghrithm,
+                links.get_switch_pair_index(),
+            )
+            counts[allocation_result] += 1
+            if allocation_result == AllocationResult.FAILURE:
+                transaction.rollback()
+            else:
+                transaction.commit(job, used_links)
+        results[alghrithm] = counts
+    return results
+
+
+def test_switch_pair_index_fails_early():
+    # OPTIMIZE only tries the compatible switch pairs and fails as soon as they are all empty,
+    # the index never changes which links it picks
+    group = Groups()
+    links = Links(group)
+    index = links.get_switch_pair_index()
+    compatible, num_pairs = index.get_compatible_switch_pairs(0, 1)
+    assert num_pairs == 64
+    assert all(compatible[src][dst] == (src % 4 == dst % 4) for src in range(16) for dst in range(16))
+    num_probes = []
+    used_links_by_index = []
+    instrumentation.reset()
+    instrumentation.enable()
+    try:
+        # each ocs has 4 idle ports per group, 2048 links between two groups at most
+        for switch_pair_index in (index, None):
+            used_links = []
+            assert not allocate_for_two_groups_optimize((0, 1), 2049, links.begin(), used_links, switch_pair_index)
+            assert len(used_links) == 2048
+            used_links_by_index.append(used_links)
+            num_probes.append(instrumentation.to_dict()['counters']['switch_pairs_probed.OPTIMIZE'])
+            instrumentation.reset()
+    finally:
+        instrumentation.disable()
+    assert used_links_by_index[0] == used_links_by_index[1]
+    # without the index every incompatible pair costs one AND before it is marked dead
+    assert num_probes[1] - num_probes[0] == 16 * 16 - num_pairs
+    print(f"failed after {num_probes[0]} probes with the index, {num_probes[1]} without")
+
+def test_bulk_spreads_without_double_booking(seed: int = 0):
+    # BULK spreads a demand over the switches as evenly as the OPTIMIZE round robin,
+    # and over a whole job sequence never claims a port twice
+    group = Groups()
+    links = Links(group)
+    index = links.get_switch_pair_index()
+    for num_link in (64, 100, 1000):
+        links_per_switch = []
+        for allocate_for_two_groups in (allocate_for_two_groups_bulk, allocate_for_two_groups_optimize):
+            used_links = []
+            assert allocate_for_two_groups((0, 1), num_link, links.begin(), used_links, index)
+            assert len(used_links) == num_link
+            for column in (1, 3):
+                counts = np.bincount([link[column] for link in used_links], minlength=16)
+                assert counts.max() - counts.min() <= 1, (allocate_for_two_groups.__name__, counts)
+                links_per_switch.append(sorted(counts.tolist()))
+        assert links_per_switch[:2] == links_per_switch[2:]
+    claimed_ports = set()
+    for job in Jobs(seed).jobs:
+        link_demand = gpu_allocate(job.gpu_count, group)
+        if not link_demand:
+            continue
+        used_links = []
+        transaction = links.begin()
+        allocation_result = physical_link_allocate(
+            transaction, link_demand, used_links, PhysicalLinkeAllocatingAlthrighm.BULK, index
+        )
+        if allocation_result == AllocationResult.FAILURE:
+            transaction.rollback()
+            continue
+        transaction.commit(job, used_links)
+        for src_group_id, src_switch_id, dst_group_id, dst_switch_id, ocs_id in used_links:
+            for port in ((src_group_id, src_switch_id, ocs_id), (dst_group_id, dst_switch_id, ocs_id)):
+                assert port not in claimed_ports, port
+                claimed_ports.add(port)
+    idle_links = links.get_temp_idle_links()
+    for group_id, switch_id, ocs_id in claimed_ports:
+        assert not idle_links[group_id][switch_id][ocs_id]
+    assert sum(links.get_num_idle_links()) == 64 * 16 * 128 - len(claimed_ports)
+    print(f"BULK claimed {len(claimed_ports)} ports, none twice")
+
+def test_capacity_index_matches_scan(seed: int = 0, num_updates: int = 2000):
+    # GpuCapacityIndex answers best fit and largest like a scan over the groups, ties go to the lowest group_id
+    rng = random.Random(seed)
+    group = Groups(num_groups=50, gpus_per_group=100)
+    for _ in range(num_updates):
+        group_id = rng.randrange(group.num_groups)
+        available_gpus = group.get_group(group_id)['available_gpus']
+        group.update_available_gpus(group_id, rng.randint(-available_gpus, group.gpus_per_group - available_gpus))
+        available = [(info['available_gpus'], info['group_id']) for info in group.groups]
+        for gpus in (0, 1, rng.randint(1, group.gpus_per_group), group.gpus_per_group, group.gpus_per_group + 1):
+            fits = [(available_gpus, group_id) for available_gpus, group_id in available if available_gpus >= gpus]
+            expected = min(fits)[1] if fits else None
+            assert group.capacity_index.find_best_fit(gpus) == expected, gpus
+        largest = max(available_gpus for available_gpus, _ in available)
+        expected = min(group_id for available_gpus, group_id in available if available_gpus == largest)
+        assert group.capacity_index.find_largest() == (expected if largest > 0 else None)
+        assert group.total_available_gpus == sum(available_gpus for available_gpus, _ in available)
+    print("capacity index matches a scan over the groups")
+
+def test_link_demand_cache():
+    # same placement shape hits whatever the group ids, the least recently used shape is evicted first,
+    # and a change in free GPUs or an invalidate misses
+    group = Groups()
+    cache = LinkDemandCache(maxsize=2)
+    shape_a, shape_b, shape_c = {0: 1024, 1: 1024}, {0: 512, 1: 1024, 2: 512}, {0: 2048, 1: 2048}
+    demand_a = calculate_link_demand(shape_a, group, cache)
+    assert demand_a == calculate_link_demand(shape_a, group, None)
+    assert calculate_link_demand(shape_a, group, cache) == demand_a
+    assert calculate_link_demand({4: 1024, 7: 1024}, group, cache) == [
+        (4, 7, min_links, max_links) for _, _, min_links, max_links in demand_a
+    ]
+    assert (cache.hits, cache.misses) == (2, 1)
+    calculate_link_demand(shape_b, group, cache)
+    calculate_link_demand(shape_c, group, cache)
+    assert cache.get_stats()['size'] == 2
+    calculate_link_demand(shape_b, group, cache)
+    assert (cache.hits, cache.misses) == (3, 3)
+    calculate_link_demand(shape_a, group, cache)
+    assert (cache.hits, cache.misses) == (3, 4)
+    group.update_available_gpus(0, -1024)
+    calculate_link_demand(shape_a, group, cache)
+    assert (cache.hits, cache.misses) == (3, 5)
+    cache.invalidate()
+    assert cache.get_stats()['size'] == 0
+    calculate_link_demand(shape_b, group, cache)
+    assert cache.get_stats() == {'hits': 3, 'misses': 6, 'size': 1, 'hit_rate': 3 / 9}
+    print("link demand cache hits, evicts and invalidates")
+
+def test_numpy_matches_optimize(seeds=range(4)):
+    # NUMPY must pick exactly the links OPTIMIZE picks, from bitarray rows and from packed words
+    for seed in seeds:
+        group = Groups()
+        links = Links(group)
+        jobs = Jobs(seed)
+        for job in jobs.jobs:
+            link_demand = gpu_allocate(job.gpu_count, group)
+            if not link_demand:
+                continue
+            packed_idle_links = links.get_packed_idle_links()
+            used_links = {}
+            results = {}
+            idle_links = {}
+            for alghrithm in (PhysicalLinkeAllocatingAlthrighm.OPTIMIZE, PhysicalLinkeAllocatingAlthrighm.NUMPY):
+                transaction = links.begin()
+                used_links[alghrithm] = []
+                results[alghrithm] = physical_link_allocate(
+                    transaction, link_demand, used_links[alghrithm], alghrithm, links.get_switch_pair_index()
+                )
+                idle_links[alghrithm] = [list(group_idle_links) for group_idle_links in transaction]
+                transaction.rollback()
+            packed_used_links = []
+            packed_result = physical_link_allocate(
+                packed_idle_links, link_demand, packed_used_links, PhysicalLinkeAllocatingAlthrighm.NUMPY
+            )
+            optimize_used_links = used_links[PhysicalLinkeAllocatingAlthrighm.OPTIMIZE]
+            assert used_links[PhysicalLinkeAllocatingAlthrighm.NUMPY] == optimize_used_links
+            assert packed_used_links == optimize_used_links
+            assert results[PhysicalLinkeAllocatingAlthrighm.NUMPY] == results[PhysicalLinkeAllocatingAlthrighm.OPTIMIZE]
+            assert packed_result == results[PhysicalLinkeAllocatingAlthrighm.OPTIMIZE]
+            # rows written back into the transaction and the packed words match what OPTIMIZE left
+            assert idle_links[PhysicalLinkeAllocatingAlthrighm.NUMPY] == idle_links[PhysicalLinkeAllocatingAlthrighm.OPTIMIZE]
+            assert packed_idle_links.to_idle_links() == idle_links[PhysicalLinkeAllocatingAlthrighm.OPTIMIZE]
+            if packed_result != AllocationResult.FAILURE:
+                links.allocate_link_for_job(job, optimize_used_links)
+    # sparse random rows, where pairs run out and the walk has to scan or give up
+    rng = random.Random(0)
+    for _ in range(500):
+        num_switch_per_group = rng.randint(1, 6)
+        num_ocs = rng.choice([8, 70, 130])
+        density = rng.choice([0.1, 0.3, 0.8])
+        idle_links = [
+            [bitarray([rng.random() < density for _ in range(num_ocs)]) for _ in range(num_switch_per_group)]
+            for _ in range(2)
+        ]
+        num_link = rng.randint(1, 80)
+        optimize_used_links = []
+        optimize_result = allocate_for_two_groups_optimize(
+            (0, 1), num_link, [[row.copy() for row in rows] for rows in idle_links], optimize_used_links
+        )
+        numpy_used_links = []
+        numpy_result = allocate_for_two_groups_numpy(
+            (0, 1), num_link, [pack_idle_links(rows) for rows in idle_links], numpy_used_links
+        )
+        assert (numpy_result, numpy_used_links) == (optimize_result, optimize_used_links)
+    print("NUMPY picks the same links as OPTIMIZE")
+
+
+def test_admission_bound(seeds=range(2), num_jobs=600):
+    # the pre-check's bound is never better than what OPTIMIZE gets, so it never rejects a feasible job,
+    # and every job it rejects comes with at least one bottleneck; the oldest jobs finish whenever
+    # the next one does not fit, so the links fragment as in a simulation
+    num_rejected = 0
+    for seed in seeds:
+        group = Groups()
+        links = Links(group)
+        running = deque()
+        for job in generate_jobs(num_jobs, seed):
+            gpu_allocation = {}
+            link_demand = gpu_allocate(job.gpu_count, group, gpu_allocation)
+            while not gpu_allocation:
+                finished_job = running.popleft()
+                links.free_link_for_job(finished_job)
+                group.free_gpu_for_job(finished_job)
+                link_demand = gpu_allocate(job.gpu_count, group, gpu_allocation)
+            bound = get_result_bound(links, link_demand)
+            report = check_link_demand(links, link_demand)
+            assert report.result == bound
+            assert (bound == AllocationResult.MEETMAX) == (not report.bottleneck_pairs and not report.bottleneck_groups)
+            used_links = []
+            transaction = links.begin()
+            allocation_result = physical_link_allocate(
+                transaction, link_demand, used_links, PhysicalLinkeAllocatingAlthrighm.OPTIMIZE,
+                links.get_switch_pair_index(),
             )
+            assert allocation_result >= bound, (allocation_result, bound)
+            num_rejected += bound == AllocationResult.FAILURE
             if allocation_result == AllocationResult.FAILURE:
-                break
+                transaction.rollback()
+                group.release_gpus(gpu_allocation)
             else:
-                links.allocate_link_for_job(job, used_kinks)
+                transaction.commit(job, used_links)
+                group.assign_gpu_for_job(job, gpu_allocation)
+                running.append(job)
+    assert num_rejected > 0
+    group = Groups()
+    links = Links(group)
+    stats = Simulator(generate_jobs(num_jobs, 0), links, group).run()
+    assert stats['precheck_rejections'] > 0
+    assert 0 < max(stats['precheck_bottleneck_groups'].values()) <= stats['precheck_rejections']
+    print(f"admission bound held, {num_rejected} jobs rejected by the bound")
 
-            print(
-                f"Job {jobs.current_index} allocated at time {time}, remaining jobs: {jobs.get_remaining_jobs_count()}"
+def compare_matching(seeds=range(10)) -> Dict[str, int]:
+    # both allocators place every job on the same state, MATCHING's links are kept;
+    # short_of_bound counts the jobs OPTIMIZE leaves short of MEETMAX although the
+    # admission bound allows it, the most any allocator could add
+    report = {'jobs': 0, 'optimize_meetmax': 0, 'matching_meetmax': 0, 'short_of_bound': 0, 'matching_worse': 0}
+    for seed in seeds:
+        group = Groups()
+        links = Links(group)
+        for job in Jobs(seed).jobs:
+            link_demand = gpu_allocate(job.gpu_count, group)
+            if not link_demand:
+                continue
+            bound = get_result_bound(links, link_demand)
+            optimize_transaction = links.begin()
+            optimize_result = physical_link_allocate(
+                optimize_transaction, link_demand, [], PhysicalLinkeAllocatingAlthrighm.OPTIMIZE,
+                links.get_switch_pair_index(),
+            )
+            optimize_transaction.rollback()
+            used_links = []
+            transaction = links.begin()
+            allocation_result = physical_link_allocate(
+                transaction, link_demand, used_links, PhysicalLinkeAllocatingAlthrighm.MATCHING,
+                links.get_switch_pair_index(),
             )
-            jobs.current_index += 1
-        time += 1
+            report['jobs'] += 1
+            report['optimize_meetmax'] += optimize_result == AllocationResult.MEETMAX
+            report['matching_meetmax'] += allocation_result == AllocationResult.MEETMAX
+            report['short_of_bound'] += optimize_result != AllocationResult.MEETMAX and bound == AllocationResult.MEETMAX
+            report['matching_worse'] += allocation_result > optimize_result
+            if allocation_result == AllocationResult.FAILURE:
+                transaction.rollback()
+            else:
+                transaction.commit(job, used_links)
+    print(
+        f"MATCHING reaches MEETMAX for {report['matching_meetmax'] - report['optimize_meetmax']} more of "
+        f"{report['jobs']} jobs than OPTIMIZE, OPTIMIZE left {report['short_of_bound']} short of the bound"
+    )
+    return report
+
+
+def test_matching_repairs_optimize():
+    # groups 0, 1, 2 with one switch each on two OCS. Group 0 and group 1 are
+    # idle on both, group 2 only on ocs 0. OPTIMIZE gives pair (0, 1) the first
+    # common ocs, which leaves no port for pair (0, 2); MATCHING moves (0, 1)
+    # to ocs 1 to make room.
+    def get_idle_links():
+        return [[bitarray('11')], [bitarray('11')], [bitarray('10')]]
+
+    link_demand = [(0, 1, 1, 0), (0, 2, 1, 0)]
+    assert physical_link_allocate(
+        get_idle_links(), link_demand, [], PhysicalLinkeAllocatingAlthrighm.OPTIMIZE
+    ) == AllocationResult.FAILURE
+    used_links = []
+    assert physical_link_allocate(
+        get_idle_links(), link_demand, used_links, PhysicalLinkeAllocatingAlthrighm.MATCHING
+    ) == AllocationResult.MEETMAX
+    assert sorted(used_links) == [(0, 0, 1, 0, 1), (0, 0, 2, 0, 0)]
+    # three idle groups of four switches on 8 OCS: OPTIMIZE fills pair (0, 1)
+    # first and strands pair (1, 2), the counts fit with about two links per pair
+    # on every ocs, which takes moving links around a cycle of three OCS
+    link_demand = [(0, 1, 1, 16), (0, 2, 1, 12), (1, 2, 1, 12)]
+    results = {}
+    for alghrithm in (PhysicalLinkeAllocatingAlthrighm.OPTIMIZE, PhysicalLinkeAllocatingAlthrighm.MATCHING):
+        idle_links = [[bitarray('1' * 8) for _ in range(4)] for _ in range(3)]
+        used_links = []
+        results[alghrithm] = physical_link_allocate(idle_links, link_demand, used_links, alghrithm)
+    assert results[PhysicalLinkeAllocatingAlthrighm.OPTIMIZE] == AllocationResult.MEETMIN
+    assert results[PhysicalLinkeAllocatingAlthrighm.MATCHING] == AllocationResult.MEETMAX
+    ports = [(group_id, switch_id, ocs_id) for group_id_1, src, group_id_2, dst, ocs_id in used_links
+             for group_id, switch_id in ((group_id_1, src), (group_id_2, dst))]
+    assert len(set(ports)) == len(ports)
+    assert all(not idle_links[group_id][switch_id][ocs_id] for group_id, switch_id, ocs_id in ports)
+    assert sum(row.count(0) for rows in idle_links for row in rows) == len(ports)
+    for group_id_1, group_id_2, min_demand, max_demand in link_demand:
+        assert sum((link[0], link[2]) == (group_id_1, group_id_2) for link in used_links) == min_demand + max_demand
+    # on generated jobs MATCHING lifts every job OPTIMIZE leaves short of the bound
+    report = compare_matching(seeds=(0, 2))
+    assert report['short_of_bound'] > 0 and report['matching_worse'] == 0
+    assert report['matching_meetmax'] - report['optimize_meetmax'] == report['short_of_bound']
+
+
+def test_trace_jobs(seed: int = 0, num_jobs: int = 60):
+    # CSV and JSONL traces, plain or gzip, replay the same jobs as the generator they were written from
+    jobs = list(generate_jobs(num_jobs, seed, submit_interval=1, priority_levels=3))
+    fields = ('job_id', 'submit_time', 'gpu_count', 'duration', 'priority')
+    rows = [(job.job_id, job.submit_time, job.gpu_count, job.time, job.priority) for job in jobs]
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for name in ('trace.csv', 'trace.csv.gz', 'trace.jsonl', 'trace.jsonl.gz'):
+            path = os.path.join(directory, name)
+            opener = gzip.open if name.endswith('.gz') else open
+            with opener(path, 'wt', newline='') as trace:
+                if '.jsonl' in name:
+                    for row in rows:
+                        trace.write(json.dumps(dict(zip(fields, row))) + '\n\n')
+                else:
+                    writer = csv.writer(trace)
+                    writer.writerow(fields)
+                    writer.writerows(rows)
+            paths.append(path)
+        for path in paths:
+            trace_jobs = TraceJobs(path)
+            for _ in range(2):
+                assert [
+                    (job.job_id, job.submit_time, job.gpu_count, job.time, job.priority) for job in trace_jobs
+                ] == rows, path
+        # job_id defaults to the record index, priority to 0, non-integer ids stay strings
+        path = os.path.join(directory, 'partial.csv')
+        with open(path, 'w', newline='') as trace:
+            trace.write('submit_time,gpu_count,duration,priority\n0,512,1,\n1,1024,2,2\n')
+        assert [(job.job_id, job.priority) for job in TraceJobs(path)] == [(0, 0), (1, 2)]
+        path = os.path.join(directory, 'named.jsonl')
+        with open(path, 'w') as trace:
+            trace.write('{"job_id": "train-7", "submit_time": 3, "gpu_count": 512, "duration": 1}\n')
+        assert [(job.job_id, job.submit_time, job.priority) for job in TraceJobs(path)] == [('train-7', 3, 0)]
+        group = Groups()
+        links = Links(group)
+        trace_stats = Simulator(TraceJobs(paths[1]), links, group).run()
+    group = Groups()
+    links = Links(group)
+    assert trace_stats == Simulator(generate_jobs(num_jobs, seed, 1, priority_levels=3), links, group).run()
+    print(f"{num_jobs} trace jobs replayed from csv, jsonl and gzip")
+
+def test_defrag_keeps_counters(seed: int = 0, num_jobs: int = 300, budget: int = 64):
+    # planning reads Links only; applying the plan moves links but keeps every job's link count,
+    # and leaves the counters equal to a Links that allocated the moved links from scratch
+    group = Groups()
+    links = Links(group)
+    simulator = Simulator(generate_jobs(num_jobs, seed, 1), links, group)
+    simulator.run(until=20)
+    idle_links = links.get_idle_links_bytes()
+    num_links_for_job = {job: len(job_links) for job, job_links in links.get_links_for_jobs().items()}
+    plan = plan_defrag(links, budget)
+    assert links.get_idle_links_bytes() == idle_links
+    assert 0 < len(plan.moves) <= budget
+    assert plan.capacity_before == get_total_capacity(links.get_num_idle_ports())
+    assert plan.capacity_after - plan.capacity_before == sum(move.gain for move in plan.moves) > 0
+    apply_defrag(links, plan)
+    assert {job: len(job_links) for job, job_links in links.get_links_for_jobs().items()} == num_links_for_job
+    assert get_total_capacity(links.get_num_idle_ports()) == plan.capacity_after
+    allocatable_links = links.get_counters()['num_allocatable_links']
+    assert int(np.triu(allocatable_links, 1).sum()) == plan.capacity_after
+    expected_group = Groups()
+    expected = Links(expected_group)
+    for job, job_links in links.get_links_for_jobs().items():
+        expected.allocate_link_for_job(job, job_links.tolist())
+    assert links.get_idle_links_bytes() == expected.get_idle_links_bytes()
+    for name, counter in links.get_counters().items():
+        assert (counter == expected.get_counters()[name]).all(), name
+    assert [info['available_links'] for info in group.groups] == [
+        info['available_links'] for info in expected_group.groups
+    ]
+    print(f"{len(plan.moves)} moves gained {plan.capacity_after - plan.capacity_before} allocatable links")
+
+def test_upgrader_tops_up(max_links_per_event: int = 256):
+    # freed ports go to the MEETMIN jobs that share their groups, higher priority first,
+    # never past the job's target and never more than the per-event budget
+    group = Groups()
+    links = Links(group)
+    upgrader = LinkUpgrader(links, max_links_per_event)
+    low, high, done = Job(1024, 1, job_id=0, priority=0), Job(1024, 1, job_id=1, priority=1), Job(1024, 1, job_id=2)
+    links.allocate_link_for_job(low, [(0, 0, 1, 0, 5)])
+    upgrader.register(low, [(0, 1, 1, 5)], [(0, 0, 1, 0, 5)])
+    links.allocate_link_for_job(high, [(0, 4, 2, 0, 6)])
+    upgrader.register(high, [(0, 2, 1, 1)], [(0, 4, 2, 0, 6)])
+    assert upgrader.missing_links == {low: {(0, 1): 5}, high: {(0, 2): 1}}
+    # switch s owns the ocs of spine s % 4: two freed ports in group 0, one each in groups 1 and 2
+    freed = [(0, 1, 1, 1, 130), (0, 2, 2, 2, 300)]
+    links.allocate_link_for_job(done, freed)
+    freed_links = links.get_links_for_job(done)
+    links.free_link_for_job(done)
+    assert upgrader.on_release(freed_links) == 3
+    # the high priority job takes the first freed port of group 0 and is complete; the low priority job
+    # gets the other port of group 0 and the freed port of group 1, each paired with any idle port on its ocs
+    assert upgrader.missing_links == {low: {(0, 1): 3}}
+    assert upgrader.num_jobs_completed == 1
+    assert links.get_links_for_job(high).tolist()[1][4] == 130
+    assert len(links.get_links_for_job(low)) == 3
+    for job in (low, high):
+        for src_group_id, src_switch_id, dst_group_id, dst_switch_id, ocs_id in links.get_links_for_job(job).tolist():
+            assert src_switch_id % 4 == dst_switch_id % 4 == ocs_id // 128
+    # a job that finishes is forgotten, and the budget caps each event
+    upgrader.unregister(high)
+    upgrader.max_links_per_event = 1
+    links.allocate_link_for_job(done, [(0, 1, 1, 1, 131), (0, 5, 1, 5, 132)])
+    freed_links = links.get_links_for_job(done)
+    links.free_link_for_job(done)
+    assert upgrader.on_release(freed_links) == 1
+    assert upgrader.missing_links == {low: {(0, 1): 2}}
+    assert upgrader.num_links_added == 4
+    expected = Links(Groups())
+    for job, job_links in links.get_links_for_jobs().items():
+        expected.allocate_link_for_job(job, job_links.tolist())
+    for name, counter in links.get_counters().items():
+        assert (counter == expected.get_counters()[name]).all(), name
+    print("upgrader topped up 4 links from freed ports")
+
+def compare_scheduling_policies(seed: int = 0, num_jobs: int = 1000):
+    for policy in SchedulingPolicy:
+        group = Groups()
+        links = Links(group)
+        stats = Simulator(generate_jobs(num_jobs, seed), links, group, policy=policy).run()
+        print(
+            f"{policy.name}: utilization {stats['utilization']:.4f}, "
+            f"mean wait {stats['mean_wait_time']:.2f}, makespan {stats['makespan']}"
+        )
+
+
+def test_port_counters(seed: int = 0, num_jobs: int = 120):
+    # incremental idle-port / allocatable-link counters equal a full recompute,
+    # also when the update is split into one-cell chunks
+    max_counter_cells = Links.MAX_COUNTER_CELLS
+    try:
+        for cells in (max_counter_cells, 1):
+            Links.MAX_COUNTER_CELLS = cells
+            group = Groups()
+            links = Links(group)
+            simulator = Simulator(generate_jobs(num_jobs, seed), links, group)
+            for until in range(5, 60, 5):
+                simulator.run(until=until)
+                ports = links.get_num_idle_ports()
+                expected = np.array([np.minimum(row, ports).sum(axis=1) for row in ports])
+                np.fill_diagonal(expected, 0)
+                for g in range(len(ports)):
+                    for h in range(len(ports)):
+                        assert links.get_num_allocatable_links(g, h) == expected[g, h], (g, h, until)
+    finally:
+        Links.MAX_COUNTER_CELLS = max_counter_cells
+
+
+def test_sweep_failure_count(seeds=range(3), num_jobs: int = 200):
+    # FAILURE in the sweep table counts the failed link allocations of every run
+    cases = make_cases(seeds, num_jobs=num_jobs)
+    results = run_sweep(cases, max_workers=2)
+    assert results == run_sweep(cases, max_workers=1)
+    for stats in results:
+        assert stats['results']['FAILURE'] == stats['link_failures']
+        assert sum(stats['results'].values()) - stats['link_failures'] == stats['started_jobs']
+    (entry,) = aggregate(results).values()
+    assert entry['results']['FAILURE'] == sum(stats['link_failures'] for stats in results) > 0
+    print(entry['results'])
+
+
+def compare_preemption(seed: int = 0, num_jobs: int = 400, priority_levels: int = 3):
+    for preemption in (False, True):
+        group = Groups()
+        links = Links(group)
+        jobs = list(generate_jobs(num_jobs, seed, priority_levels=priority_levels))
+        stats = Simulator(jobs, links, group, preemption=preemption).run()
+        wait_times = {}
+        for job in jobs:
+            wait_times.setdefault(job.priority, []).append(job.start_time - job.submit_time)
+        mean_wait_times = {priority: round(float(np.mean(waits)), 2) for priority, waits in sorted(wait_times.items())}
+        print(
+            f"{'preemption' if preemption else 'no preemption'}: mean wait by priority {mean_wait_times}, "
+            f"preemptions {stats['preemptions']}, preempted gpu time {stats['preempted_gpu_time']}, "
+            f"utilization {stats['utilization']:.4f}"
+        )
+
+
+def test_preemption_guard(seed: int = 0, num_jobs: int = 150, priority_levels: int = 3):
+    """每次抢占都有被抢占的任务，任务运行满min_runtime、被抢占不超过上限，wait_time不含已运行的时间"""
+    group = Groups()
+    links = Links(group)
+    jobs = list(generate_jobs(num_jobs, seed, priority_levels=priority_levels))
+    simulator = Simulator(jobs, links, group, preemption=True)
+    planner = simulator.preemption_planner
+    num_preemptions_for_job = {}
+    preempted_time = 0
+    on_preempt = planner.on_preempt
+
+    def record_preemption(plan):
+        nonlocal preempted_time
+        assert plan.victims
+        for victim in plan.victims:
+            assert simulator.time - victim.start_time >= planner.min_runtime
+            num_preemptions_for_job[victim] = num_preemptions_for_job.get(victim, 0) + 1
+            preempted_time += simulator.time - victim.start_time
+        on_preempt(plan)
+
+    def check_candidates(job, now):
+        # 有序索引给出的候选与扫描、排序所有运行中任务的结果相同
+        candidates = [
+            running for running in group.gpus_for_job
+            if running.priority < job.priority
+            and now - running.start_time >= planner.min_runtime
+            and planner.num_preemptions_for_job.get(running, 0) < planner.max_preemptions_per_job
+        ]
+        by_cost = sorted(candidates, key=lambda running: (running.priority, now - running.start_time, running.gpu_count))
+        by_size = sorted(candidates, key=lambda running: (running.priority, -running.gpu_count, now - running.start_time))
+        assert get_candidates(job, now) == [by_cost[:planner.max_victims], by_size[:planner.max_victims]]
+        return plan(job, now)
+
+    planner.on_preempt = record_preemption
+    get_candidates, plan = planner.get_candidates, planner.plan
+    planner.plan = check_candidates
+    simulator.run()
+    assert num_preemptions_for_job
+    assert max(num_preemptions_for_job.values()) <= planner.max_preemptions_per_job
+    assert not planner.num_preemptions_for_job
+    assert not planner.keys_for_job and not planner.running_by_cost and not planner.running_by_size
+    assert simulator.wait_time == sum(job.start_time - job.submit_time for job in jobs) - preempted_time
+
+
+def compare_placement_search(seed: int = 0, num_jobs: int = 400):
+    for search in (False, True):
+        group = Groups()
+        links = Links(group)
+        placement_search = PlacementSearch(links, group) if search else None
+        stats = Simulator(
+            generate_jobs(num_jobs, seed), links, group, placement_search=placement_search
+        ).run()
+        print(
+            f"{'search' if search else 'first fit'}: {stats['results']}, "
+            f"first attempt {stats['first_attempt_rate']:.4f}, utilization {stats['utilization']:.4f}"
+        )
+
+
+def test_instrumented(seed: int = 0, num_jobs: int = 400, json_path=None, profile_path=None):
+    # one simulation with instrumentation on, optionally under cProfile
+    group = Groups()
+    links = Links(group)
+    instrumentation.reset()
+    instrumentation.enable()
+    try:
+        if profile_path is not None:
+            with instrumentation.profile(profile_path):
+                stats = Simulator(generate_jobs(num_jobs, seed), links, group).run()
+            print(instrumentation.last_profile)
+        else:
+            stats = Simulator(generate_jobs(num_jobs, seed), links, group).run()
+    finally:
+        instrumentation.disable()
+    print(stats)
+    report = instrumentation.to_dict()
+    for name, latency in report['latencies'].items():
+        print(
+            f"{name}: calls {latency['count']}, p50 {latency['p50_us']:.1f}us, "
+            f"p99 {latency['p99_us']:.1f}us, max {latency['max_us']:.1f}us"
+        )
+    print(report['counters'])
+    print(report['switch_pairs_probed_per_link'])
+    if json_path is not None:
+        instrumentation.export_json(json_path)
+
+
+def test_checkpoint_isolation(seed: int = 0, num_jobs: int = 300):
+    # a restored checkpoint must not change when the writer writes the next generation
+    group = Groups()
+    links = Links(group)
+    simulator = Simulator(generate_jobs(num_jobs, seed, 1), links, group)
+    simulator.run(until=20)
+    with tempfile.TemporaryDirectory() as directory:
+        writer = CheckpointWriter(os.path.join(directory, 'state.ckpt'))
+        writer.write(links, group, simulator)
+        checkpoint = load(writer.path)
+        idle_links = checkpoint.links.get_idle_links_bytes()
+        counters = {name: counter.copy() for name, counter in checkpoint.links.get_counters().items()}
+        simulator.run(until=40)
+        num_bytes_written = writer.write(links, group, simulator)
+        # the next generation only writes changed pages, and matches a full save past the header
+        assert num_bytes_written < os.path.getsize(writer.path)
+        full_path = os.path.join(directory, 'full.ckpt')
+        save(full_path, links, group, simulator)
+        with open(writer.path, 'rb') as incremental_file, open(full_path, 'rb') as full_file:
+            assert incremental_file.read()[PAGE_SIZE:] == full_file.read()[PAGE_SIZE:]
+        assert links.get_idle_links_bytes() != idle_links
+        assert checkpoint.links.get_idle_links_bytes() == idle_links
+        for name, counter in checkpoint.links.get_counters().items():
+            assert (counter == counters[name]).all(), name
+        assert load(writer.path).links.get_idle_links_bytes() == links.get_idle_links_bytes()
+    print(f"restored checkpoint unchanged by later writes, {num_bytes_written} bytes written incrementally")
+
+
+def test_checkpoint_upgrade_resume(seed: int = 0, num_jobs: int = 300):
+    # a run restored with the upgrader on keeps topping up the jobs started before the save
+    group = Groups()
+    links = Links(group)
+    simulator = Simulator(generate_jobs(num_jobs, seed, 1), links, group, upgrade_links_per_event=256)
+    simulator.run(until=30)
+    assert simulator.upgrader.missing_links
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'state.ckpt')
+        save(path, links, group, simulator)
+        restored = load(path).make_simulator(generate_jobs(num_jobs, seed, 1), upgrade_links_per_event=256)
+        assert [list(missing.items()) for missing in restored.upgrader.missing_links.values()] == [
+            list(missing.items()) for missing in simulator.upgrader.missing_links.values()
+        ]
+        resumed_result = restored.run()
+    result = simulator.run()
+    assert resumed_result == result, (resumed_result, result)
+    print(f"resumed upgrade run matches, {result['links_upgraded']} links upgraded")
+
+
+def test_reconfig_batches(latency: float = 0.05):
+    # changes that cancel out never reach an OCS, each OCS gets one call per round,
+    # the calls run concurrently and the mock controller ends up with the live links
+    group = Groups()
+    links = Links(group)
+    job_1, job_2, job_3 = Job(1024, 1, job_id=1), Job(1024, 1, job_id=2), Job(1024, 1, job_id=3)
+    with record(links) as plan:
+        links.allocate_link_for_job(job_1, [(0, 0, 1, 0, 5), (0, 1, 1, 1, 130)])
+        links.free_link_for_job(job_1)
+        # the same cross-connect again, and a second link on ocs 5
+        links.allocate_link_for_job(job_2, [(0, 0, 1, 0, 5), (2, 0, 3, 0, 5), (0, 2, 1, 2, 300)])
+    # ports are numbered group_id * 16 + switch_id
+    assert plan.get_batches() == {5: OcsBatch([], [(0, 16), (32, 48)]), 300: OcsBatch([], [(2, 18)])}
+    assert plan.num_link_changes == 7
+    controller = MockOcsController(latency=latency)
+    assert asyncio.run(dispatch(plan.get_batches(), controller))['calls'] == 2
+    assert controller.cross_connects == {5: {0: 16, 16: 0, 32: 48, 48: 32}, 300: {2: 18, 18: 2}}
+
+    # switch k owns the ocs of spine k % 4, every link on its own ocs
+    new_links = [(2 * k, k, 2 * k + 1, k, k % 4 * 128 + k) for k in range(8)]
+    with record(links) as plan:
+        links.free_link_for_job(job_2)
+        links.allocate_link_for_job(job_3, new_links)
+    batches = plan.get_batches()
+    assert len(batches) == len({link[4] for link in new_links} | {5, 300})
+    report = asyncio.run(dispatch(batches, controller))
+    assert report['calls'] == controller.num_calls - 2 == len(batches)
+    # one latency for all OCS, not one per OCS
+    assert report['elapsed_s'] < latency * len(batches) / 2
+    expected = {}
+    for src_group_id, src_switch_id, dst_group_id, dst_switch_id, ocs_id in new_links:
+        port_1, port_2 = src_group_id * 16 + src_switch_id, dst_group_id * 16 + dst_switch_id
+        expected.setdefault(ocs_id, {}).update({port_1: port_2, port_2: port_1})
+    assert {ocs_id: ports for ocs_id, ports in controller.cross_connects.items() if ports} == expected
+
+    # a batch the OCS rejects fails alone, the other OCS are still reconfigured
+    bad_batches = {0: OcsBatch([(100, 101)], []), 7: OcsBatch([], [(100, 101)])}
+    try:
+        asyncio.run(dispatch(bad_batches, controller))
+        assert False, "disconnecting ports that are not connected must fail"
+    except ReconfigurationError as error:
+        assert list(error.failures) == [0]
+    assert controller.cross_connects[7][100] == 101
+    print(f"{report['calls']} OCS reconfigured concurrently in {report['elapsed_s']:.3f}s")
+
+def test_pod_checkpoint():
+    # ports a pod holds for a cross-pod job reach the change listener and survive save / restore
+    topology = Topology(num_group=4)
+    shard = PodShard(0, topology, PhysicalLinkeAllocatingAlthrighm.OPTIMIZE)
+    started, _ = shard.schedule(0, [(0, 3000, 5)])
+    assert started == [0]
+    idle_links = shard.links.get_temp_idle_links()
+    ports = np.array(
+        [(3, switch_id, idle_links[3][switch_id].index(1)) for switch_id in range(2)], dtype=PORT_DTYPE
+    )
+    with record(shard.links) as plan:
+        assert shard.reserve(1, 1024, 5, {3: 1024}, ports)
+        shard.commit(1)
+    assert sum(len(changes) for changes in plan.port_changes.values()) == len(ports)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'pod.ckpt')
+        shard.save(path)
+        restored = PodShard.restore(0, path, PhysicalLinkeAllocatingAlthrighm.OPTIMIZE)
+    assert restored.links.get_idle_links_bytes() == shard.links.get_idle_links_bytes()
+    assert (restored.links.get_ports_for_job(restored.cross_shard_jobs[1]) == ports).all()
+    assert list(restored.local_jobs) == [0]
+    with record(restored.links) as plan:
+        restored.finish([0, 1])
+    assert sorted(change for changes in plan.port_changes.values() for change in changes.values()) == [-1] * len(ports)
+    empty_groups, empty_links = topology.build()
+    assert restored.groups.total_available_gpus == empty_groups.total_available_gpus
+    assert restored.links.get_idle_links_bytes() == empty_links.get_idle_links_bytes()
+    print("pod restored with its cross-pod ports")
+
+
+def test_daemon_request_isolation():
+    # a bad request in a batch gets its own error, the other requests of the batch are unaffected
+    group = Groups()
+    daemon = AllocationDaemon(Links(group), group)
+    responses, snapshot, _ = daemon.run_round(
+        [
+            {'op': 'submit', 'gpu_count': 1024, 'time': 5, 'job_id': 'ok-1'},
+            {'op': 'submit', 'gpu_count': 1024, 'time': 5, 'job_id': [1]},
+            {'op': 'submit', 'gpu_count': 1024, 'time': 5, 'job_id': {}},
+            {'op': 'submit', 'gpu_count': 'many', 'time': 5, 'job_id': 'bad-1'},
+            {'op': 'complete', 'job_id': [1]},
+        ]
+    )
+    assert responses[0]['status'] == 'started'
+    assert all('error' in response for response in responses[1:])
+    assert list(daemon.jobs) == ['ok-1'] and not daemon.simulator.pending
+    assert snapshot.job_states == {'ok-1': 'running'}
+    responses, _, _ = daemon.run_round(
+        [
+            {'op': 'complete', 'job_id': 'ok-1'},
+            {'op': 'submit', 'gpu_count': 1024, 'time': 5, 'job_id': 'ok-1'},
+        ]
+    )
+    assert responses[0]['status'] == 'finished' and responses[1]['status'] == 'started'
+    # priority must be a finite integer; a completion earlier in the batch is still answered
+    requests = [json.loads(line) for line in (
+        '{"op": "complete", "job_id": "ok-1"}',
+        '{"op": "submit", "gpu_count": 1024, "time": 5, "priority": 1e999, "job_id": "bad-2"}',
+        '{"op": "submit", "gpu_count": 1024, "time": 5, "priority": 1.5, "job_id": "bad-3"}',
+        '{"op": "submit", "gpu_count": 1024, "time": 5, "priority": 10000000000000000000000, "job_id": "bad-4"}',
+        '{"op": "submit", "gpu_count": 1024, "time": 5, "priority": 2.0, "job_id": "ok-2"}',
+    )]
+    num_finished = daemon.simulator.num_finished
+    responses, snapshot, _ = daemon.run_round(requests)
+    assert responses[0]['status'] == 'finished' and daemon.simulator.num_finished == num_finished + 1
+    assert all('error' in response for response in responses[1:4])
+    assert responses[4]['status'] == 'started' and daemon.jobs['ok-2'].priority == 2
+    assert snapshot.job_states == {'ok-2': 'running'}
+    print("bad daemon requests fail alone")
+
+
+def test_daemon_load(num_jobs: int = 400):
+    # every job the load generator queues starts later and is completed, the daemon ends empty
+    group = Groups()
+    daemon = AllocationDaemon(Links(group), group)
+
+    async def run(path):
+        server = asyncio.ensure_future(daemon.serve(path))
+        while not os.path.exists(path):
+            await asyncio.sleep(0.01)
+        try:
+            return await generate_load(path, num_clients=16, num_jobs=num_jobs, time_scale=0.01)
+        finally:
+            server.cancel()
+
+    with tempfile.TemporaryDirectory() as directory:
+        report = asyncio.run(run(os.path.join(directory, 'daemon.sock')))
+    assert report['decisions'].get('queued', 0) > 0
+    assert sum(report['queued_outcomes'].values()) == report['decisions']['queued']
+    assert not daemon.jobs and not daemon.simulator.pending
+    stats = daemon.snapshot.stats
+    assert stats['finished_jobs'] == report['decisions']['started'] + report['queued_outcomes'].get('running', 0)
+    print(report)
 
 
 if __name__ == "__main__":
-    allocate_test()
+    # the same tests pytest collects; --compare also prints the allocator / policy comparisons
+    test_allocate()
+    test_link_transaction()
+    test_ring_edges_match_dense()
+    test_switch_pair_index_fails_early()
+    test_bulk_spreads_without_double_booking()
+    test_capacity_index_matches_scan()
+    test_link_demand_cache()
+    test_trace_jobs()
+    test_defrag_keeps_counters()
+    test_upgrader_tops_up()
+    test_numpy_matches_optimize()
+    test_admission_bound()
+    test_matching_repairs_optimize()
+    test_port_counters()
+    test_sweep_failure_count()
+    test_preemption_guard()
+    test_instrumented()
+    test_checkpoint_isolation()
+    test_checkpoint_upgrade_resume()
+    test_reconfig_batches()
+    test_pod_checkpoint()
+    test_daemon_request_isolation()
+    test_daemon_load()
+    if '--compare' in sys.argv[1:]:
+        print(compare_allocators(list(PhysicalLinkeAllocatingAlthrighm)))
+        compare_matching()
+        compare_scheduling_policies()
+        compare_preemption()
+        compare_placement_search()
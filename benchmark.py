@@ -0,0 +1,187 @@
+import argparse
+import json
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from jobs import Job, generate_jobs
+from links import LinkTransaction
+from physical_link_allocate import PhysicalLinkeAllocatingAlthrighm
+from simulator import Simulator
+from sweep import Topology, parse_topology
+
+DEFAULT_SCALES = [
+    Topology(64, 16, 512),
+    Topology(128, 16, 1024),
+    Topology(256, 32, 1024),
+    Topology(512, 32, 2048),
+    Topology(1024, 64, 4096),
+]
+
+# 越大越好的指标，其余（延迟、快照开销、内存）越小越好
+HIGHER_IS_BETTER = {'jobs_per_second'}
+
+
+class TimedSimulator(Simulator):
+    """记录每次try_start（GPU放置+链路分配，成功或失败）的耗时"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencies_ns: List[int] = []
+
+    def try_start(self, job: Job, transaction: Optional[LinkTransaction] = None) -> bool:
+        start = time.perf_counter_ns()
+        try:
+            return super().try_start(job, transaction)
+        finally:
+            self.latencies_ns.append(time.perf_counter_ns() - start)
+
+
+def measure_snapshot(links, repeat=5) -> Dict[str, float]:
+    """三种链路状态快照的中位耗时（毫秒）"""
+    timings = {'deepcopy_ms': [], 'packed_ms': [], 'transaction_ms': []}
+    for _ in range(repeat):
+        start = time.perf_counter()
+        links.get_temp_idle_links()
+        timings['deepcopy_ms'].append(time.perf_counter() - start)
+        start = time.perf_counter()
+        links.get_packed_idle_links()
+        timings['packed_ms'].append(time.perf_counter() - start)
+        # 事务是惰性的，开销来自第一次写入时复制的行
+        start = time.perf_counter()
+        transaction = links.begin()
+        transaction.get_row(0, 0)
+        transaction.rollback()
+        timings['transaction_ms'].append(time.perf_counter() - start)
+    return {name: float(np.median(values)) * 1000 for name, values in timings.items()}
+
+
+def run_case(topology: Topology, alghrithm: PhysicalLinkeAllocatingAlthrighm, seed: int, num_jobs: int) -> Dict:
+    """
+    在当前进程中跑一个规模：建立拓扑、测快照开销、回放固定种子的任务
+
+    由bench在独立的子进程中调用，峰值RSS只包含这一个case。
+    """
+    start = time.perf_counter()
+    groups, links = topology.build()
+    setup_s = time.perf_counter() - start
+    snapshot = measure_snapshot(links)
+    simulator = TimedSimulator(generate_jobs(num_jobs, seed), links, groups, alghrithm)
+    start = time.perf_counter()
+    stats = simulator.run()
+    run_s = time.perf_counter() - start
+    latencies_us = np.array(simulator.latencies_ns) / 1000
+    # 没有任何一次调度被计时的时候（如任务都放不下）延迟记为0
+    return {
+        'setup_s': setup_s,
+        **snapshot,
+        'p50_latency_us': float(np.percentile(latencies_us, 50)) if len(latencies_us) else 0.0,
+        'p99_latency_us': float(np.percentile(latencies_us, 99)) if len(latencies_us) else 0.0,
+        'jobs_per_second': stats['started_jobs'] / run_s if run_s > 0 else 0.0,
+        # Linux上ru_maxrss的单位是KB
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'results': stats['results'],
+    }
+
+
+def get_case_name(topology: Topology, alghrithm: PhysicalLinkeAllocatingAlthrighm) -> str:
+    return (
+        f"{topology.num_group}x{topology.num_switch_per_group}x{topology.num_ocs}"
+        f"x{topology.num_spine}x{topology.gpus_per_group}/{alghrithm.name}"
+    )
+
+
+def bench(
+    scales: List[Topology],
+    alghrithms: List[PhysicalLinkeAllocatingAlthrighm],
+    seed: int = 0,
+    num_jobs: int = 300,
+) -> Dict[str, Dict]:
+    """逐个规模运行，每个case使用新的子进程，互不影响内存峰值和缓存"""
+    report = {}
+    for topology in scales:
+        for alghrithm in alghrithms:
+            with ProcessPoolExecutor(max_workers=1, max_tasks_per_child=1) as executor:
+                result = executor.submit(run_case, topology, alghrithm, seed, num_jobs).result()
+            name = get_case_name(topology, alghrithm)
+            report[name] = result
+            print(format_result(name, result), flush=True)
+    return report
+
+
+def format_result(name: str, result: Dict) -> str:
+    return (
+        f"{name}: setup {result['setup_s']:.2f}s, "
+        f"snapshot deepcopy {result['deepcopy_ms']:.2f}ms packed {result['packed_ms']:.2f}ms "
+        f"transaction {result['transaction_ms']:.3f}ms, "
+        f"latency p50 {result['p50_latency_us']:.0f}us p99 {result['p99_latency_us']:.0f}us, "
+        f"{result['jobs_per_second']:.1f} jobs/s, peak rss {result['peak_rss_mb']:.0f}MB"
+    )
+
+
+def compare(report: Dict[str, Dict], baseline: Dict[str, Dict], tolerance: float = 0.1) -> List[str]:
+    """
+    与保存的基线比较，返回超过容忍度的退化
+
+    Args:
+        tolerance: 允许的相对变化，0.1表示变差10%以内不算退化
+    """
+    regressions = []
+    for name, result in report.items():
+        if name not in baseline:
+            continue
+        for metric, value in result.items():
+            base_value = baseline[name].get(metric)
+            if not isinstance(value, float) or not base_value or metric == 'setup_s':
+                continue
+            change = (value - base_value) / base_value
+            if metric in HIGHER_IS_BETTER:
+                change = -change
+            if change > tolerance:
+                regressions.append(f"{name} {metric}: {base_value:.3f} -> {value:.3f} ({change:+.0%} worse)")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="allocator benchmark across topology scales")
+    parser.add_argument(
+        '--scales',
+        nargs='+',
+        type=parse_topology,
+        default=DEFAULT_SCALES,
+        help="num_group x num_switch_per_group x num_ocs x num_spine x gpus_per_group",
+    )
+    parser.add_argument(
+        '--alghrithms',
+        nargs='+',
+        default=['OPTIMIZE'],
+        choices=[alghrithm.name for alghrithm in PhysicalLinkeAllocatingAlthrighm],
+    )
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--num-jobs', type=int, default=300)
+    parser.add_argument('--save', help="write the results as a JSON baseline")
+    parser.add_argument('--baseline', help="compare against a saved JSON baseline")
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args()
+
+    report = bench(
+        args.scales,
+        [PhysicalLinkeAllocatingAlthrighm[name] for name in args.alghrithms],
+        args.seed,
+        args.num_jobs,
+    )
+    if args.save is not None:
+        with open(args.save, 'w') as output:
+            json.dump(report, output, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(report, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            sys.exit(1)
+        print("no regressions")
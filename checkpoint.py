@@ -0,0 +1,518 @@
+import argparse
+import fcntl
+import heapq
+import json
+import mmap
+import os
+import shutil
+import struct
+import time
+from collections import deque
+from itertools import islice
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from groups import Groups
+from jobs import Job, generate_jobs
+from links import LINK_DTYPE, PORT_DTYPE, Links
+from physical_link_allocate import AllocationResult
+from simulator import Simulator
+
+# 集群状态的二进制检查点，文件布局（小端）：
+#     头部页: HEADER + 每个section的 (offset, length)
+#     固定区: 空闲端口位图、Links的计数器、group计数器，大小只由拓扑决定
+#     可变区: 任务表、GPU分配表、链路表、单端口表、JSON元数据
+# 位图每行是一个交换机的num_ocs位（大端，num_ocs/8字节），按 [group][switch] 顺序排列，
+# 与Links内存中的bitarray一致；计数器是int64数组。恢复时mmap整个文件（私有的写时复制映射），
+# Links的每一行直接是映射上的bitarray，计数器直接是映射上的numpy数组，不复制也不重算。
+MAGIC = b"OCSCKPT\0"
+VERSION = 2
+# magic, version, 是否写完整, generation, num_group, num_switch_per_group, num_ocs, num_spine, gpus_per_group
+HEADER = struct.Struct("<8sIIqIIIII")
+SECTION = struct.Struct("<qq")
+# 头部单独占一页，固定区从页边界开始
+PAGE_SIZE = mmap.PAGESIZE
+ALIGNMENT = 64
+# Linux的ioctl(FICLONE)，让新文件与原文件共享数据块（btrfs、xfs等）
+FICLONE = 0x40049409
+
+COUNTER_NAMES = (
+    'num_idle_links_for_switch',
+    'num_idle_links_for_group',
+    'num_idle_links_for_spine',
+    'num_idle_ports',
+    'num_allocatable_links',
+)
+FIXED_SECTION_NAMES = ('idle_links', *COUNTER_NAMES, 'groups')
+VARIABLE_SECTION_NAMES = ('jobs', 'gpu_allocations', 'links', 'ports', 'metadata')
+SECTION_NAMES = FIXED_SECTION_NAMES + VARIABLE_SECTION_NAMES
+
+# 运行中和等待中的任务，按任务表顺序依次占用GPU分配表 [(group_id, gpus)]、链路表和单端口表中的记录，
+# 单端口表是claim_ports_for_job占用的端口（跨pod任务在本pod的一端）
+JOB_DTYPE = np.dtype(
+    [
+        ('gpu_count', np.int64),
+        ('time', np.int64),
+        ('submit_time', np.int64),
+        ('priority', np.int64),
+        ('start_time', np.int64),  # -1表示等待中
+        ('event_seq', np.int64),  # 结束事件在堆中的序号，等待中的任务为-1
+        ('retried', np.int64),  # 等待中的任务是否已尝试过
+        ('num_gpu_groups', np.int64),
+        ('num_links', np.int64),
+        ('num_ports', np.int64),  # 没有用claim_ports_for_job占用端口的任务为-1
+    ]
+)
+
+# 恢复仿真需要的Simulator状态，都可以直接写成JSON
+SIMULATOR_FIELDS = (
+    'time',
+    'num_submitted',
+    'num_started',
+    'num_finished',
+    'num_rejected',
+    'num_first_attempt',
+    'num_link_failures',
+    'num_precheck_rejections',
+    'precheck_bottlenecks_for_group',
+    'num_reconfigurations',
+    'defrag_capacity_gained',
+    'total_gpus',
+    'gpu_time',
+    'wait_time',
+    'num_preemptions',
+    'preempted_gpu_time',
+)
+
+
+def get_sections(links: Links, groups: Groups, simulator: Optional[Simulator] = None) -> Dict[str, bytes]:
+    """把集群状态（和可选的仿真状态）编码成各section的字节"""
+    sections = {'idle_links': links.get_idle_links_bytes()}
+    for name, counter in links.get_counters().items():
+        sections[name] = counter.astype(np.int64, copy=False).tobytes()
+    sections['groups'] = np.array(
+        [[group['available_gpus'], group['available_links']] for group in groups.groups], dtype=np.int64
+    ).tobytes()
+
+    links_for_jobs = links.get_links_for_jobs()
+    ports_for_jobs = links.get_ports_for_jobs()
+    # 运行中的任务按Links中的顺序保存，碎片整理等按这个顺序遍历
+    running_jobs = list(dict.fromkeys([*links_for_jobs, *ports_for_jobs, *groups.gpus_for_job]))
+    event_seqs = {}
+    pending_jobs = []
+    retried_jobs = set()
+    num_preemptions_for_job = {}
+    upgrader = None
+    simulator_state = None
+    if simulator is not None:
+        event_seqs = {job: seq for _, seq, job in simulator.events}
+        pending_jobs = list(simulator.pending)
+        retried_jobs = simulator.retried_jobs
+        simulator_state = {name: getattr(simulator, name) for name in SIMULATOR_FIELDS}
+        simulator_state['results'] = {result.name: count for result, count in simulator.results.items()}
+        if simulator.preemption_planner is not None:
+            num_preemptions_for_job = simulator.preemption_planner.num_preemptions_for_job
+        upgrader = simulator.upgrader
+
+    jobs = np.zeros(len(running_jobs) + len(pending_jobs), dtype=JOB_DTYPE)
+    gpu_allocations = []
+    job_links = []
+    job_ports = []
+    for index, job in enumerate(running_jobs + pending_jobs):
+        gpu_allocation = groups.gpus_for_job.get(job, {})
+        links_for_job = links_for_jobs.get(job, np.zeros(0, dtype=LINK_DTYPE))
+        ports_for_job = ports_for_jobs.get(job)
+        jobs[index] = (
+            job.gpu_count,
+            job.time,
+            job.submit_time,
+            job.priority,
+            job.start_time if job.is_running else -1,
+            event_seqs.get(job, -1),
+            job in retried_jobs,
+            len(gpu_allocation),
+            len(links_for_job),
+            len(ports_for_job) if ports_for_job is not None else -1,
+        )
+        gpu_allocations.extend(gpu_allocation.items())
+        job_links.append(links_for_job)
+        if ports_for_job is not None:
+            job_ports.append(ports_for_job)
+    sections['jobs'] = jobs.tobytes()
+    sections['gpu_allocations'] = np.array(gpu_allocations, dtype=np.int64).reshape(-1, 2).tobytes()
+    sections['links'] = np.concatenate(job_links).tobytes() if job_links else b''
+    sections['ports'] = np.concatenate(job_ports).tobytes() if job_ports else b''
+    job_indices = {job: index for index, job in enumerate(running_jobs + pending_jobs)}
+    sections['metadata'] = json.dumps(
+        {
+            'job_ids': [job.job_id for job in running_jobs + pending_jobs],
+            'num_running_jobs': len(running_jobs),
+            # [[任务表中的序号, 被抢占的次数]]
+            'num_preemptions_for_job': [
+                [index, num_preemptions_for_job[job]]
+                for index, job in enumerate(running_jobs + pending_jobs)
+                if job in num_preemptions_for_job
+            ],
+            # 链路补充的状态，missing_links是 [[任务表中的序号, [[group_id_1, group_id_2, 还差的链路数]]]]，
+            # 按登记顺序（同优先级的任务按这个顺序补）
+            'upgrader': {
+                'missing_links': [
+                    [job_indices[job], [[*pair, num_missing] for pair, num_missing in missing.items()]]
+                    for job, missing in upgrader.missing_links.items()
+                ],
+                'num_links_added': upgrader.num_links_added,
+                'num_jobs_completed': upgrader.num_jobs_completed,
+            } if upgrader is not None else None,
+            'simulator': simulator_state,
+        }
+    ).encode()
+    return sections
+
+
+def align(offset: int, alignment: int) -> int:
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def get_layout(sections: Dict[str, bytes]) -> Tuple[List[Tuple[int, int]], int, int]:
+    """
+    Returns:
+        Tuple: ([(offset, length)] 按SECTION_NAMES顺序, 固定区结束位置（页对齐）, 文件大小)
+    """
+    layout = []
+    offset = PAGE_SIZE
+    for name in FIXED_SECTION_NAMES:
+        offset = align(offset, ALIGNMENT)
+        layout.append((offset, len(sections[name])))
+        offset += len(sections[name])
+    # 可变区从新的一页开始，固定区可以按页比较和覆盖
+    fixed_end = offset = align(offset, PAGE_SIZE)
+    for name in VARIABLE_SECTION_NAMES:
+        offset = align(offset, ALIGNMENT)
+        layout.append((offset, len(sections[name])))
+        offset += len(sections[name])
+    return layout, fixed_end, offset
+
+
+class CheckpointWriter:
+    """
+    向同一个文件反复写检查点
+
+    每一代都写到新的临时文件、fsync后原子替换，已经load的检查点映射的是替换前的文件，
+    不会看到之后写入的内容；中途崩溃时原文件保持上一代不变。
+    第一次（或拓扑变化后）完整写出；之后先把上一代文件克隆到临时文件（支持reflink的文件系统上
+    不复制数据，否则在内核中复制），只写入固定区中内容变化的页，再重写较小的可变区和头部。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.generation = 0
+        # 最近一次写出的固定区内容，用于找出变化的页
+        self.__fixed: Optional[np.ndarray] = None
+        # 最近一次写入的字节数（克隆上一代文件不计入）
+        self.num_bytes_written = 0
+
+    def write(self, links: Links, groups: Groups, simulator: Optional[Simulator] = None) -> int:
+        """
+        写一次检查点
+
+        Args:
+            simulator: 给出时同时保存等待队列、结束事件和统计，可以用load(...).make_simulator从这里继续仿真
+
+        Returns:
+            int: 本次写入的字节数
+        """
+        sections = get_sections(links, groups, simulator)
+        layout, fixed_end, size = get_layout(sections)
+        counters = links.get_counters()
+        num_group, num_switch_per_group = counters['num_idle_links_for_switch'].shape
+        self.generation += 1
+
+        data = bytearray(size)
+        header = HEADER.pack(
+            MAGIC,
+            VERSION,
+            True,
+            self.generation,
+            num_group,
+            num_switch_per_group,
+            counters['num_idle_ports'].shape[1],
+            counters['num_idle_links_for_spine'].shape[1],
+            groups.gpus_per_group,
+        )
+        header += b''.join(SECTION.pack(offset, length) for offset, length in layout)
+        data[:len(header)] = header
+        for name, (offset, length) in zip(SECTION_NAMES, layout):
+            data[offset:offset + length] = sections[name]
+        fixed = np.frombuffer(data, dtype=np.uint8, count=fixed_end - PAGE_SIZE, offset=PAGE_SIZE)
+        fixed = fixed.reshape(-1, PAGE_SIZE).copy()
+
+        # 不能在原文件上原地覆盖：load用的私有映射在页被访问前仍然读取文件的最新内容
+        temp_path = self.path + '.tmp'
+        if self.__fixed is None or self.__fixed.shape != fixed.shape or not os.path.exists(self.path):
+            with open(temp_path, 'wb') as output:
+                output.write(data)
+                output.flush()
+                os.fsync(output.fileno())
+            self.num_bytes_written = size
+        else:
+            clone_file(self.path, temp_path)
+            changed_pages = np.flatnonzero((fixed != self.__fixed).any(axis=1)).tolist()
+            fd = os.open(temp_path, os.O_RDWR)
+            try:
+                for page in changed_pages:
+                    offset = PAGE_SIZE * (page + 1)
+                    os.pwrite(fd, data[offset:offset + PAGE_SIZE], offset)
+                os.pwrite(fd, data[fixed_end:], fixed_end)
+                os.ftruncate(fd, size)
+                os.pwrite(fd, data[:PAGE_SIZE], 0)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self.num_bytes_written = PAGE_SIZE * (len(changed_pages) + 1) + size - fixed_end
+        os.replace(temp_path, self.path)
+        self.__fixed = fixed
+        return self.num_bytes_written
+
+
+def clone_file(source_path: str, path: str):
+    """复制整个文件：优先用reflink共享数据块，文件系统不支持时由shutil在内核中复制"""
+    with open(source_path, 'rb') as source, open(path, 'wb') as output:
+        try:
+            fcntl.ioctl(output.fileno(), FICLONE, source.fileno())
+            return
+        except OSError:
+            pass
+    shutil.copyfile(source_path, path)
+
+
+def save(path: str, links: Links, groups: Groups, simulator: Optional[Simulator] = None) -> int:
+    """完整写一次检查点，返回写入的字节数"""
+    return CheckpointWriter(path).write(links, groups, simulator)
+
+
+class Checkpoint:
+    """从检查点恢复的集群状态，Links的位图和计数器直接使用文件映射"""
+
+    def __init__(
+        self,
+        groups: Groups,
+        links: Links,
+        running_jobs: List[Job],
+        event_seqs: List[int],
+        pending_jobs: List[Job],
+        retried_jobs: List[Job],
+        num_preemptions_for_job: Dict[Job, int],
+        upgrader_state: Optional[Dict],
+        simulator_state: Optional[Dict],
+        generation: int,
+    ):
+        self.groups = groups
+        self.links = links
+        self.running_jobs = running_jobs
+        self.event_seqs = event_seqs
+        self.pending_jobs = pending_jobs
+        self.retried_jobs = retried_jobs
+        self.num_preemptions_for_job = num_preemptions_for_job
+        # 保存时开启了链路补充：{'missing_links': {job: {(group_id_1, group_id_2): 还差的链路数}}, 计数...}
+        self.upgrader_state = upgrader_state
+        self.simulator_state = simulator_state
+        self.generation = generation
+        self.__used = False
+
+    def make_simulator(self, jobs: Iterable[Job], **kwargs) -> Simulator:
+        """
+        从检查点时刻继续仿真，返回的Simulator接管这份状态，每个Checkpoint只能用一次；
+        要从同一时刻分叉多个仿真，对每个分支各load一次（映射是私有的，分支之间互不影响）
+
+        Args:
+            jobs: 与保存时相同的完整任务序列，保存前已提交的任务会被跳过
+            kwargs: Simulator的其它参数，如alghrithm、policy、upgrade_links_per_event；
+                保存和恢复时都开启链路补充，才会继续为保存时缺链路的任务补链路，
+                否则只对恢复后以MEETMIN启动的任务生效
+        """
+        assert self.simulator_state is not None, "checkpoint was saved without a simulator"
+        assert not self.__used
+        self.__used = True
+        state = self.simulator_state
+        simulator = Simulator(islice(jobs, state['num_submitted'], None), self.links, self.groups, **kwargs)
+        for name in SIMULATOR_FIELDS:
+            # 旧版本写的检查点没有后加的字段，保留Simulator的初始值
+            if name in state:
+                setattr(simulator, name, state[name])
+        simulator.results = {result: state['results'][result.name] for result in AllocationResult}
+        simulator.pending = deque(self.pending_jobs)
+        simulator.retried_jobs = set(self.retried_jobs)
+        if simulator.preemption_planner is not None:
+            simulator.preemption_planner.num_preemptions_for_job = dict(self.num_preemptions_for_job)
+        if simulator.upgrader is not None and self.upgrader_state is not None:
+            simulator.upgrader.missing_links = {
+                job: dict(missing) for job, missing in self.upgrader_state['missing_links'].items()
+            }
+            simulator.upgrader.num_links_added = self.upgrader_state['num_links_added']
+            simulator.upgrader.num_jobs_completed = self.upgrader_state['num_jobs_completed']
+        simulator.events = [
+            (job.end_time, seq, job) for job, seq in zip(self.running_jobs, self.event_seqs)
+        ]
+        heapq.heapify(simulator.events)
+        if simulator.preemption_planner is not None:
+            # 按启动顺序重建运行中任务的索引
+            for _, _, job in sorted(simulator.events, key=lambda event: event[1]):
+                simulator.preemption_planner.on_start(job)
+        return simulator
+
+
+def read_header(buffer) -> Tuple[Tuple, List[Tuple[int, int]]]:
+    header = HEADER.unpack_from(buffer, 0)
+    magic, version, complete = header[:3]
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("not a checkpoint file or unsupported version")
+    if not complete:
+        raise ValueError("checkpoint was not completely written")
+    layout = [SECTION.unpack_from(buffer, HEADER.size + SECTION.size * index) for index in range(len(SECTION_NAMES))]
+    return header, layout
+
+
+def load(path: str) -> Checkpoint:
+    """
+    mmap检查点并恢复Links和Groups
+
+    映射是私有的写时复制映射：Links在其上原地分配和释放，只复制被写到的页，不会改动文件。
+    """
+    with open(path, 'rb') as checkpoint_file:
+        buffer = mmap.mmap(checkpoint_file.fileno(), 0, access=mmap.ACCESS_COPY)
+    header, layout = read_header(buffer)
+    _, _, _, generation, num_group, num_switch_per_group, num_ocs, num_spine, gpus_per_group = header
+    sections = dict(zip(SECTION_NAMES, layout))
+    shapes = {
+        'num_idle_links_for_switch': (num_group, num_switch_per_group),
+        'num_idle_links_for_group': (num_group,),
+        'num_idle_links_for_spine': (num_group, num_spine),
+        'num_idle_ports': (num_group, num_ocs),
+        'num_allocatable_links': (num_group, num_group),
+        'groups': (num_group, 2),
+        'gpu_allocations': (-1, 2),
+    }
+
+    def get_array(name, dtype=np.int64):
+        offset, length = sections[name]
+        array = np.frombuffer(buffer, dtype=dtype, count=length // np.dtype(dtype).itemsize, offset=offset)
+        return array.reshape(shapes[name]) if name in shapes else array
+
+    group_counters = get_array('groups')
+    groups = Groups(num_group, gpus_per_group)
+    for group_id, (available_gpus, available_links) in enumerate(group_counters.tolist()):
+        groups.update_available_gpus(group_id, available_gpus - gpus_per_group)
+        groups.get_group(group_id)['available_links'] = available_links
+
+    offset, length = sections['metadata']
+    metadata = json.loads(bytes(buffer[offset:offset + length]))
+    jobs = get_array('jobs', JOB_DTYPE)
+    gpu_allocations = get_array('gpu_allocations').tolist()
+    link_table = get_array('links', LINK_DTYPE)
+    port_table = get_array('ports', PORT_DTYPE)
+    running_jobs = []
+    event_seqs = []
+    pending_jobs = []
+    retried_jobs = []
+    links_for_job = {}
+    ports_for_job = {}
+    jobs_in_table = []
+    gpu_index = 0
+    link_index = 0
+    port_index = 0
+    for index, (record, job_id) in enumerate(zip(jobs.tolist(), metadata['job_ids'])):
+        (
+            gpu_count,
+            job_time,
+            submit_time,
+            priority,
+            start_time,
+            event_seq,
+            retried,
+            num_gpu_groups,
+            num_links,
+            num_ports,
+        ) = record
+        job = Job(gpu_count, job_time, submit_time, job_id=job_id, priority=priority)
+        jobs_in_table.append(job)
+        if index < metadata['num_running_jobs']:
+            job.start(start_time)
+            running_jobs.append(job)
+            event_seqs.append(event_seq)
+            groups.assign_gpu_for_job(
+                job, dict(map(tuple, gpu_allocations[gpu_index:gpu_index + num_gpu_groups]))
+            )
+            if num_ports >= 0:
+                # 跨pod任务在本pod只占用端口，结束时只释放端口
+                ports_for_job[job] = port_table[port_index:port_index + num_ports]
+            else:
+                # 链路表是映射上的视图，迁移链路时原地修改
+                links_for_job[job] = link_table[link_index:link_index + num_links]
+        else:
+            pending_jobs.append(job)
+            if retried:
+                retried_jobs.append(job)
+        gpu_index += num_gpu_groups
+        link_index += num_links
+        port_index += max(num_ports, 0)
+    num_preemptions_for_job = {
+        jobs_in_table[index]: count for index, count in metadata['num_preemptions_for_job']
+    }
+    # 旧版本写的检查点没有链路补充的状态
+    upgrader_state = metadata.get('upgrader')
+    if upgrader_state is not None:
+        upgrader_state = {
+            **upgrader_state,
+            'missing_links': {
+                jobs_in_table[index]: {
+                    (group_id_1, group_id_2): num_missing for group_id_1, group_id_2, num_missing in missing
+                }
+                for index, missing in upgrader_state['missing_links']
+            },
+        }
+
+    offset, length = sections['idle_links']
+    links = Links.from_buffers(
+        memoryview(buffer)[offset:offset + length],
+        {name: get_array(name) for name in COUNTER_NAMES},
+        links_for_job,
+        groups,
+        ports_for_job,
+    )
+    return Checkpoint(
+        groups,
+        links,
+        running_jobs,
+        event_seqs,
+        pending_jobs,
+        retried_jobs,
+        num_preemptions_for_job,
+        upgrader_state,
+        metadata['simulator'],
+        generation,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="checkpoint a simulation mid-trace and resume it from the file")
+    parser.add_argument('path')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--num-jobs', type=int, default=300)
+    parser.add_argument('--submit-interval', type=int, default=1)
+    parser.add_argument('--until', type=int, default=50)
+    args = parser.parse_args()
+
+    groups = Groups()
+    links = Links(groups)
+    simulator = Simulator(generate_jobs(args.num_jobs, args.seed, args.submit_interval), links, groups)
+    simulator.run(until=args.until)
+    start = time.perf_counter()
+    num_bytes = save(args.path, links, groups, simulator)
+    print(f"saved {num_bytes} bytes at time {simulator.time} in {(time.perf_counter() - start) * 1000:.2f}ms")
+    start = time.perf_counter()
+    checkpoint = load(args.path)
+    print(f"restored in {(time.perf_counter() - start) * 1000:.2f}ms")
+    resumed = checkpoint.make_simulator(generate_jobs(args.num_jobs, args.seed, args.submit_interval)).run()
+    print("resumed:      ", resumed)
+    print("uninterrupted:", simulator.run())
@@ -0,0 +1,546 @@
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from groups import Groups
+from jobs import Job, generate_jobs
+from links import Links
+from physical_link_allocate import PhysicalLinkeAllocatingAlthrighm
+from reconfig import MockOcsController, OcsBatch, OcsController, ReconfigurationError, dispatch, record
+from simulator import SchedulingPolicy, Simulator
+
+DEFAULT_SOCKET_PATH = '/tmp/ocs_allocate.sock'
+
+# 由唯一的写任务处理的请求，其余（查询）直接读快照
+MUTATING_OPS = {'submit', 'complete'}
+
+
+class Snapshot(NamedTuple):
+    """一轮调度结束时的只读状态，发布后不再修改，查询不需要等写任务"""
+
+    version: int
+    time: float
+    num_idle_links: Tuple[int, ...]
+    available_gpus: Tuple[int, ...]
+    # {job_id: 'running' / 'queued'}，只包含未结束的任务
+    job_states: Dict
+    stats: Dict
+
+
+# 任务的数值字段都要能存进检查点的int64列
+MAX_FIELD_VALUE = int(np.iinfo(np.int64).max)
+
+
+def parse_number(request: Dict, name: str, integer: bool = False):
+    """
+    读取请求中的数值字段
+
+    Raises:
+        ValueError: 字段缺失、不是数字（bool和字符串都不算）、不是有限值、绝对值超过MAX_FIELD_VALUE，
+            integer为True时不是整数（1.5不会被截断成1）
+    """
+    value = request.get(name)
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError(f"{name} must be a number, got {value!r}")
+    # 大整数转成float会溢出，先比较大小再检查是否有限
+    if abs(value) > MAX_FIELD_VALUE or not math.isfinite(value):
+        raise ValueError(f"{name} must be finite and at most {MAX_FIELD_VALUE} in magnitude, got {value!r}")
+    if integer:
+        if value != int(value):
+            raise ValueError(f"{name} must be an integer, got {value!r}")
+        value = int(value)
+    return value
+
+
+def parse_positive(request: Dict, name: str, integer: bool = False):
+    """
+    读取请求中的正数字段
+
+    Raises:
+        ValueError: 不是合法的数值字段（见parse_number）或不大于0
+    """
+    value = parse_number(request, name, integer)
+    if value <= 0:
+        raise ValueError(f"{name} must be positive, got {value!r}")
+    return value
+
+
+def parse_job_id(request: Dict):
+    """
+    读取请求中的job_id，缺失时返回None
+
+    Raises:
+        ValueError: job_id不是字符串或整数（bool不算），不能作为任务的键
+    """
+    job_id = request.get('job_id')
+    if job_id is not None and (isinstance(job_id, bool) or not isinstance(job_id, (str, int))):
+        raise ValueError(f"job_id must be a string or an integer, got {job_id!r}")
+    return job_id
+
+
+class AllocationDaemon:
+    """
+    通过Unix socket接收任务提交、完成通知和容量查询的分配服务
+
+    协议是每行一个JSON对象，请求可带id，响应原样带回，同一连接上可以流水线发送：
+        {"op": "submit", "gpu_count": 1024, "time": 2, "priority": 0, "job_id": ...}
+            -> {"status": "started", "job_id": ..., "gpus": {group_id: n}, "num_links": n}
+               或 {"status": "queued" / "rejected", "job_id": ...}
+        {"op": "complete", "job_id": ...} -> {"status": "finished", "job_id": ...}
+        {"op": "wait_start", "job_id": ...} -> {"status": "running" / "rejected" / "unknown", "job_id": ...}
+        {"op": "idle_links"} / {"op": "available_gpus"} / {"op": "status", "job_id": ...} / {"op": "stats"}
+
+    Links和Groups只由一个写线程修改：提交和完成通知进入队列，写任务收到第一个请求后
+    再等batch_window秒，把期间到达的请求合并成一轮调度（先处理完成，再加入新任务，
+    最后按调度策略启动等待中的任务），每轮结束时发布新的Snapshot。
+    调度在单独的线程中运行，事件循环在此期间继续用上一个快照回答查询。
+    提交的响应是它所在那一轮的决定，之后才启动的排队任务可以用status查询，
+    或者用wait_start等到它启动（或被拒绝）时再收到响应。
+    job_id只能是字符串或整数，其余字段有误时只有该请求返回错误，同一轮的其他请求照常处理。
+    给出controller时，每轮的链路变化合并成每台OCS一个批次并发下发，下发完成后才回复。
+    时间单位是秒（服务启动后的时间），任务的time是预计运行时长，只用于回填预留。
+    """
+
+    def __init__(
+        self,
+        links: Links,
+        group: Groups,
+        alghrithm: PhysicalLinkeAllocatingAlthrighm = PhysicalLinkeAllocatingAlthrighm.OPTIMIZE,
+        policy: SchedulingPolicy = SchedulingPolicy.FIFO,
+        batch_window: float = 0.001,
+        max_batch: int = 256,
+        controller: Optional[OcsController] = None,
+    ):
+        self.links = links
+        self.group = group
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.controller = controller
+        # 调度逻辑（策略、准入检查、统计）与仿真共用，任务由请求而不是trace提供
+        self.simulator = Simulator([], links, group, alghrithm, policy=policy)
+        # {job_id: job} 运行中和排队中的任务
+        self.jobs: Dict = {}
+        self.job_ids = itertools.count()
+        self.start_time = time.monotonic()
+        self.version = 0
+        self.num_rounds = 0
+        self.snapshot = self.make_snapshot()
+        self.queue: Optional[asyncio.Queue] = None
+        # {job_id: [future]} 等待排队任务启动的wait_start请求，只在事件循环中访问
+        self.start_waiters: Dict = {}
+        # 唯一修改Links和Groups的线程
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='allocation-writer')
+
+    def make_snapshot(self) -> Snapshot:
+        """在写线程中调用，复制出本轮结束时的状态"""
+        return Snapshot(
+            self.version,
+            self.simulator.time,
+            tuple(self.links.get_num_idle_links()),
+            tuple(group['available_gpus'] for group in self.group.groups),
+            {job_id: 'running' if job.is_running else 'queued' for job_id, job in self.jobs.items()},
+            {**self.simulator.get_stats(), 'rounds': self.num_rounds, 'pending_jobs': len(self.simulator.pending)},
+        )
+
+    def run_round(self, requests: List[Dict]) -> Tuple[List[Dict], Snapshot, Dict[int, OcsBatch]]:
+        """
+        在写线程中执行一轮：处理一批提交和完成通知，然后调度一次
+
+        Returns:
+            Tuple: (与requests一一对应的响应, 本轮结束时的快照, 本轮每台OCS要下发的批次)
+        """
+        with record(self.links) as plan:
+            responses = self.__run_round(requests)
+        return responses, self.make_snapshot(), plan.get_batches()
+
+    def __run_round(self, requests: List[Dict]) -> List[Dict]:
+        simulator = self.simulator
+        simulator.time = time.monotonic() - self.start_time
+        responses = [None] * len(requests)
+        submitted = []
+        # 先处理完成通知，释放的资源本轮就可以使用
+        for index, request in enumerate(requests):
+            if request['op'] != 'complete':
+                continue
+            try:
+                job_id = parse_job_id(request)
+            except ValueError as error:
+                responses[index] = {'error': str(error)}
+                continue
+            job = self.jobs.get(job_id)
+            if job is None or not job.is_running:
+                responses[index] = {'error': f"job {job_id!r} is not running"}
+                continue
+            simulator.complete(job)
+            del self.jobs[job.job_id]
+            responses[index] = {'status': 'finished', 'job_id': job.job_id}
+        for index, request in enumerate(requests):
+            if request['op'] != 'submit':
+                continue
+            # 所有字段在修改任何状态之前检查完，出错的请求只影响自己
+            try:
+                job_id = parse_job_id(request)
+                gpu_count = parse_positive(request, 'gpu_count', integer=True)
+                duration = parse_positive(request, 'time')
+                priority = parse_number(request, 'priority', integer=True) if 'priority' in request else 0
+            except ValueError as error:
+                responses[index] = {'error': f"bad submit request: {error}"}
+                continue
+            if job_id is None:
+                job_id = next(self.job_ids)
+            if job_id in self.jobs:
+                responses[index] = {'error': f"job {job_id!r} already exists"}
+                continue
+            job = Job(gpu_count, duration, simulator.time, job_id=job_id, priority=priority)
+            if job.gpu_count > simulator.total_gpus:
+                responses[index] = {'status': 'rejected', 'job_id': job_id}
+                simulator.num_rejected += 1
+                continue
+            self.jobs[job_id] = job
+            simulator.pending.append(job)
+            simulator.num_submitted += 1
+            submitted.append((index, job))
+        rejected = set()
+        try:
+            simulator.schedule()
+            job = simulator.reject_unrunnable()
+            while job is not None:
+                del self.jobs[job.job_id]
+                rejected.add(job)
+                simulator.schedule()
+                job = simulator.reject_unrunnable()
+        except Exception:
+            # 去掉本轮提交、尚未启动的任务，否则之后每一轮都会在同一个任务上出错
+            for _, job in submitted:
+                if not job.is_running and job in self.jobs.values():
+                    if job in simulator.pending:
+                        simulator.pending.remove(job)
+                    simulator.retried_jobs.discard(job)
+                    del self.jobs[job.job_id]
+            raise
+        for index, job in submitted:
+            if job.is_running:
+                responses[index] = {
+                    'status': 'started',
+                    'job_id': job.job_id,
+                    'gpus': self.group.gpus_for_job[job],
+                    'num_links': len(self.links.get_links_for_job(job)),
+                }
+            else:
+                responses[index] = {'status': 'rejected' if job in rejected else 'queued', 'job_id': job.job_id}
+        self.version += 1
+        self.num_rounds += 1
+        return responses
+
+    async def writer(self):
+        """唯一的写任务：合并短时间内到达的请求，交给写线程执行一轮调度"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            if self.batch_window > 0:
+                await asyncio.sleep(self.batch_window)
+            while len(batch) < self.max_batch and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            requests = [request for request, _ in batch]
+            try:
+                responses, snapshot, batches = await loop.run_in_executor(self.executor, self.run_round, requests)
+            except Exception as error:  # 一轮出错时整批返回错误，服务继续运行
+                for _, future in batch:
+                    if not future.done():
+                        future.set_result({'error': repr(error)})
+                continue
+            self.snapshot = snapshot
+            if self.controller is not None and batches:
+                # 下一轮要等本轮下发完成，每台OCS上的操作保持提交顺序
+                try:
+                    await dispatch(batches, self.controller)
+                except ReconfigurationError as error:
+                    responses = [{**response, 'error': str(error)} for response in responses]
+            for (_, future), response in zip(batch, responses):
+                if not future.done():
+                    future.set_result(response)
+            self.notify_waiters()
+
+    async def wait_start(self, job_id) -> Dict:
+        """等到排队中的任务不再排队，不是排队中的任务立即返回它当前的状态"""
+        status = self.snapshot.job_states.get(job_id, 'unknown')
+        if status == 'queued':
+            future = asyncio.get_running_loop().create_future()
+            self.start_waiters.setdefault(job_id, []).append(future)
+            status = await future
+        return {'status': status, 'job_id': job_id}
+
+    def notify_waiters(self):
+        """一轮的链路下发完成后，唤醒等待的任务已经启动或被拒绝的wait_start请求"""
+        job_states = self.snapshot.job_states
+        for job_id in list(self.start_waiters):
+            status = job_states.get(job_id, 'rejected')
+            if status == 'queued':
+                continue
+            for future in self.start_waiters.pop(job_id):
+                if not future.done():
+                    future.set_result(status)
+
+    def query(self, request: Dict) -> Dict:
+        """只读查询，直接由当前快照回答"""
+        snapshot = self.snapshot
+        op = request['op']
+        if op == 'idle_links':
+            if 'group_id' in request:
+                return {'num_idle_links': snapshot.num_idle_links[int(request['group_id'])], 'version': snapshot.version}
+            return {'num_idle_links': snapshot.num_idle_links, 'version': snapshot.version}
+        if op == 'available_gpus':
+            return {'available_gpus': snapshot.available_gpus, 'version': snapshot.version}
+        if op == 'status':
+            return {
+                'job_id': request.get('job_id'),
+                'status': snapshot.job_states.get(request.get('job_id'), 'unknown'),
+                'version': snapshot.version,
+            }
+        if op == 'stats':
+            return {'stats': snapshot.stats, 'version': snapshot.version}
+        return {'error': f"unknown op {op!r}"}
+
+    async def handle_request(self, line: bytes) -> Dict:
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict) or 'op' not in request:
+                raise ValueError("request must be a JSON object with an op")
+        except ValueError as error:
+            return {'error': str(error)}
+        if request['op'] == 'wait_start':
+            try:
+                response = await self.wait_start(parse_job_id(request))
+            except ValueError as error:
+                response = {'error': str(error)}
+        elif request['op'] in MUTATING_OPS:
+            future = asyncio.get_running_loop().create_future()
+            await self.queue.put((request, future))
+            response = await future
+        else:
+            try:
+                response = self.query(request)
+            except (IndexError, TypeError, ValueError) as error:
+                response = {'error': repr(error)}
+        if 'id' in request:
+            response = {'id': request['id'], **response}
+        return response
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """同一连接上的请求并发处理，响应按完成顺序写回（用id对应）"""
+        tasks = set()
+
+        async def respond(line):
+            response = await self.handle_request(line)
+            writer.write(json.dumps(response).encode() + b'\n')
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                task = asyncio.ensure_future(respond(line))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, path: str = DEFAULT_SOCKET_PATH):
+        self.queue = asyncio.Queue()
+        if os.path.exists(path):
+            os.unlink(path)
+        writer_task = asyncio.ensure_future(self.writer())
+        server = await asyncio.start_unix_server(self.handle_connection, path)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            writer_task.cancel()
+            self.executor.shutdown()
+
+
+class DaemonClient:
+    """守护进程的异步客户端，同一连接上可以有多个未完成的请求"""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.request_ids = itertools.count()
+        self.futures: Dict[int, asyncio.Future] = {}
+        self.reader_task = asyncio.ensure_future(self.read_responses())
+
+    @classmethod
+    async def connect(cls, path: str = DEFAULT_SOCKET_PATH) -> "DaemonClient":
+        reader, writer = await asyncio.open_unix_connection(path)
+        return cls(reader, writer)
+
+    async def read_responses(self):
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                break
+            response = json.loads(line)
+            self.futures.pop(response.pop('id')).set_result(response)
+
+    async def request(self, op: str, **fields) -> Dict:
+        request_id = next(self.request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.futures[request_id] = future
+        self.writer.write(json.dumps({'id': request_id, 'op': op, **fields}).encode() + b'\n')
+        await self.writer.drain()
+        return await future
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+        self.reader_task.cancel()
+
+
+async def generate_load(
+    path: str = DEFAULT_SOCKET_PATH,
+    num_clients: int = 32,
+    num_jobs: int = 10000,
+    seed: int = 0,
+    time_scale: float = 0.01,
+) -> Dict:
+    """
+    本地压测：num_clients个连接各自依次提交任务，任务启动后（排队的任务用wait_start等到启动）
+    在 time * time_scale 秒后发送完成通知，压测结束时所有启动过的任务都已完成；
+    另有一个连接持续查询idle_links，测量写任务忙时的查询延迟
+
+    Returns:
+        Dict: 提交吞吐、提交决定延迟和查询延迟的分位数（毫秒）、各种决定的个数、排队任务最终的状态
+    """
+    jobs = list(generate_jobs(num_jobs, seed))
+    rng = random.Random(seed)
+    decision_latencies = []
+    query_latencies = []
+    statuses = {}
+    # 排队任务最终的状态：running（之后启动并完成）/ rejected
+    late_statuses = {}
+    completions = set()
+    done = asyncio.Event()
+
+    async def complete_later(client, job_id, delay):
+        await asyncio.sleep(delay)
+        await client.request('complete', job_id=job_id)
+
+    async def complete_after_start(client, job_id, delay):
+        # 排队的任务从启动时开始计时
+        response = await client.request('wait_start', job_id=job_id)
+        status = response.get('status', 'error')
+        late_statuses[status] = late_statuses.get(status, 0) + 1
+        if status == 'running':
+            await complete_later(client, job_id, delay)
+
+    async def submitter(client_id):
+        client = await DaemonClient.connect(path)
+        for job_index in range(client_id, num_jobs, num_clients):
+            job = jobs[job_index]
+            start = time.perf_counter()
+            duration = job.time * time_scale
+            response = await client.request(
+                'submit', gpu_count=job.gpu_count, time=duration, job_id=f"{seed}-{job_index}"
+            )
+            decision_latencies.append(time.perf_counter() - start)
+            status = response.get('status', 'error')
+            statuses[status] = statuses.get(status, 0) + 1
+            # 运行时长加一点抖动，避免大量任务同时完成
+            if status == 'started':
+                completions.add(
+                    asyncio.ensure_future(
+                        complete_later(client, response['job_id'], duration * rng.uniform(0.5, 1.5))
+                    )
+                )
+            elif status == 'queued':
+                completions.add(
+                    asyncio.ensure_future(
+                        complete_after_start(client, response['job_id'], duration * rng.uniform(0.5, 1.5))
+                    )
+                )
+        return client
+
+    async def querier():
+        client = await DaemonClient.connect(path)
+        while not done.is_set():
+            start = time.perf_counter()
+            await client.request('idle_links')
+            query_latencies.append(time.perf_counter() - start)
+            await asyncio.sleep(0.001)
+        await client.close()
+
+    query_task = asyncio.ensure_future(querier())
+    start = time.perf_counter()
+    clients = await asyncio.gather(*(submitter(client_id) for client_id in range(num_clients)))
+    elapsed = time.perf_counter() - start
+    done.set()
+    await query_task
+    if completions:
+        await asyncio.gather(*completions)
+    for client in clients:
+        await client.close()
+    decision_ms = np.array(decision_latencies) * 1000
+    query_ms = np.array(query_latencies) * 1000 if query_latencies else np.zeros(1)
+    return {
+        'submissions_per_second': num_jobs / elapsed,
+        'decision_p50_ms': float(np.percentile(decision_ms, 50)),
+        'decision_p99_ms': float(np.percentile(decision_ms, 99)),
+        'query_p50_ms': float(np.percentile(query_ms, 50)),
+        'query_p99_ms': float(np.percentile(query_ms, 99)),
+        'decisions': statuses,
+        'queued_outcomes': late_statuses,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OCS link allocation daemon over a Unix socket")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    serve_parser = subparsers.add_parser('serve', help="run the daemon")
+    serve_parser.add_argument('--socket', default=DEFAULT_SOCKET_PATH)
+    serve_parser.add_argument(
+        '--alghrithm', default='OPTIMIZE', choices=[alghrithm.name for alghrithm in PhysicalLinkeAllocatingAlthrighm]
+    )
+    serve_parser.add_argument('--policy', default='FIFO', choices=[policy.name for policy in SchedulingPolicy])
+    serve_parser.add_argument('--batch-window', type=float, default=0.001, help="seconds to coalesce submissions")
+    serve_parser.add_argument(
+        '--mock-ocs-latency', type=float, help="push reconfigurations to a mock OCS controller with this call latency"
+    )
+    load_parser = subparsers.add_parser('load', help="run the local load generator against a daemon")
+    load_parser.add_argument('--socket', default=DEFAULT_SOCKET_PATH)
+    load_parser.add_argument('--clients', type=int, default=32)
+    load_parser.add_argument('--num-jobs', type=int, default=10000)
+    load_parser.add_argument('--seed', type=int, default=0)
+    load_parser.add_argument('--time-scale', type=float, default=0.01, help="seconds per job time unit")
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        groups = Groups()
+        daemon = AllocationDaemon(
+            Links(groups),
+            groups,
+            PhysicalLinkeAllocatingAlthrighm[args.alghrithm],
+            SchedulingPolicy[args.policy],
+            args.batch_window,
+            controller=MockOcsController(args.mock_ocs_latency) if args.mock_ocs_latency is not None else None,
+        )
+        try:
+            asyncio.run(daemon.serve(args.socket))
+        except KeyboardInterrupt:
+            pass
+    else:
+        report = asyncio.run(generate_load(args.socket, args.clients, args.num_jobs, args.seed, args.time_scale))
+        print(json.dumps(report, indent=2))
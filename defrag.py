@@ -0,0 +1,195 @@
+from typing import Dict, List, NamedTuple, Tuple
+
+import numpy as np
+
+from jobs import Job
+from links import Links, find_idle_switch
+
+
+class LinkMove(NamedTuple):
+    job: Job
+    link_index: int  # 在任务链路数组中的下标
+    old_link: Tuple[int, int, int, int, int]
+    new_link: Tuple[int, int, int, int, int]
+    gain: int  # 这次迁移使所有group对的可分配链路总数增加多少
+
+
+class DefragPlan:
+    """一次碎片整理的迁移计划，以及计划前后所有group对可分配链路数之和"""
+
+    def __init__(self, moves: List[LinkMove], capacity_before: int, capacity_after: int):
+        self.moves = moves
+        self.capacity_before = capacity_before
+        self.capacity_after = capacity_after
+
+    def get_moves_for_jobs(self) -> Dict[Job, List[Tuple[int, Tuple[int, int, int, int, int]]]]:
+        """转换成Links.move_links_for_job的参数，同一条链路迁移多次时只保留最终位置"""
+        final_links = {}
+        for move in self.moves:
+            final_links[(move.job, move.link_index)] = move.new_link
+        moves_for_jobs = {}
+        for (job, link_index), new_link in final_links.items():
+            moves_for_jobs.setdefault(job, []).append((link_index, new_link))
+        return moves_for_jobs
+
+    def get_report(self) -> Dict:
+        gained = self.capacity_after - self.capacity_before
+        return {
+            'reconfigurations': len(self.moves),
+            'capacity_before': self.capacity_before,
+            'capacity_after': self.capacity_after,
+            'capacity_gained': gained,
+            'capacity_gained_per_reconfiguration': gained / len(self.moves) if self.moves else 0.0,
+        }
+
+
+def get_total_capacity(idle_ports: np.ndarray) -> int:
+    """
+    所有group对 (g < h) 的可分配链路数之和：sum_o min(idle_ports[g, o], idle_ports[h, o])
+
+    每列升序排序后第i小的值是它与后面 G-1-i 个group的最小值
+    """
+    num_group = idle_ports.shape[0]
+    sorted_ports = np.sort(idle_ports, axis=0)
+    return int((sorted_ports * (num_group - 1 - np.arange(num_group))[:, None]).sum())
+
+
+def count_higher(idle_ports: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns:
+        (greater, greater_equal): 形状都是 (num_group, num_ocs)，
+        分别是同一ocs上空闲端口数大于 / 不小于该group的其它group个数
+    """
+    num_group, num_ocs = idle_ports.shape
+    max_ports = int(idle_ports.max()) if idle_ports.size else 0
+    # at_least[v, o]: ocs o上空闲端口数 >= v 的group个数
+    histogram = np.zeros((max_ports + 2, num_ocs), dtype=np.int64)
+    np.add.at(histogram, (idle_ports, np.broadcast_to(np.arange(num_ocs), idle_ports.shape)), 1)
+    at_least = np.cumsum(histogram[::-1], axis=0)[::-1]
+    columns = np.arange(num_ocs)
+    greater = at_least[idle_ports + 1, columns]
+    greater_equal = at_least[idle_ports, columns] - 1
+    return greater, greater_equal
+
+
+def plan_defrag(links: Links, budget: int, min_gain: int = 1) -> DefragPlan:
+    """
+    贪心地规划链路迁移：每一步把一条已分配的链路 (g1, s1, g2, s2, o) 改接到
+    同一spine上另一个两端都有空闲端口的ocs o'，选使所有group对可分配链路总数
+    增加最多的一步，直到用完budget或没有收益不少于min_gain的迁移
+
+    一条链路从o移到o'时，对第三个group h：
+    在o上 g1、g2 的空闲端口各加一，只有当h在o上的空闲端口比它多时 min 才增加；
+    在o'上各减一，只有当h在o'上的空闲端口不比它少时 min 才减少；
+    g1与g2之间在o上加一、在o'上减一，相互抵消。
+    因此收益只依赖同一ocs上比g1/g2空闲多的group个数，可以对所有候选向量化计算。
+
+    只读Links，不修改任何状态；计划在本地的空闲端口矩阵和事务中模拟。
+
+    Args:
+        links: 链路状态
+        budget: 最多迁移多少条链路（每条迁移是一次OCS重配置）
+        min_gain: 一次迁移至少要增加的可分配链路数
+    """
+    idle_ports = links.get_num_idle_ports()
+    capacity_before = get_total_capacity(idle_ports)
+    switch_pair_index = links.get_switch_pair_index()
+    spine_ids = np.array(switch_pair_index.spine_ids)
+    spine_ports = [np.array(list(ports.search(1)), dtype=np.int64) for ports in switch_pair_index.spine_ports]
+    transaction = links.begin()
+
+    link_jobs = []
+    link_indices = []
+    link_arrays = []
+    for job, job_links in links.get_links_for_jobs().items():
+        link_jobs.extend([job] * len(job_links))
+        link_indices.extend(range(len(job_links)))
+        link_arrays.append(job_links)
+    moves = []
+    if not link_arrays:
+        transaction.rollback()
+        return DefragPlan(moves, capacity_before, capacity_before)
+    # 计划过程中随迁移更新的所有链路 (n, 5)
+    all_links = np.stack(
+        [np.concatenate([job_links[field] for job_links in link_arrays]).astype(np.int64)
+         for field in ('src_group', 'src_switch', 'dst_group', 'dst_switch', 'ocs')],
+        axis=1,
+    )
+    link_spines = spine_ids[all_links[:, 0], all_links[:, 1]]
+
+    while len(moves) < budget:
+        greater, greater_equal = count_higher(idle_ports)
+        group_1, group_2, ocs = all_links[:, 0], all_links[:, 2], all_links[:, 4]
+        # 释放o上的端口带来的收益，去掉g1与g2之间的项
+        free_gain = (
+            greater[group_1, ocs] - (idle_ports[group_2, ocs] > idle_ports[group_1, ocs])
+            + greater[group_2, ocs] - (idle_ports[group_1, ocs] > idle_ports[group_2, ocs])
+        )
+        best = None
+        for spine_id, ports in enumerate(spine_ports):
+            in_spine = np.flatnonzero(link_spines == spine_id)
+            if len(in_spine) == 0:
+                continue
+            # 占用o'的代价只与 (g1, g2, o') 有关：每个group对只需取释放收益最大的一条链路
+            pair_keys = group_1[in_spine] * len(idle_ports) + group_2[in_spine]
+            order = np.lexsort((-free_gain[in_spine], pair_keys))
+            first = np.ones(len(order), dtype=bool)
+            first[1:] = pair_keys[order][1:] != pair_keys[order][:-1]
+            candidates = in_spine[order[first]]
+            src_ports = idle_ports[group_1[candidates][:, None], ports[None, :]]
+            dst_ports = idle_ports[group_2[candidates][:, None], ports[None, :]]
+            use_cost = (
+                greater_equal[group_1[candidates][:, None], ports[None, :]] - (dst_ports >= src_ports)
+                + greater_equal[group_2[candidates][:, None], ports[None, :]] - (src_ports >= dst_ports)
+            )
+            gains = free_gain[candidates][:, None] - use_cost
+            gains[(src_ports == 0) | (dst_ports == 0)] = np.iinfo(np.int64).min
+            candidate_index, port_index = np.unravel_index(np.argmax(gains), gains.shape)
+            gain = int(gains[candidate_index, port_index])
+            if best is None or gain > best[0]:
+                best = (gain, int(candidates[candidate_index]), int(ports[port_index]))
+        if best is None or best[0] < min_gain:
+            break
+        gain, link_id, new_ocs = best
+        src_group, src_switch, dst_group, dst_switch, old_ocs = all_links[link_id].tolist()
+        new_src_switch = find_idle_switch(transaction, src_group, new_ocs)
+        new_dst_switch = find_idle_switch(transaction, dst_group, new_ocs)
+        # 在事务中模拟迁移，之后的迁移能看到这次的结果
+        transaction.get_row(src_group, src_switch)[old_ocs] = 1
+        transaction.get_row(dst_group, dst_switch)[old_ocs] = 1
+        transaction.get_row(src_group, new_src_switch)[new_ocs] = 0
+        transaction.get_row(dst_group, new_dst_switch)[new_ocs] = 0
+        idle_ports[[src_group, dst_group], old_ocs] += 1
+        idle_ports[[src_group, dst_group], new_ocs] -= 1
+        new_link = (src_group, new_src_switch, dst_group, new_dst_switch, new_ocs)
+        moves.append(
+            LinkMove(
+                link_jobs[link_id],
+                link_indices[link_id],
+                (src_group, src_switch, dst_group, dst_switch, old_ocs),
+                new_link,
+                gain,
+            )
+        )
+        all_links[link_id] = new_link
+    transaction.rollback()
+    return DefragPlan(moves, capacity_before, get_total_capacity(idle_ports))
+
+
+def apply_defrag(links: Links, plan: DefragPlan):
+    """把计划一次性应用到Links，整批校验通过后才修改，要么全部迁移要么都不迁移"""
+    if plan.moves:
+        links.move_links_for_job(plan.get_moves_for_jobs())
+
+
+def defrag(links: Links, budget: int, min_gain: int = 1, dry_run: bool = False) -> DefragPlan:
+    """
+    规划并（除非dry_run）应用一次碎片整理，可以在两轮调度之间调用
+
+    Returns:
+        DefragPlan: 迁移计划，get_report()给出恢复的可分配链路数及每次重配置的收益
+    """
+    plan = plan_defrag(links, budget, min_gain)
+    if not dry_run:
+        apply_defrag(links, plan)
+    return plan
@@ -1,17 +1,106 @@
-from typing import List, Tuple, Set
+from collections import OrderedDict
+from enum import IntEnum
 import numpy as np
 
-def gpu_allocate(job_gpu_count, group):
+from instrumentation import instrumentation
+
+
+GPUS_PER_TRAFFIC_GROUP = 128  # 每128卡为一个流量组
+MESSAGE_SIZE = 128*100  # 每次传输128*100MB（每个数据并行组）
+TRAFFIC_BATCHES_PER_SECOND = 20  # 每秒可以计算50个batch(iteration)
+MB_TO_GBITS = 8 / 1000  # 1MB = 0.008Gb
+GPUS_PER_COMM_GROUP = 128  # 每128卡为一个通信组
+FLOW_BATCHES_PER_SECOND = 50  # 每秒可以计算50个batch
+LINK_BANDWIDTH = 100  # 单链路带宽为100G
+
+
+class GpuPlacement(IntEnum):
+    FIRST_FIT = 0  # 从group 0开始依次放置
+    BEST_FIT = 1  # 放得下剩余GPU的最小group，否则先填满空闲最少的group
+    FEWEST_GROUPS = 2  # 放得下剩余GPU的最小group，否则先占用空闲最多的group
+
+
+class LinkDemandCache:
+    """
+    链路需求的有界LRU缓存，键为放置形状：按group_id升序的
+    (分配的GPU数, 剩余空闲GPU数, 可用链路数) 元组，与具体的group_id无关
+    """
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()
+
+    def get(self, shape):
+        best_links = self.__entries.get(shape)
+        if best_links is None:
+            self.misses += 1
+            return None
+        self.__entries.move_to_end(shape)
+        self.hits += 1
+        return best_links
+
+    def put(self, shape, best_links):
+        self.__entries[shape] = best_links
+        self.__entries.move_to_end(shape)
+        if len(self.__entries) > self.maxsize:
+            self.__entries.popitem(last=False)
+
+    def invalidate(self):
+        """清空缓存，修改流量模型常量（如LINK_BANDWIDTH）后需要调用"""
+        self.__entries.clear()
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.__entries),
+            'hit_rate': self.hits / lookups if lookups > 0 else 0.0,
+        }
+
+
+link_demand_cache = LinkDemandCache()
+
+
+@instrumentation.timed("gpu_allocate")
+def gpu_allocate(job_gpu_count, group, gpu_allocation=None, placement=GpuPlacement.FIRST_FIT,
+                 cache=link_demand_cache):
     """
     为任务分配GPU资源并计算链路需求
     
     Args:
         job_gpu_count: 任务需要的GPU数量
         group: Groups对象，包含所有计算集群组的信息
+        gpu_allocation: 可选的dict，分配成功时写入 {group_id: 分配的GPU数量}，
+            用于区分"分配失败"和"只用了一个组因而没有链路需求"
+        placement: GPU放置策略，见GpuPlacement
+        cache: 链路需求缓存，传None时每次重新计算
     
     Returns:
         List[Tuple[int, int, int, int]]: 链路需求列表，每个元素是(group_id_1, group_id_2, min_links, max_links)
     """
+    if placement == GpuPlacement.FIRST_FIT:
+        allocation = place_first_fit(job_gpu_count, group)
+    else:
+        allocation = place_by_capacity(job_gpu_count, group, placement)
+    if allocation is None:
+        return []
+    
+    used_allocation = {group_id: gpus for group_id, gpus in enumerate(allocation) if gpus > 0}
+    if gpu_allocation is not None:
+        gpu_allocation.update(used_allocation)
+    
+    return calculate_link_demand(used_allocation, group, cache)
+
+def place_first_fit(job_gpu_count, group):
+    """
+    首次适应放置：从group 0开始依次占用空闲GPU
+
+    Returns:
+        List[int] | None: 每个group分配的GPU数量，失败时返回None（已回滚）
+    """
     GROUP_COUNT = group.num_groups
     
     # 创建分配方案
@@ -86,169 +175,147 @@ def gpu_allocate(job_gpu_count, group):
     if remaining_gpus <= 0:
         allocation_success = True
     
-    # 如果分配失败，回滚已分配的资源并返回空列表
+    # 如果分配失败，回滚已分配的资源
     if not allocation_success:
         # 回滚已分配的GPU
         for group_id, allocated_gpus in enumerate(allocation):
             if allocated_gpus > 0:
                 group.update_available_gpus(group_id, allocated_gpus)
-        return []
-    
-    # 计算流量矩阵和流数矩阵
-    traffic_matrix = calculate_traffic_matrix(allocation)
-    flow_matrix = calculate_flow_count_matrix(allocation)
-    
-    # 找出所有有分配GPU的组
-    used_groups = {i for i, gpus in enumerate(allocation) if gpus > 0}
-    
-    # 如果只有一个组被分配了GPU，则无需链路
-    if len(used_groups) <= 1:
-        return []
-    
-    # 初始化链路矩阵
-    best_links_matrix = np.zeros((GROUP_COUNT, GROUP_COUNT), dtype=int)
-    min_links_matrix = np.zeros((GROUP_COUNT, GROUP_COUNT), dtype=int)
-    
-    # 计算每个集群的总带宽需求
-    total_traffic = {g: 0 for g in used_groups}
-    for g1 in used_groups:
-        total_traffic[g1] = sum(traffic_matrix[g1])
-    
-    # 获取每个集群的初始可用链路数 (不受GPU使用影响的链路数)
-    initial_uplinks = {g: group.get_group(g)['available_links'] for g in used_groups}
-    
-    # 计算组间链路分配
-    for g1 in used_groups:
-        for g2 in used_groups:
-            if g1 < g2:  # 只处理上三角矩阵
-                traffic = traffic_matrix[g1][g2]
-                flow = flow_matrix[g1][g2]
-                used_gpu_g1 = allocation[g1]
-                used_gpu_g2 = allocation[g2]
-                
-                if traffic > 0:
-                    # 最少链路数: 流量 > 0时至少分配1条链路
-                    min_links_matrix[g1][g2] = 1
-                    min_links_matrix[g2][g1] = 1
-                    
-                    # 获取两个组的信息
-                    group1 = group.get_group(g1)
-                    group2 = group.get_group(g2)
-                    
-                    # 计算可用链路数: 流量/100G带宽（假设100G每链路）
-                    max_links = min(
-                        initial_uplinks[g1] * (1 - group1['available_gpus'] / (group1['available_gpus'] + used_gpu_g1)),
-                        initial_uplinks[g2] * (1 - group2['available_gpus'] / (group2['available_gpus'] + used_gpu_g2))
-                    )
-                    link_capacity = traffic / 100  # 单链路带宽为100G
-                    
-                    # 计算总带宽需求
-                    total_demand = total_traffic[g1] + total_traffic[g2]
-                    
-                    # 按比例分配链路数
-                    ratio_g1 = traffic / total_traffic[g1] if total_traffic[g1] > 0 else 0
-                    ratio_g2 = traffic / total_traffic[g2] if total_traffic[g2] > 0 else 0
-                    
-                    # 计算最佳链路数
-                    best_links = int(min(
-                        max_links,
-                        flow,
-                        int(np.round(link_capacity)),
-                        initial_uplinks[g1] * (1 - group1['available_gpus'] / (group1['available_gpus'] + used_gpu_g1)) * ratio_g1,
-                        initial_uplinks[g2] * (1 - group2['available_gpus'] / (group2['available_gpus'] + used_gpu_g2)) * ratio_g2
-                    ))
-                    
-                    # 更新最佳链路数矩阵
-                    best_links_matrix[g1][g2] = best_links
-                    best_links_matrix[g2][g1] = best_links
-    
-    # 构建链路需求列表
-    link_demands = []
-    for g1 in used_groups:
-        for g2 in used_groups:
-            if g1 < g2 and best_links_matrix[g1][g2] > 0:
-                link_demands.append((g1, g2, min_links_matrix[g1][g2], best_links_matrix[g1][g2]))
+        return None
     
-    return link_demands
+    return allocation
 
-def calculate_traffic_matrix(allocation):
+def place_by_capacity(job_gpu_count, group, placement):
     """
-    计算单个任务在集群间的流量矩阵，采用环形通信模式
-    :param allocation: 单个任务的GPU分配方案
-    :return: 该任务的流量矩阵 (单位: Gbps)
+    借助Groups.capacity_index放置GPU，每一步O(log n)
+
+    先检查总空闲GPU，之后的贪心一定成功，因此边选边预留，不需要回滚。
+
+    Returns:
+        List[int] | None: 每个group分配的GPU数量，总空闲GPU不足时返回None
     """
-    GROUP_COUNT = 64
-    GPUS_PER_TRAFFIC_GROUP = 128  # 每128卡为一个流量组
-    MESSAGE_SIZE = 128*100  # 每次传输128*100MB（每个数据并行组）
-    BATCHES_PER_SECOND = 20  # 每秒可以计算50个batch(iteration)
-    MB_TO_GBITS = 8 / 1000  # 1MB = 0.008Gb
-    
-    flow_matrix = [[0] * GROUP_COUNT for _ in range(GROUP_COUNT)]
-    
-    # 找出所有有分配GPU的组
-    active_groups = [i for i, gpus in enumerate(allocation) if gpus > 0]
+    if group.total_available_gpus < job_gpu_count:
+        return None
+    allocation = [0] * group.num_groups
+    remaining_gpus = job_gpu_count
+    while remaining_gpus > 0:
+        group_id = group.capacity_index.find_best_fit(remaining_gpus)
+        if group_id is None:
+            if placement == GpuPlacement.BEST_FIT:
+                group_id = group.capacity_index.find_best_fit(1)
+            else:
+                group_id = group.capacity_index.find_largest()
+        gpus_to_allocate = min(group.get_group(group_id)['available_gpus'], remaining_gpus)
+        allocation[group_id] = gpus_to_allocate
+        group.update_available_gpus(group_id, -gpus_to_allocate)
+        remaining_gpus -= gpus_to_allocate
+    return allocation
+
+def calculate_ring_edges(allocation):
+    """
+    以稀疏边表的形式计算单个任务环形通信中相邻集群之间的流量和流数，
+    结果与原来的稠密流量矩阵和流数矩阵中的非零项一致（见allocate_test中的dense_traffic_matrix）
+    :param allocation: {group_id: 分配的GPU数量}
+    :return: (group_id_1, group_id_2, 流量(Gbps), 流数(flows/s)) 四个数组，每条边group_id_1 < group_id_2；
+             只有两个组时环上的两条边落在同一对组上，已合并
+    """
+    no_edges = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0))
+    active_groups = np.array(sorted(g for g, gpus in allocation.items() if gpus > 0), dtype=np.int64)
     if len(active_groups) <= 1:
-        return flow_matrix
-        
-    # 计算数据并行组的数量
-    total_gpus = sum(allocation)
-    dp_groups = (total_gpus + GPUS_PER_TRAFFIC_GROUP - 1) // GPUS_PER_TRAFFIC_GROUP
+        return no_edges
     
-    if dp_groups <= 1:
-        return flow_matrix
-        
-    # 计算一个batch需要的通信量（单位：MB）
-    base_volume = MESSAGE_SIZE * 2 * (dp_groups - 1)  # 128MB * 2 * (dp_groups-1)
-    
-    # 转换为每秒流量（Gbps）
-    base_volume_gbps = (base_volume * BATCHES_PER_SECOND * MB_TO_GBITS)
-    
-    # 环形通信：记录相邻集群之间的总流量
-    for i in range(len(active_groups)):
-        group1 = active_groups[i]
-        group2 = active_groups[(i + 1) % len(active_groups)]
-        
-        # 更新流量矩阵（双向相同）
-        flow_matrix[group1][group2] += base_volume_gbps
-        flow_matrix[group2][group1] += base_volume_gbps
+    total_gpus = sum(allocation.values())
+    dp_groups = (total_gpus + GPUS_PER_TRAFFIC_GROUP - 1) // GPUS_PER_TRAFFIC_GROUP
+    comm_groups = (total_gpus + GPUS_PER_COMM_GROUP - 1) // GPUS_PER_COMM_GROUP
+    if dp_groups <= 1 or comm_groups <= 1:
+        return no_edges
+    base_volume = MESSAGE_SIZE * 2 * (dp_groups - 1)
+    base_volume_gbps = (base_volume * TRAFFIC_BATCHES_PER_SECOND * MB_TO_GBITS)
+    flows_per_second = 2 * (comm_groups - 1) * FLOW_BATCHES_PER_SECOND
     
-    return flow_matrix
+    if len(active_groups) == 2:
+        return (
+            active_groups[:1],
+            active_groups[1:],
+            np.array([base_volume_gbps + base_volume_gbps]),
+            np.array([flows_per_second + flows_per_second]),
+        )
+    next_groups = np.roll(active_groups, -1)
+    return (
+        np.minimum(active_groups, next_groups),
+        np.maximum(active_groups, next_groups),
+        np.full(len(active_groups), base_volume_gbps),
+        np.full(len(active_groups), flows_per_second),
+    )
 
-def calculate_flow_count_matrix(allocation):
+def calculate_link_demand(allocation, group, cache=link_demand_cache, ring_order=None):
     """
-    计算单个任务在集群间的流数矩阵，采用环形通信模式
-    :param allocation: 单个任务的GPU分配方案
-    :return: 该任务的流数矩阵 (单位: flows/s)
+    根据GPU分配方案计算环边的最少/最佳链路数，结果按放置形状缓存
+    :param allocation: {group_id: 分配的GPU数量}，GPU已从group中扣减
+    :param group: Groups对象
+    :param cache: LinkDemandCache，传None时不使用缓存
+    :param ring_order: 可选，环上各组的顺序（allocation中group_id的一个排列），默认按group_id升序成环
+    :return: 链路需求列表 [(group_id_1, group_id_2, min_links, max_links), ...]
     """
-    GROUP_COUNT = 64
-    GPUS_PER_COMM_GROUP = 128  # 每128卡为一个通信组
-    BATCHES_PER_SECOND = 50  # 每秒可以计算50个batch
-    
-    flow_matrix = [[0] * GROUP_COUNT for _ in range(GROUP_COUNT)]
-    
-    # 找出所有有分配GPU的组
-    active_groups = [i for i, gpus in enumerate(allocation) if gpus > 0]
-    if len(active_groups) <= 1:
-        return flow_matrix
-        
-    # 计算数据并行组的数量
-    total_gpus = sum(allocation)
-    dp_groups = (total_gpus + GPUS_PER_COMM_GROUP - 1) // GPUS_PER_COMM_GROUP
+    active_groups = sorted(allocation) if ring_order is None else list(ring_order)
+    # 形状按环上的顺序排列，不同的环顺序对应不同的形状
+    shape = tuple(
+        (allocation[g], group.get_group(g)['available_gpus'], group.get_group(g)['available_links'])
+        for g in active_groups
+    )
+    best_links = cache.get(shape) if cache is not None else None
+    if best_links is None:
+        best_links = calculate_best_links(shape)
+        if cache is not None:
+            cache.put(shape, best_links)
     
-    if dp_groups <= 1:
-        return flow_matrix
+    if ring_order is not None:
+        # 按环上的顺序输出，每条边group_id_1 < group_id_2
+        return [
+            (min(active_groups[index_1], active_groups[index_2]),
+             max(active_groups[index_1], active_groups[index_2]), 1, links)
+            for index_1, index_2, links in best_links
+        ]
     
-    # 每个batch产生2*(dp_groups-1)个流
-    flows_per_batch = 2 * (dp_groups - 1)
-    flows_per_second = flows_per_batch * BATCHES_PER_SECOND
+    # 与原先遍历used_groups集合时的输出顺序保持一致
+    used_groups = {g for g in active_groups}
+    order = {g: i for i, g in enumerate(used_groups)}
+    link_demands = [
+        (active_groups[index_1], active_groups[index_2], 1, links)
+        for index_1, index_2, links in best_links
+    ]
+    link_demands.sort(key=lambda demand: (order[demand[0]], order[demand[1]]))
+    return link_demands
+
+def calculate_best_links(shape):
+    """
+    对一个放置形状一次性（向量化）计算所有环边的最佳链路数，
+    开销只与任务跨越的组数有关，与集群规模无关
+    :param shape: 按环上顺序（默认group_id升序）排列的 (分配的GPU数, 剩余空闲GPU数, 可用链路数)
+    :return: ((下标1, 下标2, 最佳链路数), ...)，下标指shape中的位置，只包含链路数大于0的边
+    """
+    used_gpus, available_gpus, uplinks = (np.array(column) for column in zip(*shape))
+    # 以形状中的位置代替group_id，环边不变
+    index_1, index_2, traffic, flow = calculate_ring_edges(dict(enumerate(used_gpus.tolist())))
+    if len(traffic) == 0:
+        return ()
     
-    # 环形通信：记录相邻集群之间的流数
-    for i in range(len(active_groups)):
-        group1 = active_groups[i]
-        group2 = active_groups[(i + 1) % len(active_groups)]
-        
-        # 更新流数矩阵（双向相同）
-        flow_matrix[group1][group2] += flows_per_second
-        flow_matrix[group2][group1] += flows_per_second
+    # 每个组的总流量
+    total_traffic = np.zeros(len(shape))
+    np.add.at(total_traffic, index_1, traffic)
+    np.add.at(total_traffic, index_2, traffic)
     
-    return flow_matrix
+    # 每个组按GPU占用比例可用于本任务的链路数（uplinks为初始可用链路数）
+    usable_links = uplinks * (1 - available_gpus / (available_gpus + used_gpus))
+    best_links = np.minimum.reduce([
+        np.minimum(usable_links[index_1], usable_links[index_2]),
+        flow,
+        np.round(traffic / LINK_BANDWIDTH),
+        usable_links[index_1] * (traffic / total_traffic[index_1]),
+        usable_links[index_2] * (traffic / total_traffic[index_2]),
+    ]).astype(np.int64)
+    return tuple(
+        (i1, i2, links)
+        for i1, i2, links in zip(index_1.tolist(), index_2.tolist(), best_links.tolist())
+        if links > 0
+    )
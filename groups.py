@@ -1,13 +1,82 @@
+from bisect import bisect_left, insort
+
+
+class GpuCapacityIndex:
+    """
+    按空闲GPU数量索引group：以GPU数量为下标的线段树记录每个取值有多少个group，
+    每个取值对应一个按group_id排序的桶。查询和更新都是O(log n)。
+    """
+
+    def __init__(self, max_gpus_per_group):
+        self.max_gpus_per_group = max_gpus_per_group
+        self.size = 1
+        while self.size < max_gpus_per_group + 1:
+            self.size *= 2
+        self.tree = [0] * (2 * self.size)
+        # {空闲GPU数量: 排序的group_id列表}
+        self.buckets = {}
+
+    def add(self, group_id, available_gpus):
+        insort(self.buckets.setdefault(available_gpus, []), group_id)
+        self.__update_count(available_gpus, 1)
+
+    def remove(self, group_id, available_gpus):
+        bucket = self.buckets[available_gpus]
+        del bucket[bisect_left(bucket, group_id)]
+        self.__update_count(available_gpus, -1)
+
+    def __update_count(self, available_gpus, delta):
+        node = available_gpus + self.size
+        while node >= 1:
+            self.tree[node] += delta
+            node //= 2
+
+    def find_best_fit(self, gpus):
+        """空闲GPU不少于gpus的group中空闲最少的一个（同样多时取group_id最小的），没有则返回None"""
+        if gpus > self.max_gpus_per_group:
+            return None
+        node = gpus + self.size
+        if self.tree[node] == 0:
+            # 向上找到第一个右侧非空的兄弟子树
+            while node > 1 and (node % 2 == 1 or self.tree[node + 1] == 0):
+                node //= 2
+            if node == 1:
+                return None
+            node += 1
+            while node < self.size:
+                node = 2 * node if self.tree[2 * node] > 0 else 2 * node + 1
+        return self.buckets[node - self.size][0]
+
+    def find_largest(self):
+        """空闲GPU最多的group，没有空闲GPU时返回None"""
+        if self.tree[1] == 0:
+            return None
+        node = 1
+        while node < self.size:
+            node = 2 * node + 1 if self.tree[2 * node + 1] > 0 else 2 * node
+        if node - self.size == 0:
+            return None
+        return self.buckets[node - self.size][0]
+
+
 class Groups:
-    def __init__(self):
-        self.num_groups = 64
+    def __init__(self, num_groups=64, gpus_per_group=2048, links_per_group=2048):
+        self.num_groups = num_groups
+        self.gpus_per_group = gpus_per_group
         self.groups = []
         for group_id in range(self.num_groups):
             self.groups.append({
                 'group_id': group_id,
-                'available_gpus': 2048,  # 初始可用GPU数量
-                'available_links': 2048   # 初始可用链路数量
+                'available_gpus': gpus_per_group,  # 初始可用GPU数量
+                'available_links': links_per_group   # 初始可用链路数量
             })
+        # {job: {group_id: 占用的GPU数量}}
+        self.gpus_for_job = {}
+        self.total_available_gpus = 0
+        self.capacity_index = GpuCapacityIndex(gpus_per_group)
+        for group in self.groups:
+            self.capacity_index.add(group['group_id'], group['available_gpus'])
+            self.total_available_gpus += group['available_gpus']
 
     def get_group(self, group_id):
         """获取指定group的信息"""
@@ -15,8 +84,24 @@ class Groups:
 
     def update_available_gpus(self, group_id, delta):
         """更新指定group的可用GPU数量"""
+        self.capacity_index.remove(group_id, self.groups[group_id]['available_gpus'])
         self.groups[group_id]['available_gpus'] += delta
+        self.capacity_index.add(group_id, self.groups[group_id]['available_gpus'])
+        self.total_available_gpus += delta
 
     def update_available_links(self, group_id, delta):
         """更新指定group的可用链路数量"""
-        self.groups[group_id]['available_links'] += delta
\ No newline at end of file
+        self.groups[group_id]['available_links'] += delta
+
+    def assign_gpu_for_job(self, job, gpu_allocation):
+        """记录任务在各group上占用的GPU（可用数量已由gpu_allocate扣减）"""
+        self.gpus_for_job[job] = gpu_allocation
+
+    def release_gpus(self, gpu_allocation):
+        """归还一次分配占用的GPU"""
+        for group_id, gpus in gpu_allocation.items():
+            self.update_available_gpus(group_id, gpus)
+
+    def free_gpu_for_job(self, job):
+        """释放任务占用的GPU"""
+        self.release_gpus(self.gpus_for_job.pop(job))
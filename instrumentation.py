@@ -0,0 +1,154 @@
+import cProfile
+import functools
+import io
+import json
+import pstats
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+
+class LatencyHistogram:
+    """以2的幂（纳秒）为桶边界的延迟直方图，记录一次只需一次bit_length和一次字典更新"""
+
+    def __init__(self):
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+        # {桶下标b: 次数}，桶b覆盖 [2**(b-1), 2**b) 纳秒
+        self.buckets: Dict[int, int] = {}
+
+    def record(self, elapsed_ns):
+        self.count += 1
+        self.total_ns += elapsed_ns
+        if elapsed_ns > self.max_ns:
+            self.max_ns = elapsed_ns
+        bucket = elapsed_ns.bit_length()
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def get_percentile_ns(self, percentile):
+        """百分位数的上界（所在桶的上边界）"""
+        if self.count == 0:
+            return 0
+        rank = percentile / 100 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(2 ** bucket, self.max_ns)
+        return self.max_ns
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'mean_us': self.total_ns / self.count / 1000 if self.count > 0 else 0.0,
+            'p50_us': self.get_percentile_ns(50) / 1000,
+            'p99_us': self.get_percentile_ns(99) / 1000,
+            'max_us': self.max_ns / 1000,
+            'buckets_ns': {2 ** bucket: count for bucket, count in sorted(self.buckets.items())},
+        }
+
+
+class Instrumentation:
+    """
+    分配流程热路径上的计时和计数
+
+    默认关闭，关闭时每个埋点只多一次属性判断，可以常驻在生产代码中。
+    计数器按名字累加，如 links_requested.OPTIMIZE、switch_pairs_probed.OPTIMIZE；
+    计时按名字记录到LatencyHistogram。
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.latencies: Dict[str, LatencyHistogram] = {}
+        self.counters: Dict[str, int] = {}
+        # 最近一次profile()的文本结果
+        self.last_profile: Optional[str] = None
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        self.latencies.clear()
+        self.counters.clear()
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def record_latency(self, name, elapsed_ns):
+        histogram = self.latencies.get(name)
+        if histogram is None:
+            histogram = self.latencies[name] = LatencyHistogram()
+        histogram.record(elapsed_ns)
+
+    def timed(self, name):
+        """
+        装饰器：开启时记录被装饰函数每次调用的耗时，调用次数即直方图的count
+
+        Args:
+            name: 指标名
+        """
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                start = time.perf_counter_ns()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.record_latency(name, time.perf_counter_ns() - start)
+
+            return wrapper
+
+        return decorator
+
+    @contextmanager
+    def profile(self, path: Optional[str] = None, limit: int = 30):
+        """
+        按需开启cProfile，退出时把按累计时间排序的结果保存到self.last_profile，
+        给出path时同时写出可用pstats/snakeviz打开的profile文件
+
+        用法:
+            with instrumentation.profile('simulate.prof'):
+                simulator.run()
+        """
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield profiler
+        finally:
+            profiler.disable()
+            if path is not None:
+                profiler.dump_stats(path)
+            output = io.StringIO()
+            pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(limit)
+            self.last_profile = output.getvalue()
+
+    def to_dict(self):
+        report = {
+            'latencies': {name: histogram.to_dict() for name, histogram in sorted(self.latencies.items())},
+            'counters': dict(sorted(self.counters.items())),
+        }
+        # 每条分配成功的链路平均探测了多少个交换机对
+        probes_per_link = {}
+        for name, probes in self.counters.items():
+            if not name.startswith('switch_pairs_probed.'):
+                continue
+            alghrithm = name.split('.', 1)[1]
+            granted = self.counters.get('links_granted.' + alghrithm, 0)
+            if granted > 0:
+                probes_per_link[alghrithm] = probes / granted
+        report['switch_pairs_probed_per_link'] = probes_per_link
+        return report
+
+    def export_json(self, path):
+        with open(path, 'w') as output:
+            json.dump(self.to_dict(), output, indent=2)
+
+
+instrumentation = Instrumentation()
@@ -1,10 +1,20 @@
+import csv
+import gzip
+import json
 import random
 
 
 class Job:
-    def __init__(self, gpu_count, time):
+    # 集群中可能同时存在大量任务，用__slots__去掉每个实例的__dict__
+    __slots__ = ('job_id', 'gpu_count', 'time', 'submit_time', 'priority', 'start_time', 'is_running')
+
+    def __init__(self, gpu_count, time, submit_time=0, job_id=None, priority=0):
+        self.job_id = job_id
+        # 优先级越大越先获得释放出来的链路
+        self.priority = priority
         self.gpu_count = gpu_count
         self.time = time
+        self.submit_time = submit_time
         self.start_time = None
         self.is_running = False
 
@@ -16,31 +26,95 @@ class Job:
     def end(self, end_time):
         assert self.is_running == True
         assert self.start_time + self.time == end_time
-        self.is_running == False
+        self.is_running = False
+
+    @property
+    def end_time(self):
+        return self.start_time + self.time
+
+
+# 可选的GPU数量及其对应的时间
+GPU_TIME_OPTIONS = [
+    (512, 1),
+    (512, 1),
+    (512, 1),  # 512 GPU jobs take 1 time unit
+    (1024, 2),
+    (1024, 2),
+    (1024, 2),  # 1024 GPU jobs take 2 time units
+    (2048, 3),  # 2048 GPU jobs take 3 time units
+    (4096, 4),  # 4096 GPU jobs take 4 time units
+    (8192, 5),  # 8192 GPU jobs take 5 time units
+    (16384, 6),  # 16384 GPU jobs take 6 time units
+]
+
+
+def generate_jobs(num_jobs, seed=None, submit_interval=0, priority_levels=1):
+    """
+    惰性生成随机任务
+
+    Args:
+        num_jobs: 任务数量
+        seed: 随机种子，相同种子生成相同的任务序列
+        submit_interval: 相邻任务的提交时间间隔，0表示全部在0时刻提交
+        priority_levels: 大于1时每个任务的优先级在 [0, priority_levels) 中均匀随机，
+            为1时全部为0且不消耗随机数，任务序列与不带优先级时相同
+    """
+    rng = random.Random(seed)
+    for index in range(num_jobs):
+        gpu_count, time = rng.choice(GPU_TIME_OPTIONS)
+        priority = rng.randrange(priority_levels) if priority_levels > 1 else 0
+        yield Job(gpu_count, time, index * submit_interval, job_id=index, priority=priority)
+
+
+def parse_job_id(job_id):
+    """CSV中的job_id总是字符串，JSONL中可能是数字或字符串，是整数时统一转成int"""
+    if isinstance(job_id, str):
+        try:
+            return int(job_id)
+        except ValueError:
+            return job_id
+    return job_id
+
+
+class TraceJobs:
+    """
+    从调度trace文件流式读取任务，每次迭代重新打开文件，内存中只保留当前一行
+
+    支持CSV（带表头）和JSONL，文件名以.gz结尾时按gzip读取。
+    每条记录需要 submit_time、gpu_count、duration 字段，job_id、priority 可选。
+    整数形式的job_id在两种格式中都读成int，与generate_jobs生成的任务一致。
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __iter__(self):
+        opener = gzip.open if self.path.endswith('.gz') else open
+        name = self.path[:-3] if self.path.endswith('.gz') else self.path
+        with opener(self.path, 'rt', newline='') as trace:
+            if name.endswith('.jsonl'):
+                records = (json.loads(line) for line in trace if line.strip())
+            else:
+                records = csv.DictReader(trace)
+            for index, record in enumerate(records):
+                yield Job(
+                    int(record['gpu_count']),
+                    int(record['duration']),
+                    int(record['submit_time']),
+                    job_id=parse_job_id(record.get('job_id', index)),
+                    priority=int(record.get('priority') or 0),
+                )
 
 
 class Jobs:
-    def __init__(self):
-        # 可选的GPU数量及其对应的时间
-        gpu_time_options = [
-            (512, 1),
-            (512, 1),
-            (512, 1),  # 512 GPU jobs take 1 time unit
-            (1024, 2),
-            (1024, 2),
-            (1024, 2),  # 1024 GPU jobs take 2 time units
-            (2048, 3),  # 2048 GPU jobs take 3 time units
-            (4096, 4),  # 4096 GPU jobs take 4 time units
-            (8192, 5),  # 8192 GPU jobs take 5 time units
-            (16384, 6),  # 16384 GPU jobs take 6 time units
-        ]
-        # 生成200个随机选择的任务
-        self.jobs = [
-            Job(gpu_count, time)
-            for gpu_count, time in [random.choice(gpu_time_options) for _ in range(200)]
-        ]
+    def __init__(self, seed=None, num_jobs=200):
+        # 生成num_jobs个随机选择的任务
+        self.jobs = list(generate_jobs(num_jobs, seed))
         self.current_index = 0
 
+    def __iter__(self):
+        return iter(self.jobs[self.current_index:])
+
     def get_next_job(self):
         """获取下一个任务，如果还有任务则返回任务对象，否则返回None"""
         if self.current_index < len(self.jobs):
@@ -55,6 +129,3 @@ class Jobs:
     def get_remaining_jobs_count(self):
         """获取剩余任务数量"""
         return len(self.jobs) - self.current_index
-
-    def get_jobs_by_time(self, i):
-        return [job for job in self.jobs if job.time == i]
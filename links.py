@@ -1,81 +1,695 @@
 import copy
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple, Union
 
+import numpy as np
 from bitarray import bitarray
 
+from groups import Groups
+from instrumentation import instrumentation
 from jobs import Job
 
+# one physical link: (src_group_id, src_switch_id, dst_group_id, dst_switch_id, ocs_id)
+LINK_DTYPE = np.dtype(
+    [
+        ("src_group", np.int16),
+        ("src_switch", np.int16),
+        ("dst_group", np.int16),
+        ("dst_switch", np.int16),
+        ("ocs", np.int16),
+    ]
+)
+
+
+# one end of a link: (group_id, switch_id, ocs_id)
+PORT_DTYPE = np.dtype(
+    [
+        ("group", np.int16),
+        ("switch", np.int16),
+        ("ocs", np.int16),
+    ]
+)
+
+
+def to_link_array(links) -> np.ndarray:
+    if isinstance(links, np.ndarray) and links.dtype == LINK_DTYPE:
+        return links
+    return np.array([tuple(link) for link in links], dtype=LINK_DTYPE)
+
+
+def to_port_array(ports) -> np.ndarray:
+    if isinstance(ports, np.ndarray) and ports.dtype == PORT_DTYPE:
+        return ports
+    return np.array([tuple(port) for port in ports], dtype=PORT_DTYPE)
+
+
+def link_ports(links: np.ndarray) -> np.ndarray:
+    # both ends of every link, all sources first
+    ports = np.empty(2 * len(links), dtype=PORT_DTYPE)
+    ports["group"] = np.concatenate((links["src_group"], links["dst_group"]))
+    ports["switch"] = np.concatenate((links["src_switch"], links["dst_switch"]))
+    ports["ocs"] = np.concatenate((links["ocs"], links["ocs"]))
+    return ports
+
+
+def link_masks(links: np.ndarray, num_switch_per_group: int, num_ocs: int):
+    return port_masks(link_ports(links), num_switch_per_group, num_ocs)
+
+
+def port_masks(ports: np.ndarray, num_switch_per_group: int, num_ocs: int):
+    # group the ports by switch: yields (group_id, switch_id, mask)
+    # with one bit set per port used on that switch
+    group_ids = ports["group"].astype(np.int64)
+    switch_ids = ports["switch"].astype(np.int64)
+    ocs_ids = ports["ocs"].astype(np.int64)
+    row_keys, row_index = np.unique(group_ids * num_switch_per_group + switch_ids, return_inverse=True)
+    bits = np.zeros((len(row_keys), num_ocs), dtype=np.uint8)
+    bits[row_index, ocs_ids] = 1
+    # a port can't be used twice by the same job
+    assert int(bits.sum()) == len(ocs_ids)
+    packed = np.packbits(bits, axis=1)
+    for row_key, row_bytes in zip(row_keys.tolist(), packed):
+        mask = bitarray(endian="big")
+        mask.frombytes(row_bytes.tobytes())
+        del mask[num_ocs:]
+        yield row_key // num_switch_per_group, row_key % num_switch_per_group, mask
+
+
+def get_port_ranges(num_switch_per_group: int, num_ocs: int, num_spine: int) -> List[bitarray]:
+    # idle masks of one fully idle group: switch i owns the ports of spine i % num_spine
+    ports_per_spine = num_ocs // num_spine
+    spines = []
+    for spine_id in range(num_spine):
+        spine = bitarray(num_ocs)
+        spine.setall(0)
+        spine[spine_id * ports_per_spine : (spine_id + 1) * ports_per_spine] = 1  # low index in left side
+        spines.append(spine)
+    return [spines[switch_id % num_spine] for switch_id in range(num_switch_per_group)]
+
+
+def find_idle_switch(transaction: "LinkTransaction", group_id: int, ocs_id: int) -> int:
+    # first switch of the group whose port on this ocs is idle in the transaction
+    for switch_id in range(transaction.num_switch_per_group):
+        if transaction.peek_row(group_id, switch_id)[ocs_id]:
+            return switch_id
+    raise ValueError(f"group {group_id} has no idle port on ocs {ocs_id}")
+
 
 class Links:
+    # bound on num_group x touched (group, ocs) cells in one counter update
+    MAX_COUNTER_CELLS = 1 << 22
     __num_ocs: int
     __num_switch_per_group: int
     __num_group: int
     # (num_group, num_switch_per_group, num_ocs)   (64, 16, 512)
     __idle_links: List[List[bitarray]]
-    # {job_id: [(src_group_id, src_switch_id, dst_group_id, dst_switch_id, ocs_id), ...]}
-    __links_for_job: Dict[Job, List[Tuple[int, int, int, int, int]]]
-
-    def __init__(self):
-        self.__num_ocs = 512
-        self.__num_switch_per_group = 16
-        self.__num_group = 64
-        self.__idle_links = []
+    # {job: LINK_DTYPE array of the job's links}, 10 bytes per link
+    __links_for_job: Dict[Job, np.ndarray]
+    # {job: PORT_DTYPE array}, ports of links whose other end is managed by
+    # another Links (a different pod), see claim_ports_for_job
+    __ports_for_job: Dict[Job, np.ndarray]
+    __switch_pair_index: "SwitchPairIndex"
+    # idle link counters, kept up to date by allocate/free
+    # (num_group, num_switch_per_group)
+    __num_idle_links_for_switch: np.ndarray
+    # (num_group,)
+    __num_idle_links_for_group: np.ndarray
+    # (num_group, num_spines)
+    __num_idle_links_for_spine: np.ndarray
+    # (num_group, num_ocs) idle ports of a group on each ocs
+    __num_idle_ports: np.ndarray
+    # (num_group, num_group) links currently allocatable between two groups
+    __num_allocatable_links: np.ndarray
+    __groups: Optional[Groups]
+    # notified of every port change, see set_change_listener
+    __change_listener: Optional[object]
+
+    def __init__(
+        self,
+        groups: Optional[Groups] = None,
+        num_group: int = 64,
+        num_switch_per_group: int = 16,
+        num_ocs: int = 512,
+        num_spine: int = 4,
+    ):
+        assert num_ocs % num_spine == 0
+        self.__num_ocs = num_ocs
+        self.__num_switch_per_group = num_switch_per_group
+        self.__num_group = num_group
+        self.__idle_links = [
+            [ports.copy() for ports in get_port_ranges(num_switch_per_group, num_ocs, num_spine)]
+            for _ in range(self.__num_group)
+        ]
         self.__links_for_job = {}
+        self.__ports_for_job = {}
+        self.__switch_pair_index = SwitchPairIndex(self.__idle_links)
+        self.__init_counters()
+        self.__groups = groups
+        self.__change_listener = None
+        if groups is not None:
+            for group_id in range(self.__num_group):
+                groups.update_available_links(
+                    group_id,
+                    int(self.__num_idle_links_for_group[group_id])
+                    - groups.get_group(group_id)["available_links"],
+                )
 
-        spine_0 = bitarray(512)
-        spine_0[:128] = 1  # low index in left side
-        spine_1 = bitarray(512)
-        spine_1[128:256] = 1  # low index in left side
-        spine_2 = bitarray(512)
-        spine_2[256:384] = 1  # low index in left side
-        spine_3 = bitarray(512)
-        spine_3[384:512] = 1  # low index in left side
-        for _ in range(self.__num_group):
-            group_idle_links = []
-            for switch_id in range(self.__num_switch_per_group):
-                if switch_id % 4 == 0:
-                    group_idle_links.append(spine_0.copy())
-                elif switch_id % 4 == 1:
-                    group_idle_links.append(spine_1.copy())
-                elif switch_id % 4 == 2:
-                    group_idle_links.append(spine_2.copy())
-                else:
-                    group_idle_links.append(spine_3.copy())
-            self.__idle_links.append(group_idle_links)
+    @classmethod
+    def from_buffers(
+        cls,
+        idle_links_buffer: memoryview,
+        counters: Dict[str, np.ndarray],
+        links_for_job: Dict[Job, np.ndarray],
+        groups: Optional[Groups] = None,
+        ports_for_job: Optional[Dict[Job, np.ndarray]] = None,
+    ) -> "Links":
+        # start from saved state without a replay: every idle row is a bitarray
+        # over its slice of idle_links_buffer (num_ocs / 8 bytes per row, rows in
+        # group-major order) and the arrays in counters (see get_counters) are
+        # used as they are. Nothing is copied, so the buffer and the arrays must
+        # be writable and are updated in place. groups must already hold the
+        # matching available_links. ports_for_job restores the single-port
+        # claims of claim_ports_for_job, already marked busy in the buffer.
+        num_group, num_switch_per_group = counters["num_idle_links_for_switch"].shape
+        num_ocs = counters["num_idle_ports"].shape[1]
+        num_spine = counters["num_idle_links_for_spine"].shape[1]
+        assert num_ocs % 8 == 0 and len(idle_links_buffer) == num_group * num_switch_per_group * num_ocs // 8
+        row_bytes = num_ocs // 8
+        links = cls.__new__(cls)
+        links.__num_ocs = num_ocs
+        links.__num_switch_per_group = num_switch_per_group
+        links.__num_group = num_group
+        links.__idle_links = [
+            [
+                bitarray(buffer=idle_links_buffer[offset : offset + row_bytes], endian="big")
+                for offset in range(
+                    group_id * num_switch_per_group * row_bytes,
+                    (group_id + 1) * num_switch_per_group * row_bytes,
+                    row_bytes,
+                )
+            ]
+            for group_id in range(num_group)
+        ]
+        links.__links_for_job = links_for_job
+        links.__ports_for_job = ports_for_job if ports_for_job is not None else {}
+        # every group has the same port ranges
+        links.__switch_pair_index = SwitchPairIndex(
+            [get_port_ranges(num_switch_per_group, num_ocs, num_spine)] * num_group
+        )
+        links.__num_idle_links_for_switch = counters["num_idle_links_for_switch"]
+        links.__num_idle_links_for_group = counters["num_idle_links_for_group"]
+        links.__num_idle_links_for_spine = counters["num_idle_links_for_spine"]
+        links.__num_idle_ports = counters["num_idle_ports"]
+        links.__num_allocatable_links = counters["num_allocatable_links"]
+        links.__groups = groups
+        links.__change_listener = None
+        return links
+
+    def __init_counters(self):
+        self.__num_idle_links_for_switch = np.array(
+            [
+                [switch_idle_links.count(1) for switch_idle_links in group_idle_links]
+                for group_idle_links in self.__idle_links
+            ],
+            dtype=np.int64,
+        )
+        self.__num_idle_links_for_group = self.__num_idle_links_for_switch.sum(axis=1)
+        spine_ids = np.array(self.__switch_pair_index.spine_ids)
+        self.__num_idle_links_for_spine = np.zeros(
+            (self.__num_group, self.__switch_pair_index.num_spines), dtype=np.int64
+        )
+        for group_id in range(self.__num_group):
+            np.add.at(
+                self.__num_idle_links_for_spine[group_id],
+                spine_ids[group_id],
+                self.__num_idle_links_for_switch[group_id],
+            )
+        self.__num_idle_ports = np.array(
+            [
+                sum(
+                    np.frombuffer(switch_idle_links.unpack(), dtype=np.uint8).astype(np.int64)
+                    for switch_idle_links in group_idle_links
+                )
+                for group_idle_links in self.__idle_links
+            ]
+        )
+        self.__num_allocatable_links = np.array(
+            [
+                np.minimum(group_idle_ports, self.__num_idle_ports).sum(axis=1)
+                for group_idle_ports in self.__num_idle_ports
+            ]
+        )
+        np.fill_diagonal(self.__num_allocatable_links, 0)
+
+    def __update_counters(self, links: np.ndarray, delta: int):
+        self.__update_port_counters(link_ports(links), delta)
+
+    def __update_port_counters(self, ports: np.ndarray, delta: int):
+        if len(ports) == 0:
+            return
+        group_ids = ports["group"].astype(np.int64)
+        switch_ids = ports["switch"].astype(np.int64)
+        ocs_ids = ports["ocs"].astype(np.int64)
+        spine_ids = np.array(self.__switch_pair_index.spine_ids)[group_ids, switch_ids]
+        np.add.at(self.__num_idle_links_for_switch, (group_ids, switch_ids), delta)
+        np.add.at(self.__num_idle_links_for_spine, (group_ids, spine_ids), delta)
+        group_deltas = np.bincount(group_ids, minlength=self.__num_group) * delta
+        self.__num_idle_links_for_group += group_deltas
+        # allocatable links of a pair only change through the (group, ocs)
+        # cells whose idle ports changed, so the work is cells x num_group
+        cell_keys = np.unique(group_ids * self.__num_ocs + ocs_ids)
+        cell_groups = cell_keys // self.__num_ocs
+        touched_ocs, cell_columns = np.unique(cell_keys % self.__num_ocs, return_inverse=True)
+        old_idle_ports = self.__num_idle_ports[:, touched_ocs]
+        np.add.at(self.__num_idle_ports, (group_ids, ocs_ids), delta)
+        new_idle_ports = self.__num_idle_ports[:, touched_ocs]
+        touched = np.zeros(old_idle_ports.shape, dtype=bool)
+        touched[cell_groups, cell_columns] = True
+        # (num_group, cells) temporaries, a bounded number of cells at a time
+        chunk = max(1, self.MAX_COUNTER_CELLS // self.__num_group)
+        for start in range(0, len(cell_keys), chunk):
+            groups = cell_groups[start:start + chunk]
+            columns = cell_columns[start:start + chunk]
+            pair_deltas = np.minimum(
+                new_idle_ports[:, columns], new_idle_ports[groups, columns]
+            ) - np.minimum(old_idle_ports[:, columns], old_idle_ports[groups, columns])
+            # cells are sorted by group: sum the cells of each group
+            chunk_groups, group_starts = np.unique(groups, return_index=True)
+            self.__num_allocatable_links[chunk_groups, :] += np.add.reduceat(pair_deltas, group_starts, axis=1).T
+            # a pair with both cells touched is already counted by the row of
+            # each cell, only add the other pairs to the columns
+            pair_deltas[touched[:, columns]] = 0
+            self.__num_allocatable_links[:, chunk_groups] += np.add.reduceat(pair_deltas, group_starts, axis=1)
+        touched_groups = np.unique(cell_groups)
+        self.__num_allocatable_links[touched_groups, touched_groups] = 0
+        if self.__groups is not None:
+            for group_id in np.flatnonzero(group_deltas).tolist():
+                self.__groups.update_available_links(group_id, int(group_deltas[group_id]))
 
     def get_num_idle_links(self) -> List[int]:
-        return [
-            sum(switch_idle_links.count(1) for switch_idle_links in group_idle_links)
-            for group_idle_links in self.__idle_links
-        ]
+        return self.__num_idle_links_for_group.tolist()
 
     def get_num_idle_links_fo_group(self, group_id) -> int:
-        group_idle_links = self.__idle_links[group_id]
-        return sum(
-            [switch_idle_links.count(1) for switch_idle_links in group_idle_links]
-        )
+        return int(self.__num_idle_links_for_group[group_id])
+
+    def get_num_idle_links_for_switch(self, group_id, switch_id) -> int:
+        return int(self.__num_idle_links_for_switch[group_id, switch_id])
 
+    def get_num_idle_links_for_spine(self, group_id, spine_id) -> int:
+        return int(self.__num_idle_links_for_spine[group_id, spine_id])
+
+    def get_num_allocatable_links(self, group_id_1, group_id_2) -> int:
+        # most links a single group pair could get right now
+        return int(self.__num_allocatable_links[group_id_1, group_id_2])
+
+    @instrumentation.timed("Links.allocate_link_for_job")
     def allocate_link_for_job(self, job, links: List[Tuple[int, int, int, int, int]]):
-        for src_group_id, src_switch_id, dst_group_id, dst_switch_id, ocs_id in links:
-            assert self.__idle_links[src_group_id][src_switch_id][ocs_id] == 1
-            assert self.__idle_links[dst_group_id][dst_switch_id][ocs_id] == 1
-            self.__idle_links[src_group_id][src_switch_id][ocs_id] = 0
-            self.__idle_links[dst_group_id][dst_switch_id][ocs_id] = 0
+        links = to_link_array(links)
+        self.__claim_links(links)
         self.__links_for_job[job] = links
         return False
 
+    def add_links_for_job(self, job, links: List[Tuple[int, int, int, int, int]]):
+        # more links for a job that is already running, kept with its other links
+        links = to_link_array(links)
+        self.__claim_links(links)
+        self.__links_for_job[job] = np.concatenate((self.__links_for_job[job], links))
+
+    def __claim_links(self, links: np.ndarray):
+        self.__claim_ports(link_ports(links))
+        if self.__change_listener is not None:
+            self.__change_listener.on_connect(links)
+
+    def __claim_ports(self, ports: np.ndarray):
+        # the one place ports are taken, for whole links and single ports
+        # alike. All ports are checked before any is taken.
+        masks = list(port_masks(ports, self.__num_switch_per_group, self.__num_ocs))
+        for group_id, switch_id, mask in masks:
+            if self.__idle_links[group_id][switch_id] & mask != mask:
+                raise ValueError(f"ports of switch {switch_id} in group {group_id} are not idle")
+        for group_id, switch_id, mask in masks:
+            self.__idle_links[group_id][switch_id] &= ~mask
+        self.__update_port_counters(ports, -1)
+
+    def __free_ports(self, ports: np.ndarray):
+        # one OR per switch touched instead of one write per port
+        for group_id, switch_id, mask in port_masks(ports, self.__num_switch_per_group, self.__num_ocs):
+            idle_links = self.__idle_links[group_id][switch_id]
+            assert not (idle_links & mask).any()
+            idle_links |= mask
+        self.__update_port_counters(ports, 1)
+
+    @instrumentation.timed("Links.free_link_for_job")
     def free_link_for_job(self, job):
-        links = self.__links_for_job[job]
-        for src_group_id, src_switch_id, dst_group_id, dst_switch_id, ocs_id in links:
-            assert self.__idle_links[src_group_id][src_switch_id][ocs_id] == 0
-            assert self.__idle_links[dst_group_id][dst_switch_id][ocs_id] == 0
-            self.__idle_links[src_group_id][src_switch_id][ocs_id] = 1
-            self.__idle_links[dst_group_id][dst_switch_id][ocs_id] = 1
-        del self.__links_for_job[job]
+        links = self.__links_for_job.pop(job)
+        self.__free_ports(link_ports(links))
+        if self.__change_listener is not None:
+            self.__change_listener.on_disconnect(links)
+
+    def claim_ports_for_job(self, job, ports: List[Tuple[int, int, int]]):
+        # take single ports for a job whose links leave this Links: the other
+        # end of each link lives in another pod's state
+        ports = to_port_array(ports)
+        self.__claim_ports(ports)
+        self.__ports_for_job[job] = ports
+        if self.__change_listener is not None:
+            self.__change_listener.on_claim_ports(ports)
+
+    def free_ports_for_job(self, job):
+        ports = self.__ports_for_job.pop(job)
+        self.__free_ports(ports)
+        if self.__change_listener is not None:
+            self.__change_listener.on_free_ports(ports)
+
+    def get_ports_for_job(self, job) -> np.ndarray:
+        return self.__ports_for_job[job]
+
+    def get_ports_for_jobs(self) -> Dict[Job, np.ndarray]:
+        return dict(self.__ports_for_job)
+
+    def set_change_listener(self, listener):
+        # listener.on_connect(links) / on_disconnect(links) get the LINK_DTYPE
+        # links after every committed claim, free or move, and
+        # listener.on_claim_ports(ports) / on_free_ports(ports) the PORT_DTYPE
+        # ports of claim_ports_for_job / free_ports_for_job; None to stop
+        self.__change_listener = listener
+
+    def get_links_for_job(self, job) -> np.ndarray:
+        return self.__links_for_job[job]
+
+    def get_links_for_jobs(self) -> Dict[Job, np.ndarray]:
+        return dict(self.__links_for_job)
+
+    def get_num_idle_ports(self) -> np.ndarray:
+        # (num_group, num_ocs) copy
+        return self.__num_idle_ports.copy()
+
+    def get_num_idle_ports_for_group(self, group_id) -> np.ndarray:
+        # (num_ocs,) copy
+        return self.__num_idle_ports[group_id].copy()
+
+    def move_links_for_job(self, moves: Dict[Job, List[Tuple[int, Tuple[int, int, int, int, int]]]]):
+        # reconfigure links of running jobs: {job: [(index in the job's links, new link), ...]}
+        # the whole batch is checked first, so either every move happens or none
+        old_links = []
+        new_links = []
+        for job, job_moves in moves.items():
+            job_links = self.__links_for_job[job]
+            for link_index, new_link in job_moves:
+                old_links.append(tuple(job_links[link_index]))
+                new_links.append(tuple(new_link))
+        old_links = to_link_array(old_links)
+        new_links = to_link_array(new_links)
+        old_masks = {
+            (group_id, switch_id): mask
+            for group_id, switch_id, mask in link_masks(old_links, self.__num_switch_per_group, self.__num_ocs)
+        }
+        new_masks = {
+            (group_id, switch_id): mask
+            for group_id, switch_id, mask in link_masks(new_links, self.__num_switch_per_group, self.__num_ocs)
+        }
+        for (group_id, switch_id), mask in old_masks.items():
+            assert not (self.__idle_links[group_id][switch_id] & mask).any()
+        for (group_id, switch_id), mask in new_masks.items():
+            idle_links = self.__idle_links[group_id][switch_id]
+            if (group_id, switch_id) in old_masks:
+                idle_links = idle_links | old_masks[(group_id, switch_id)]
+            if idle_links & mask != mask:
+                raise ValueError(f"ports of switch {switch_id} in group {group_id} are not idle")
+        for (group_id, switch_id), mask in old_masks.items():
+            self.__idle_links[group_id][switch_id] |= mask
+        for (group_id, switch_id), mask in new_masks.items():
+            self.__idle_links[group_id][switch_id] &= ~mask
+        for job, job_moves in moves.items():
+            job_links = self.__links_for_job[job]
+            for link_index, new_link in job_moves:
+                job_links[link_index] = tuple(new_link)
+        self.__update_counters(old_links, 1)
+        self.__update_counters(new_links, -1)
+        if self.__change_listener is not None:
+            self.__change_listener.on_disconnect(old_links)
+            self.__change_listener.on_connect(new_links)
 
+    def get_counters(self) -> Dict[str, np.ndarray]:
+        # the live counter arrays by name, not copies: for saving state only
+        return {
+            "num_idle_links_for_switch": self.__num_idle_links_for_switch,
+            "num_idle_links_for_group": self.__num_idle_links_for_group,
+            "num_idle_links_for_spine": self.__num_idle_links_for_spine,
+            "num_idle_ports": self.__num_idle_ports,
+            "num_allocatable_links": self.__num_allocatable_links,
+        }
+
+    def get_idle_links_bytes(self) -> bytes:
+        # all idle rows packed big-endian, num_ocs / 8 bytes per row, group-major
+        assert self.__num_ocs % 8 == 0
+        return b"".join(row.tobytes() for group_idle_links in self.__idle_links for row in group_idle_links)
+
+    @instrumentation.timed("Links.get_temp_idle_links")
     def get_temp_idle_links(self) -> List[List[bitarray]]:
         return copy.deepcopy(self.__idle_links)
 
+    @instrumentation.timed("Links.begin")
+    def begin(self) -> "LinkTransaction":
+        return LinkTransaction(self.__idle_links, self)
+
+    def get_packed_idle_links(self) -> "PackedIdleLinks":
+        return PackedIdleLinks.from_idle_links(self.__idle_links)
+
+    def get_switch_pair_index(self) -> "SwitchPairIndex":
+        return self.__switch_pair_index
+
+
+class SwitchPairIndex:
+    # Switches are grouped into spines by the OCS ports they own; two switches
+    # can only ever be linked if their spines share a port. Built from the
+    # idle-link masks of a fully idle fabric, so it does not assume any
+    # particular switch -> spine rule.
+    # spine_id -> ports owned by the spine
+    spine_ports: List[bitarray]
+    # [group_id][switch_id] -> spine_id
+    spine_ids: List[List[int]]
+
+    def __init__(self, port_ranges):
+        self.spine_ports = []
+        self.spine_ids = []
+        spine_by_ports = {}
+        for group_port_ranges in port_ranges:
+            group_spine_ids = []
+            for switch_id in range(len(group_port_ranges)):
+                ports = group_port_ranges[switch_id]
+                key = ports.tobytes()
+                if key not in spine_by_ports:
+                    spine_by_ports[key] = len(self.spine_ports)
+                    self.spine_ports.append(ports.copy())
+                group_spine_ids.append(spine_by_ports[key])
+            self.spine_ids.append(group_spine_ids)
+        self.__spine_overlap = [
+            [(ports_1 & ports_2).any() for ports_2 in self.spine_ports]
+            for ports_1 in self.spine_ports
+        ]
+        # {(src spine ids, dst spine ids): (compatible matrix, num compatible pairs)}
+        self.__cache = {}
+
+    @property
+    def num_spines(self) -> int:
+        return len(self.spine_ports)
+
+    def get_compatible_switch_pairs(self, src_group_id, dst_group_id) -> Tuple[List[List[bool]], int]:
+        src_spine_ids = tuple(self.spine_ids[src_group_id])
+        dst_spine_ids = tuple(self.spine_ids[dst_group_id])
+        key = (src_spine_ids, dst_spine_ids)
+        if key not in self.__cache:
+            compatible = [
+                [self.__spine_overlap[src_spine][dst_spine] for dst_spine in dst_spine_ids]
+                for src_spine in src_spine_ids
+            ]
+            self.__cache[key] = (compatible, sum(map(sum, compatible)))
+        return self.__cache[key]
+
+
+def pack_idle_links(rows: List[bitarray]) -> np.ndarray:
+    # bit ocs_id of a row lives in word ocs_id // 64, mask 1 << (63 - ocs_id % 64)
+    num_words = (len(rows[0]) + 63) // 64
+    buffer = b"".join(row.tobytes().ljust(num_words * 8, b"\0") for row in rows)
+    return np.frombuffer(buffer, dtype=">u8").astype(np.uint64).reshape(len(rows), num_words)
+
+
+class PackedIdleLinks:
+    # (num_group, num_switch_per_group, num_ocs / 64) uint64 words
+    idle_words: np.ndarray
+    num_ocs: int
+
+    def __init__(self, idle_words: np.ndarray, num_ocs: int):
+        self.idle_words = idle_words
+        self.num_ocs = num_ocs
+
+    @classmethod
+    def from_idle_links(cls, idle_links) -> "PackedIdleLinks":
+        num_switch_per_group = len(idle_links[0])
+        rows = [
+            idle_links[group_id][switch_id]
+            for group_id in range(len(idle_links))
+            for switch_id in range(num_switch_per_group)
+        ]
+        idle_words = pack_idle_links(rows)
+        return cls(
+            idle_words.reshape(len(idle_links), num_switch_per_group, -1),
+            len(rows[0]),
+        )
+
+    def __len__(self) -> int:
+        return self.idle_words.shape[0]
+
+    def to_idle_links(self) -> List[List[bitarray]]:
+        idle_links = []
+        for group_words in self.idle_words:
+            group_idle_links = []
+            for switch_words in group_words:
+                switch_idle_links = bitarray(endian="big")
+                switch_idle_links.frombytes(switch_words.astype(">u8").tobytes())
+                group_idle_links.append(switch_idle_links[: self.num_ocs])
+            idle_links.append(group_idle_links)
+        return idle_links
+
+
+class _GroupView:
+    # switch rows of one group as seen by a transaction, None until first
+    # written. Reads return the shared row; writers must go through
+    # LinkTransaction.get_row (or get_writable_row) to get a private copy.
+    rows: List[Optional[bitarray]]
+
+    def __init__(self, transaction: "LinkTransaction", group_id: int):
+        self.__transaction = transaction
+        self.__group_id = group_id
+        self.rows = [None] * transaction.num_switch_per_group
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __getitem__(self, switch_id: int) -> bitarray:
+        row = self.rows[switch_id]
+        if row is None:
+            return self.__transaction.peek_row(self.__group_id, switch_id)
+        return row
+
+    def own(self, switch_id: int) -> bitarray:
+        row = self.rows[switch_id]
+        if row is None:
+            row = self.__transaction.peek_row(self.__group_id, switch_id).copy()
+            self.rows[switch_id] = row
+        return row
+
+    def __iter__(self):
+        for switch_id in range(len(self)):
+            yield self[switch_id]
+
+
+class LinkTransaction:
+    # Looks like List[List[bitarray]] to the allocators, but a switch row is
+    # only copied the first time it is written (through get_row), instead of
+    # deep-copying every row up front; indexing only reads the shared row.
+    # Committed operations are journaled and replayed through Links (or
+    # merged into the parent transaction when nested).
+    __base: "Union[List[List[bitarray]], LinkTransaction]"
+    __links: "Optional[Links]"
+    # [group_id] -> view holding the private copies of touched rows
+    __groups: List[Optional[_GroupView]]
+    # [(job, [(src_group_id, src_switch_id, dst_group_id, dst_switch_id, ocs_id), ...]), ...]
+    __journal: List[Tuple[Job, List[Tuple[int, int, int, int, int]]]]
+
+    def __init__(self, base, links: "Optional[Links]" = None):
+        self.__base = base
+        self.__links = links
+        self.__groups = [None] * len(base)
+        self.__journal = []
+        self.num_switch_per_group = len(base[0])
+        self.closed = False
+
+    def __len__(self) -> int:
+        return len(self.__groups)
+
+    def __getitem__(self, group_id: int) -> _GroupView:
+        group_view = self.__groups[group_id]
+        if group_view is None:
+            assert not self.closed
+            group_view = _GroupView(self, group_id)
+            self.__groups[group_id] = group_view
+        return group_view
+
+    def __iter__(self):
+        for group_id in range(len(self)):
+            yield self[group_id]
+
+    def peek_row(self, group_id: int, switch_id: int) -> bitarray:
+        # read-only access, never copies
+        group_view = self.__groups[group_id]
+        if group_view is not None and group_view.rows[switch_id] is not None:
+            return group_view.rows[switch_id]
+        if isinstance(self.__base, LinkTransaction):
+            return self.__base.peek_row(group_id, switch_id)
+        return self.__base[group_id][switch_id]
+
+    def get_row(self, group_id: int, switch_id: int) -> bitarray:
+        # writable row, copied into this transaction on first use
+        return self[group_id].own(switch_id)
+
+    def num_touched_rows(self) -> int:
+        return sum(
+            row is not None
+            for group_view in self.__groups
+            if group_view is not None
+            for row in group_view.rows
+        )
+
+    def begin(self) -> "LinkTransaction":
+        return LinkTransaction(self)
+
+    def allocate_link_for_job(self, job, links: List[Tuple[int, int, int, int, int]]):
+        # tentative allocation of links that are still idle in this view
+        for src_group_id, src_switch_id, dst_group_id, dst_switch_id, ocs_id in links:
+            src_links = self.get_row(src_group_id, src_switch_id)
+            dst_links = self.get_row(dst_group_id, dst_switch_id)
+            assert src_links[ocs_id] == 1
+            assert dst_links[ocs_id] == 1
+            src_links[ocs_id] = 0
+            dst_links[ocs_id] = 0
+        self.__journal.append((job, links))
+
+    def commit(self, job=None, used_links: Optional[List[Tuple[int, int, int, int, int]]] = None):
+        # used_links: links an allocator already claimed through this view
+        assert not self.closed
+        if job is not None:
+            self.__journal.append((job, used_links))
+        if isinstance(self.__base, LinkTransaction):
+            self.__base._merge(self.__groups, self.__journal)
+        else:
+            for journal_job, links in self.__journal:
+                self.__links.allocate_link_for_job(journal_job, links)
+        self.closed = True
+
+    def rollback(self):
+        self.__groups = [None] * len(self.__groups)
+        self.__journal = []
+        self.closed = True
+
+    def _merge(self, groups, journal):
+        for group_id, group_view in enumerate(groups):
+            if group_view is None:
+                continue
+            rows = self[group_id].rows
+            for switch_id, row in enumerate(group_view.rows):
+                if row is not None:
+                    rows[switch_id] = row
+        self.__journal.extend(journal)
+
+
+def get_writable_row(idle_links, group_id: int, switch_id: int) -> bitarray:
+    # rows read from a transaction are shared with Links; plain
+    # List[List[bitarray]] snapshots are already private copies
+    if isinstance(idle_links, LinkTransaction):
+        return idle_links.get_row(group_id, switch_id)
+    return idle_links[group_id][switch_id]
+
 
 if __name__ == "__main__":
     links = Links()
@@ -85,3 +699,8 @@ if __name__ == "__main__":
     print(links.get_num_idle_links())
     links.free_link_for_job(1)
     print(links.get_num_idle_links())
+    transaction = links.begin()
+    transaction.allocate_link_for_job(2, [(0, 0, 1, 0, 0)])
+    print(links.get_num_idle_links_fo_group(0), transaction.num_touched_rows())
+    transaction.commit()
+    print(links.get_num_idle_links_fo_group(0))
@@ -1,12 +1,22 @@
 from enum import IntEnum
-from typing import List, Tuple
+from functools import partial
+from itertools import repeat
+from typing import List, Optional, Tuple
 
+import numpy as np
 from bitarray import bitarray
+from bitarray.util import count_n
+
+from instrumentation import instrumentation
+from links import PackedIdleLinks, SwitchPairIndex, get_writable_row, pack_idle_links
 
 
 class PhysicalLinkeAllocatingAlthrighm(IntEnum):
     NATIVE = 0
     OPTIMIZE = 1
+    NUMPY = 2
+    BULK = 3
+    MATCHING = 4
 
 
 class AllocationResult(IntEnum):
@@ -20,28 +30,109 @@ def physical_link_allocate(
     link_demand: List[Tuple[int, int, int, int]],
     used_links: List[Tuple[int, int, int, int, int]],
     alghrithm: PhysicalLinkeAllocatingAlthrighm,
+    switch_pair_index: Optional[SwitchPairIndex] = None,
 ) -> AllocationResult:
+    num_used_links = len(used_links)
     if alghrithm == PhysicalLinkeAllocatingAlthrighm.NATIVE:
-        return physical_link_allocate_native(temp_idle_links, link_demand, used_links)
+        result = physical_link_allocate_native(temp_idle_links, link_demand, used_links)
     elif alghrithm == PhysicalLinkeAllocatingAlthrighm.OPTIMIZE:
-        return physical_link_allocate_optimize(temp_idle_links, link_demand, used_links)
+        result = physical_link_allocate_optimize(
+            temp_idle_links, link_demand, used_links, switch_pair_index
+        )
+    elif alghrithm == PhysicalLinkeAllocatingAlthrighm.NUMPY:
+        result = physical_link_allocate_numpy(temp_idle_links, link_demand, used_links)
+    elif alghrithm == PhysicalLinkeAllocatingAlthrighm.BULK:
+        result = physical_link_allocate_bulk(
+            temp_idle_links, link_demand, used_links, switch_pair_index
+        )
+    elif alghrithm == PhysicalLinkeAllocatingAlthrighm.MATCHING:
+        result = physical_link_allocate_matching(
+            temp_idle_links, link_demand, used_links, switch_pair_index
+        )
     else:
         raise ValueError("Invalid algorithm selected")
+    if instrumentation.enabled:
+        # the min pass and the max pass both claim links, see allocate_min_then_max
+        instrumentation.count(
+            "links_requested." + alghrithm.name,
+            sum(min_demand + max_demand for _, _, min_demand, max_demand in link_demand),
+        )
+        if result != AllocationResult.FAILURE:
+            instrumentation.count("links_granted." + alghrithm.name, len(used_links) - num_used_links)
+        instrumentation.count("result." + alghrithm.name + "." + result.name)
+    return result
 
 
+@instrumentation.timed("physical_link_allocate.OPTIMIZE")
 def physical_link_allocate_optimize(
     temp_idle_links: List[List[bitarray]],
     link_demand: List[Tuple[int, int, int, int]],
     used_links: List[Tuple[int, int, int, int, int]],
+    switch_pair_index: Optional[SwitchPairIndex] = None,
+) -> AllocationResult:
+    return allocate_min_then_max(
+        temp_idle_links,
+        link_demand,
+        used_links,
+        partial(allocate_for_two_groups_optimize, switch_pair_index=switch_pair_index),
+    )
+
+
+@instrumentation.timed("physical_link_allocate.NUMPY")
+def physical_link_allocate_numpy(
+    temp_idle_links: "List[List[bitarray]] | PackedIdleLinks",
+    link_demand: List[Tuple[int, int, int, int]],
+    used_links: List[Tuple[int, int, int, int, int]],
+) -> AllocationResult:
+    # The rows of every group in the demand are packed once and shared by
+    # all group pairs; bitarray rows get the result written back at the end.
+    if isinstance(temp_idle_links, PackedIdleLinks):
+        return allocate_min_then_max(
+            temp_idle_links.idle_words, link_demand, used_links, allocate_for_two_groups_numpy
+        )
+    group_ids = sorted({group_id for pair in link_demand for group_id in pair[:2]})
+    old_words = {
+        group_id: pack_idle_links(list(temp_idle_links[group_id])) for group_id in group_ids
+    }
+    idle_words = {group_id: words.copy() for group_id, words in old_words.items()}
+    result = allocate_min_then_max(
+        idle_words, link_demand, used_links, allocate_for_two_groups_numpy
+    )
+    for group_id in group_ids:
+        words = idle_words[group_id]
+        for switch_id in np.flatnonzero((words != old_words[group_id]).any(axis=1)).tolist():
+            row = get_writable_row(temp_idle_links, group_id, switch_id)
+            idle_row = bitarray(endian="big")
+            idle_row.frombytes(words[switch_id].astype(">u8").tobytes())
+            row[:] = idle_row[: len(row)]
+    return result
+
+
+@instrumentation.timed("physical_link_allocate.BULK")
+def physical_link_allocate_bulk(
+    temp_idle_links: List[List[bitarray]],
+    link_demand: List[Tuple[int, int, int, int]],
+    used_links: List[Tuple[int, int, int, int, int]],
+    switch_pair_index: Optional[SwitchPairIndex] = None,
+) -> AllocationResult:
+    return allocate_min_then_max(
+        temp_idle_links,
+        link_demand,
+        used_links,
+        partial(allocate_for_two_groups_bulk, switch_pair_index=switch_pair_index),
+    )
+
+
+def allocate_min_then_max(
+    temp_idle_links, link_demand, used_links, allocate_for_two_groups
 ) -> AllocationResult:
     result = AllocationResult.MEETMAX
-    used_links = []
     for i in range(2):
         for group_id_1, group_id_2, min_demand, max_demand in link_demand:
             demand = min_demand if i == 0 else max_demand
             if demand == 0:
                 continue
-            if not allocate_for_two_groups_optimize(
+            if not allocate_for_two_groups(
                 (group_id_1, group_id_2), demand, temp_idle_links, used_links
             ):
                 if i == 0:
@@ -52,15 +143,25 @@ def physical_link_allocate_optimize(
 
 
 def allocate_for_two_groups_optimize(
-    group_id_pair, num_link, temp_idle_links, used_links
+    group_id_pair, num_link, temp_idle_links, used_links, switch_pair_index=None
 ):
     num_switch_per_group = len(temp_idle_links[group_id_pair[0]])
+    # Incompatible switch pairs are still stepped over (and marked dead) where
+    # the walk meets them, so the picks do not change, but they never cost an AND.
+    compatible = None
+    if switch_pair_index is not None:
+        compatible, num_enable_pairs = switch_pair_index.get_compatible_switch_pairs(
+            group_id_pair[0], group_id_pair[1]
+        )
+        if num_enable_pairs == 0:
+            return num_link <= 0
     src_index = 0
     dst_index = 0
     src_to_dst = [
         [True for _ in range(num_switch_per_group)] for _ in range(num_switch_per_group)
     ]
     links = 0
+    num_probes = 0
     while links < num_link:
         # find a enable link
         while True:
@@ -77,8 +178,14 @@ def allocate_for_two_groups_optimize(
             else:
                 # if not self.CheckNoLink(temp_idle_links, group_id_pair):
                 #     raise Exception("still have link")
+                if instrumentation.enabled:
+                    instrumentation.count("switch_pairs_probed.OPTIMIZE", num_probes)
                 return False
 
+            if compatible is not None and not compatible[src_index][dst_index]:
+                src_to_dst[src_index][dst_index] = False
+                continue
+            num_probes += 1
             enable_links = (
                 temp_idle_links[group_id_pair[0]][src_index]
                 & temp_idle_links[group_id_pair[1]][dst_index]
@@ -88,11 +195,18 @@ def allocate_for_two_groups_optimize(
                 break
             except ValueError:
                 src_to_dst[src_index][dst_index] = False
+                if compatible is not None:
+                    num_enable_pairs -= 1
+                    if num_enable_pairs == 0:
+                        # every compatible switch pair is exhausted
+                        if instrumentation.enabled:
+                            instrumentation.count("switch_pairs_probed.OPTIMIZE", num_probes)
+                        return False
                 continue
 
         # allocate link
-        temp_idle_links[group_id_pair[0]][src_index][first_enable_link] = 0
-        temp_idle_links[group_id_pair[1]][dst_index][first_enable_link] = 0
+        get_writable_row(temp_idle_links, group_id_pair[0], src_index)[first_enable_link] = 0
+        get_writable_row(temp_idle_links, group_id_pair[1], dst_index)[first_enable_link] = 0
         used_links.append(
             (
                 group_id_pair[0],
@@ -105,6 +219,169 @@ def allocate_for_two_groups_optimize(
         src_index = (src_index + 1) % num_switch_per_group
         dst_index = (dst_index + 1) % num_switch_per_group
         links += 1
+    if instrumentation.enabled:
+        instrumentation.count("switch_pairs_probed.OPTIMIZE", num_probes)
+    return True
+
+
+def allocate_for_two_groups_bulk(
+    group_id_pair, num_link, temp_idle_links, used_links, switch_pair_index=None
+):
+    # Claims the whole demand of a group pair with a few mask operations per
+    # switch pair: every round splits what is left evenly over the live switch
+    # pairs (the first ones in order take the remainder, one link each),
+    # visiting pairs diagonal by diagonal ((0, 0), (1, 1), ..., then (0, 1),
+    # (1, 2), ...) so every switch carries the same number of links give or
+    # take one, like the OPTIMIZE round robin.
+    num_switch_per_group = len(temp_idle_links[group_id_pair[0]])
+    src_rows = [temp_idle_links[group_id_pair[0]][i] for i in range(num_switch_per_group)]
+    dst_rows = [temp_idle_links[group_id_pair[1]][i] for i in range(num_switch_per_group)]
+    compatible = None
+    if switch_pair_index is not None:
+        compatible, _ = switch_pair_index.get_compatible_switch_pairs(
+            group_id_pair[0], group_id_pair[1]
+        )
+    switch_pairs = [
+        (src_index, (src_index + offset) % num_switch_per_group)
+        for offset in range(num_switch_per_group)
+        for src_index in range(num_switch_per_group)
+        if compatible is None
+        or compatible[src_index][(src_index + offset) % num_switch_per_group]
+    ]
+    links = 0
+    num_probes = 0
+    while links < num_link and switch_pairs:
+        share, num_extra = divmod(num_link - links, len(switch_pairs))
+        next_switch_pairs = []
+        for position, (src_index, dst_index) in enumerate(switch_pairs):
+            pair_share = share + (position < num_extra)
+            if links == num_link or pair_share == 0:
+                next_switch_pairs.append((src_index, dst_index))
+                continue
+            num_probes += 1
+            enable_links = src_rows[src_index] & dst_rows[dst_index]
+            num_enable_links = enable_links.count(1)
+            if num_enable_links == 0:
+                continue
+            num_claim = min(pair_share, num_enable_links, num_link - links)
+            if num_claim < num_enable_links:
+                enable_links[count_n(enable_links, num_claim):] = 0
+                next_switch_pairs.append((src_index, dst_index))
+            # allocate links
+            src_rows[src_index] = get_writable_row(temp_idle_links, group_id_pair[0], src_index)
+            dst_rows[dst_index] = get_writable_row(temp_idle_links, group_id_pair[1], dst_index)
+            src_rows[src_index] &= ~enable_links
+            dst_rows[dst_index] &= ~enable_links
+            used_links.extend(
+                (
+                    group_id_pair[0],
+                    src_index,
+                    group_id_pair[1],
+                    dst_index,
+                    ocs_id,
+                )
+                for ocs_id in enable_links.search(1)
+            )
+            links += num_claim
+        switch_pairs = next_switch_pairs
+    if instrumentation.enabled:
+        instrumentation.count("switch_pairs_probed.BULK", num_probes)
+    return links == num_link
+
+
+def allocate_for_two_groups_numpy(group_id_pair, num_link, idle_words, used_links):
+    # Same walk and same picks as allocate_for_two_groups_optimize. The walk
+    # steps down a diagonal ((s, d), (s + 1, d + 1), ...) and every switch is
+    # in exactly one pair of a diagonal, so the pairs do not take ports from
+    # each other: visit v of the walk takes the (v // n)-th idle ocs of pair
+    # v % n, until the first visit to a pair that has run out. All those
+    # links are claimed at once with array operations. Only an empty pair
+    # makes the walk scan for the next pair, as OPTIMIZE does.
+    src_words = idle_words[group_id_pair[0]]
+    dst_words = idle_words[group_id_pair[1]]
+    num_switch_per_group, num_words = src_words.shape
+    steps = np.arange(num_switch_per_group)
+    # created by the first scan
+    src_to_dst = None
+    src_index = 0
+    dst_index = 0
+    links = 0
+    while links < num_link:
+        src_ids = (src_index + steps) % num_switch_per_group
+        dst_ids = (dst_index + steps) % num_switch_per_group
+        # bit ocs_id is word ocs_id // 64, mask 1 << (63 - ocs_id % 64), see pack_idle_links
+        enable_bits = np.unpackbits(
+            (src_words[src_ids] & dst_words[dst_ids]).astype(">u8").view(np.uint8), axis=1
+        ).view(bool)
+        num_enable_links = np.count_nonzero(enable_bits, axis=1)
+        num_visits = min(
+            num_link - links, int((num_enable_links * num_switch_per_group + steps).min())
+        )
+        if num_visits == 0:
+            # (src_index, dst_index) is empty, find the next pair the way the
+            # OPTIMIZE scan does: each row is scanned num_switch_per_group
+            # steps from the dst the scan started at, and marking a pair
+            # dead restarts the scan at that pair
+            has_links = (src_words[:, None, :] & dst_words[None, :, :]).any(axis=2)
+            if not has_links.any():
+                # the scan would only mark the remaining pairs dead
+                return False
+            has_links = has_links.tolist()
+            if src_to_dst is None:
+                src_to_dst = [
+                    [True for _ in range(num_switch_per_group)] for _ in range(num_switch_per_group)
+                ]
+            num_rows = 0
+            num_checks = 0
+            while True:
+                if src_to_dst[src_index][dst_index]:
+                    if has_links[src_index][dst_index]:
+                        break
+                    src_to_dst[src_index][dst_index] = False
+                    num_rows = 0
+                    num_checks = 0
+                dst_index = (dst_index + 1) % num_switch_per_group
+                num_checks += 1
+                if num_checks == num_switch_per_group:
+                    num_checks = 0
+                    src_index = (src_index + 1) % num_switch_per_group
+                    num_rows += 1
+                    if num_rows == num_switch_per_group:
+                        return False
+            continue
+        # links each pair gets, then the first that many idle ocs of every
+        # pair, in the order the walk visits them
+        num_claim = (num_visits - steps + num_switch_per_group - 1) // num_switch_per_group
+        bit_ids = np.flatnonzero(enable_bits)
+        pair_ids = bit_ids // enable_bits.shape[1]
+        # 0 for the first idle ocs of a pair, 1 for the second, ...
+        ranks = np.arange(len(bit_ids)) - (np.cumsum(num_enable_links) - num_enable_links)[pair_ids]
+        claimed = ranks < num_claim[pair_ids]
+        bit_ids = bit_ids[claimed]
+        pair_ids = pair_ids[claimed]
+        order = np.argsort(ranks[claimed] * num_switch_per_group + pair_ids)
+        claim_bits = np.zeros(enable_bits.size, dtype=np.uint8)
+        claim_bits[bit_ids] = 1
+        pair_ids = pair_ids[order]
+        ocs_ids = bit_ids[order] % enable_bits.shape[1]
+        # allocate links
+        claim_words = (
+            np.packbits(claim_bits).view(">u8").astype(np.uint64).reshape(-1, num_words)
+        )
+        src_words[src_ids] &= ~claim_words
+        dst_words[dst_ids] &= ~claim_words
+        used_links.extend(
+            zip(
+                repeat(group_id_pair[0], num_visits),
+                src_ids[pair_ids].tolist(),
+                repeat(group_id_pair[1], num_visits),
+                dst_ids[pair_ids].tolist(),
+                ocs_ids.tolist(),
+            )
+        )
+        src_index = (src_index + num_visits) % num_switch_per_group
+        dst_index = (dst_index + num_visits) % num_switch_per_group
+        links += num_visits
     return True
 
 
@@ -121,8 +398,8 @@ def allocate_for_two_groups_native(
                     temp_idle_links[group_id_pair[0]][switch_id_1][ocs_id] == 1
                     and temp_idle_links[group_id_pair[1]][switch_id_2][ocs_id] == 1
                 ):
-                    temp_idle_links[group_id_pair[0]][switch_id_1][ocs_id] = 0
-                    temp_idle_links[group_id_pair[1]][switch_id_2][ocs_id] = 0
+                    get_writable_row(temp_idle_links, group_id_pair[0], switch_id_1)[ocs_id] = 0
+                    get_writable_row(temp_idle_links, group_id_pair[1], switch_id_2)[ocs_id] = 0
                     links = links + 1
                     used_links.append(
                         (
@@ -138,13 +415,13 @@ def allocate_for_two_groups_native(
     return False
 
 
+@instrumentation.timed("physical_link_allocate.NATIVE")
 def physical_link_allocate_native(
     temp_idle_links: List[List[bitarray]],
     link_demand: List[Tuple[int, int, int, int]],
     used_links: List[Tuple[int, int, int, int, int]],
 ) -> AllocationResult:
     result = AllocationResult.MEETMAX
-    used_links = []
     for group_id_1, group_id_2, _, demand in link_demand:
         if demand == 0:
             continue
@@ -156,3 +433,220 @@ def physical_link_allocate_native(
         ):
             return AllocationResult.FAILURE
     return result
+
+
+@instrumentation.timed("physical_link_allocate.MATCHING")
+def physical_link_allocate_matching(
+    temp_idle_links: List[List[bitarray]],
+    link_demand: List[Tuple[int, int, int, int]],
+    used_links: List[Tuple[int, int, int, int, int]],
+    switch_pair_index: Optional[SwitchPairIndex] = None,
+) -> AllocationResult:
+    # OPTIMIZE places the job first. Only a job it leaves short of MEETMAX is
+    # repaired, so no pair ever gets fewer links than with OPTIMIZE.
+    #
+    # Which switch carries a link only matters through its OCS port, so the
+    # repair works on (group, ocs) port counts: every link of a group pair
+    # takes one idle port at the same ocs in both groups. A missing link
+    # that has no common free ocs is placed through an augmenting path that
+    # moves links of neighbouring pairs to other OCS. Switches are picked
+    # once the counts are final, keeping OPTIMIZE's links where they stay.
+    #
+    # This is a bounded heuristic, not an optimal assignment. Augmenting
+    # paths stop at MAX_AUGMENTING_PATH moves, and even without that limit
+    # the search is not exact: each group's ports at an ocs are shared by
+    # its two pairs of the ring, and each pair's demand is summed over all
+    # OCS, so the job is an integer multi-commodity problem, not a bipartite
+    # matching, and a max flow cannot model it. compare_matching in
+    # allocate_test reports how many more jobs it brings to MEETMAX, next
+    # to how many OPTIMIZE left short while the admission bound allowed it.
+    claimed_links = []
+    result = allocate_min_then_max(
+        temp_idle_links,
+        link_demand,
+        claimed_links,
+        partial(allocate_for_two_groups_optimize, switch_pair_index=switch_pair_index),
+    )
+    if result != AllocationResult.MEETMAX:
+        matching = _OcsMatching(temp_idle_links, link_demand, claimed_links)
+        result = matching.repair(link_demand)
+        if result != AllocationResult.FAILURE:
+            claimed_links = matching.assign_switches(temp_idle_links, claimed_links)
+    used_links.extend(claimed_links)
+    return result
+
+
+class _OcsMatching:
+    # longest chain of links moved to make room for one new link, deeper
+    # conflicts are reported as not placeable; each step is a stack frame
+    MAX_AUGMENTING_PATH = 256
+
+    def __init__(self, temp_idle_links, link_demand, claimed_links):
+        self.pairs_of_group = {}
+        for group_id_1, group_id_2, _, _ in link_demand:
+            self.pairs_of_group.setdefault(group_id_1, []).append((group_id_1, group_id_2))
+            self.pairs_of_group.setdefault(group_id_2, []).append((group_id_1, group_id_2))
+        # {group_id: idle ports per ocs not used by the matching}
+        self.free = {}
+        # {group_id: ocs with a free port}
+        self.free_ocs = {}
+        for group_id in self.pairs_of_group:
+            rows = temp_idle_links[group_id]
+            self.free[group_id] = sum(
+                np.frombuffer(rows[i].unpack(), dtype=np.uint8).astype(np.int64)
+                for i in range(len(rows))
+            )
+            self.free_ocs[group_id] = bitarray((self.free[group_id] > 0).tolist())
+        # {(group_id_1, group_id_2): {ocs_id: links}}, starting from the
+        # links already claimed, whose ports are not idle any more
+        self.links = {pair: {} for group_pairs in self.pairs_of_group.values() for pair in group_pairs}
+        for group_id_1, _, group_id_2, _, ocs_id in claimed_links:
+            ocs_links = self.links[(group_id_1, group_id_2)]
+            ocs_links[ocs_id] = ocs_links.get(ocs_id, 0) + 1
+        self.num_links = {pair: sum(ocs_links.values()) for pair, ocs_links in self.links.items()}
+
+    def repair(self, link_demand) -> AllocationResult:
+        # the demand is counted as in allocate_min_then_max: min_demand, then
+        # max_demand more, the max pass adding one link per pair in turn
+        if self.__is_short(link_demand, 0):
+            return AllocationResult.FAILURE
+        for group_id_1, group_id_2, min_demand, _ in link_demand:
+            pair = (group_id_1, group_id_2)
+            while self.num_links[pair] < min_demand:
+                if not self.add_link(pair):
+                    return AllocationResult.FAILURE
+        if self.__is_short(link_demand, 1):
+            return AllocationResult.MEETMIN
+        result = AllocationResult.MEETMAX
+        remaining = {
+            (group_id_1, group_id_2): min_demand + max_demand
+            for group_id_1, group_id_2, min_demand, max_demand in link_demand
+            if max_demand > 0
+        }
+        while remaining:
+            for pair in list(remaining):
+                if self.num_links[pair] >= remaining[pair]:
+                    del remaining[pair]
+                elif not self.add_link(pair):
+                    result = AllocationResult.MEETMIN
+                    del remaining[pair]
+        return result
+
+    def __is_short(self, link_demand, demand_index) -> bool:
+        # the bound of admission.check_link_demand on the ports this job can
+        # use, its own links included: when it fails no rearrangement reaches
+        # the demand, and the search for one would visit every (group, ocs)
+        ports = {group_id: free.copy() for group_id, free in self.free.items()}
+        for pair, ocs_links in self.links.items():
+            for group_id in pair:
+                for ocs_id, num_links in ocs_links.items():
+                    ports[group_id][ocs_id] += num_links
+        num_links_for_group = {}
+        for group_id_1, group_id_2, min_demand, max_demand in link_demand:
+            demand = min_demand if demand_index == 0 else min_demand + max_demand
+            num_links_for_group[group_id_1] = num_links_for_group.get(group_id_1, 0) + demand
+            num_links_for_group[group_id_2] = num_links_for_group.get(group_id_2, 0) + demand
+            if np.minimum(ports[group_id_1], ports[group_id_2]).sum() < demand:
+                return True
+        return any(ports[group_id].sum() < num_links for group_id, num_links in num_links_for_group.items())
+
+    def add_link(self, pair) -> bool:
+        group_id_1, group_id_2 = pair
+        enable_ocs = self.free_ocs[group_id_1] & self.free_ocs[group_id_2]
+        if enable_ocs.any():
+            self.__take(pair, enable_ocs.index(1))
+            return True
+        # place the link where one group has a free port, and make room for
+        # the other group there
+        visited = set()
+        for group_id, other_group_id in ((group_id_2, group_id_1), (group_id_1, group_id_2)):
+            for ocs_id in list(self.free_ocs[other_group_id].search(1)):
+                self.__take(pair, ocs_id)
+                if self.__make_room(group_id, ocs_id, visited, 1):
+                    return True
+                self.__drop(pair, ocs_id)
+        return False
+
+    def __make_room(self, group_id, ocs_id, visited, depth) -> bool:
+        # augmenting path: group_id uses one port more than it has at ocs_id,
+        # move a link of one of its pairs to another ocs. Where only one of
+        # the pair's groups is free the other one is left a port short
+        # instead, and the path goes on from there; a failed step is undone.
+        if (group_id, ocs_id) in visited:
+            return False
+        visited.add((group_id, ocs_id))
+        if depth > self.MAX_AUGMENTING_PATH:
+            return False
+        for pair in self.pairs_of_group[group_id]:
+            if not self.links[pair].get(ocs_id):
+                continue
+            other_group_id = pair[1] if pair[0] == group_id else pair[0]
+            enable_ocs = self.free_ocs[group_id] & self.free_ocs[other_group_id]
+            if enable_ocs.any():
+                self.__move(pair, ocs_id, enable_ocs.index(1))
+                return True
+            for short_group_id, free_group_id in ((group_id, other_group_id), (other_group_id, group_id)):
+                for new_ocs_id in list(self.free_ocs[free_group_id].search(1)):
+                    if new_ocs_id == ocs_id or (short_group_id, new_ocs_id) in visited:
+                        continue
+                    self.__move(pair, ocs_id, new_ocs_id)
+                    if self.__make_room(short_group_id, new_ocs_id, visited, depth + 1):
+                        return True
+                    self.__move(pair, new_ocs_id, ocs_id)
+        return False
+
+    def __is_free(self, pair, ocs_id) -> bool:
+        return self.free[pair[0]][ocs_id] > 0 and self.free[pair[1]][ocs_id] > 0
+
+    def __update(self, group_id, ocs_id, delta):
+        self.free[group_id][ocs_id] += delta
+        self.free_ocs[group_id][ocs_id] = bool(self.free[group_id][ocs_id] > 0)
+
+    def __take(self, pair, ocs_id):
+        self.links[pair][ocs_id] = self.links[pair].get(ocs_id, 0) + 1
+        self.num_links[pair] += 1
+        self.__update(pair[0], ocs_id, -1)
+        self.__update(pair[1], ocs_id, -1)
+
+    def __drop(self, pair, ocs_id):
+        self.links[pair][ocs_id] -= 1
+        self.num_links[pair] -= 1
+        self.__update(pair[0], ocs_id, 1)
+        self.__update(pair[1], ocs_id, 1)
+
+    def __move(self, pair, ocs_id, new_ocs_id):
+        self.__drop(pair, ocs_id)
+        self.__take(pair, new_ocs_id)
+
+    def assign_switches(self, temp_idle_links, claimed_links):
+        """Turn the final counts into links: keep claimed links at every ocs
+        whose count did not drop, free the ports of the links moved away, and
+        pick idle switches for the links added"""
+        kept_links = []
+        for link in claimed_links:
+            group_id_1, src_index, group_id_2, dst_index, ocs_id = link
+            ocs_links = self.links[(group_id_1, group_id_2)]
+            if ocs_links.get(ocs_id, 0) > 0:
+                ocs_links[ocs_id] -= 1
+                kept_links.append(link)
+            else:
+                get_writable_row(temp_idle_links, group_id_1, src_index)[ocs_id] = 1
+                get_writable_row(temp_idle_links, group_id_2, dst_index)[ocs_id] = 1
+        # the port counts guarantee enough idle switches for every new link
+        for (group_id_1, group_id_2), ocs_links in self.links.items():
+            src_rows = temp_idle_links[group_id_1]
+            dst_rows = temp_idle_links[group_id_2]
+            for ocs_id in sorted(ocs_links):
+                for _ in range(ocs_links[ocs_id]):
+                    src_index = next(
+                        i for i in range(len(src_rows)) if src_rows[i][ocs_id]
+                    )
+                    dst_index = next(
+                        i for i in range(len(dst_rows)) if dst_rows[i][ocs_id]
+                    )
+                    get_writable_row(temp_idle_links, group_id_1, src_index)[ocs_id] = 0
+                    get_writable_row(temp_idle_links, group_id_2, dst_index)[ocs_id] = 0
+                    kept_links.append(
+                        (group_id_1, src_index, group_id_2, dst_index, ocs_id)
+                    )
+        return kept_links
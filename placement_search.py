@@ -0,0 +1,185 @@
+from typing import Dict, List, Optional, Tuple
+
+from admission import get_result_bound, has_enough_gpus
+from gpu_allocate import (
+    GpuPlacement,
+    calculate_link_demand,
+    link_demand_cache,
+    place_by_capacity,
+    place_first_fit,
+)
+from groups import Groups
+from links import LinkTransaction, Links
+from physical_link_allocate import (
+    AllocationResult,
+    PhysicalLinkeAllocatingAlthrighm,
+    physical_link_allocate,
+)
+
+
+class PlacementCandidate:
+    """一个候选放置：GPU分配、环顺序、链路需求，以及在独立事务中试分配链路的结果"""
+
+    def __init__(self, name: str, gpu_allocation: Dict[int, int], link_demand: List[Tuple[int, int, int, int]]):
+        self.name = name
+        self.gpu_allocation = gpu_allocation
+        self.link_demand = link_demand
+        self.transaction: Optional[LinkTransaction] = None
+        self.used_links: List[Tuple[int, int, int, int, int]] = []
+        self.result = AllocationResult.FAILURE
+
+    def commit(self, job, group: Groups):
+        """扣减GPU并提交链路事务"""
+        for group_id, gpus in self.gpu_allocation.items():
+            group.update_available_gpus(group_id, -gpus)
+        self.transaction.commit(job, self.used_links)
+        group.assign_gpu_for_job(job, self.gpu_allocation)
+
+    def rollback(self):
+        if self.transaction is not None and not self.transaction.closed:
+            self.transaction.rollback()
+
+
+class PlacementSearch:
+    """
+    推测式放置搜索：为一个任务生成多个候选的group集合和环顺序，
+    在各自的链路事务中依次试分配，只提交结果最好的一个
+
+    候选包括首次适应、最佳适应、最少group，以及对每个group集合按组间可分配
+    链路数贪心排列的环（让链路充足的组在环上相邻）。候选在同一份链路状态上
+    读取、各自写入自己的事务，互不影响；评估期间不修改Groups和Links。
+    结果相同时按生成顺序取第一个，因此首次适应可行时行为与gpu_allocate一致。
+    试分配是纯Python的计算，受GIL限制，多线程并不会更快，所以串行评估，
+    并用已有的最好结果跳过上界达不到更好结果的候选。
+    """
+
+    PLACEMENTS = (GpuPlacement.FIRST_FIT, GpuPlacement.BEST_FIT, GpuPlacement.FEWEST_GROUPS)
+
+    def __init__(
+        self,
+        links: Links,
+        group: Groups,
+        alghrithm: PhysicalLinkeAllocatingAlthrighm = PhysicalLinkeAllocatingAlthrighm.OPTIMIZE,
+        cache=link_demand_cache,
+    ):
+        self.links = links
+        self.group = group
+        self.alghrithm = alghrithm
+        self.cache = cache
+
+    def search(self, job_gpu_count, transaction: Optional[LinkTransaction] = None) -> Optional[PlacementCandidate]:
+        """
+        返回最好的可行候选，其链路已在一个未提交的事务中分配好，由调用方commit；
+        没有可行候选时返回None
+
+        Args:
+            job_gpu_count: 任务需要的GPU数量
+            transaction: 可选的父事务，候选的事务嵌套在其中
+        """
+        if not has_enough_gpus(self.group, job_gpu_count):
+            return None
+        candidates = self.generate_candidates(job_gpu_count)
+        if not candidates:
+            return None
+        for candidate in candidates:
+            candidate.transaction = self.links.begin() if transaction is None else transaction.begin()
+        # 已有的最好结果作为门槛，上界达不到更好结果的候选不必试分配；
+        # 已经满足最佳链路数时其余候选都会被跳过，不增加调度延迟
+        best = candidates[0]
+        self.evaluate(best)
+        for candidate in candidates[1:]:
+            if get_result_bound(self.links, candidate.link_demand) < best.result:
+                self.evaluate(candidate)
+                if candidate.result < best.result:
+                    best = candidate
+        for candidate in candidates:
+            if candidate is not best:
+                candidate.rollback()
+        if best.result == AllocationResult.FAILURE:
+            best.rollback()
+            return None
+        return best
+
+    def evaluate(self, candidate: PlacementCandidate):
+        """在候选自己的事务中试分配链路"""
+        if get_result_bound(self.links, candidate.link_demand) == AllocationResult.FAILURE:
+            candidate.result = AllocationResult.FAILURE
+            return
+        if not candidate.link_demand:
+            candidate.result = AllocationResult.MEETMAX
+            return
+        candidate.result = physical_link_allocate(
+            candidate.transaction,
+            candidate.link_demand,
+            candidate.used_links,
+            self.alghrithm,
+            self.links.get_switch_pair_index(),
+        )
+
+    def generate_candidates(self, job_gpu_count) -> List[PlacementCandidate]:
+        """
+        依次用每种放置策略临时扣减GPU、计算链路需求后立即归还，
+        相同的GPU分配只保留一次
+        """
+        candidates = []
+        seen = set()
+        for placement in self.PLACEMENTS:
+            if placement == GpuPlacement.FIRST_FIT:
+                allocation = place_first_fit(job_gpu_count, self.group)
+            else:
+                allocation = place_by_capacity(job_gpu_count, self.group, placement)
+            if allocation is None:
+                continue
+            gpu_allocation = {group_id: gpus for group_id, gpus in enumerate(allocation) if gpus > 0}
+            key = tuple(sorted(gpu_allocation.items()))
+            if key not in seen:
+                seen.add(key)
+                candidates.append(
+                    PlacementCandidate(
+                        placement.name,
+                        gpu_allocation,
+                        calculate_link_demand(gpu_allocation, self.group, self.cache),
+                    )
+                )
+                ring_order = self.get_link_rich_ring(gpu_allocation)
+                if ring_order is not None:
+                    candidates.append(
+                        PlacementCandidate(
+                            placement.name + "_RING",
+                            gpu_allocation,
+                            calculate_link_demand(gpu_allocation, self.group, self.cache, ring_order),
+                        )
+                    )
+            self.group.release_gpus(gpu_allocation)
+        return candidates
+
+    def get_link_rich_ring(self, gpu_allocation: Dict[int, int]) -> Optional[List[int]]:
+        """
+        贪心成环：从空闲链路最多的组出发，每次接上与当前组之间可分配链路最多的组
+
+        Returns:
+            List[int] | None: 环上group的顺序，与默认的升序环相同（或不足3个组）时返回None
+        """
+        group_ids = sorted(gpu_allocation)
+        if len(group_ids) <= 2:
+            return None
+        current = max(group_ids, key=self.links.get_num_idle_links_fo_group)
+        ring_order = [current]
+        remaining = set(group_ids) - {current}
+        while remaining:
+            current = max(
+                sorted(remaining),
+                key=lambda group_id: self.links.get_num_allocatable_links(current, group_id),
+            )
+            ring_order.append(current)
+            remaining.remove(current)
+        if get_ring_edges(ring_order) == get_ring_edges(group_ids):
+            return None
+        return ring_order
+
+
+def get_ring_edges(ring_order: List[int]):
+    return {
+        (min(group_id, next_group_id), max(group_id, next_group_id))
+        for group_id, next_group_id in zip(ring_order, ring_order[1:] + ring_order[:1])
+    }
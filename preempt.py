@@ -0,0 +1,293 @@
+from bisect import bisect_left, insort
+from itertools import islice
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from admission import get_result_bound
+from gpu_allocate import GpuPlacement, gpu_allocate
+from groups import Groups
+from jobs import Job
+from links import Links, link_masks, link_ports, to_link_array
+from physical_link_allocate import (
+    AllocationResult,
+    PhysicalLinkeAllocatingAlthrighm,
+    physical_link_allocate,
+)
+
+
+class Victim(NamedTuple):
+    job: Job
+    gpu_allocation: Dict[int, int]
+    links: np.ndarray
+    # {group_id: 链路在该group的端口数}，结束后该group的available_links增加这么多
+    links_per_group: Dict[int, int]
+    cost: int  # 抢占后丢失的工作量：已运行的GPU时间
+
+
+class PreemptionPlan(NamedTuple):
+    """一次抢占：先结束victims，再按已经试分配过的GPU和链路启动job"""
+
+    job: Job
+    victims: List[Job]
+    cost: int
+    gpu_allocation: Dict[int, int]
+    link_demand: List[Tuple[int, int, int, int]]
+    used_links: List[Tuple[int, int, int, int, int]]
+    result: AllocationResult
+
+
+class IdlePortBound:
+    """
+    用假设的各group在每个ocs上的空闲端口数代替Links的计数器，
+    提供admission.get_result_bound需要的两个查询
+    """
+
+    def __init__(self, idle_ports: np.ndarray):
+        self.idle_ports = idle_ports
+
+    def get_num_allocatable_links(self, group_id_1, group_id_2) -> int:
+        return int(np.minimum(self.idle_ports[group_id_1], self.idle_ports[group_id_2]).sum())
+
+    def get_num_idle_links_fo_group(self, group_id) -> int:
+        return int(self.idle_ports[group_id].sum())
+
+
+class PreemptionPlanner:
+    """
+    为放不下的高优先级任务选出代价最小的一组低优先级运行中任务来抢占
+
+    候选任务先按 (优先级, 已运行时间, GPU数) 排序：先抢占最低优先级的，
+    同优先级中单位GPU丢失工作量最少（刚启动）的先抢占，再相同时先抢占小任务。
+    小任务释放的GPU分散、常常没有足够的OCS端口，这种顺序失败时再按GPU数从大到小
+    试一次。每种顺序都依次加入候选，直到释放的GPU足够、由空闲端口计数给出的
+    链路上界可行、并且事务中的试分配成功，再从代价最高的开始去掉不必要的任务，
+    得到的集合中每个任务都不可缺少。每一步只需一次GPU计数比较和一次计数器上界检查，
+    试分配只在上界可行时进行，不枚举子集。
+
+    试分配在LinkTransaction中把被抢占任务的链路标记为空闲，GPU和available_links
+    直接在Groups上归还后恢复（GPU放置和链路需求都依赖它们），计划返回时Links和Groups
+    都没有变化。
+
+    为避免反复抢占，运行不足min_runtime的任务和已被抢占max_preemptions_per_job次的
+    任务不会被选中。不抢占也能放下的任务不返回计划，仍按调度策略排队。
+
+    运行中的任务按优先级分组，组内按两种顺序保存在有序列表中，由on_start、on_preempt、
+    on_finish增删，每次plan不必扫描和排序所有运行中的任务。
+    """
+
+    def __init__(
+        self,
+        links: Links,
+        group: Groups,
+        alghrithm: PhysicalLinkeAllocatingAlthrighm = PhysicalLinkeAllocatingAlthrighm.OPTIMIZE,
+        placement: GpuPlacement = GpuPlacement.FIRST_FIT,
+        max_victims: int = 64,
+        min_runtime: int = 1,
+        max_preemptions_per_job: int = 1,
+    ):
+        self.links = links
+        self.group = group
+        self.alghrithm = alghrithm
+        self.placement = placement
+        # 一次抢占最多结束多少个任务，超过时放弃抢占
+        self.max_victims = max_victims
+        # 任务至少运行这么久才能被抢占
+        self.min_runtime = min_runtime
+        # 一个任务最多被抢占几次
+        self.max_preemptions_per_job = max_preemptions_per_job
+        # {job: 被抢占的次数}，任务结束时删除
+        self.num_preemptions_for_job: Dict[Job, int] = {}
+        # {优先级: [(-start_time, gpu_count, 序号, job)]}，刚启动的在前
+        self.running_by_cost: Dict[int, List[Tuple[int, int, int, Job]]] = {}
+        # {优先级: [(-gpu_count, -start_time, 序号, job)]}，大任务在前
+        self.running_by_size: Dict[int, List[Tuple[int, int, int, Job]]] = {}
+        # {job: (by_cost中的键, by_size中的键)}，序号按启动顺序递增，键互不相同
+        self.keys_for_job: Dict[Job, Tuple[Tuple, Tuple]] = {}
+        self.num_started = 0
+        self.num_plans = 0
+        self.num_trials = 0
+
+    def on_start(self, job: Job):
+        """任务启动后调用"""
+        self.num_started += 1
+        by_cost = (-job.start_time, job.gpu_count, self.num_started, job)
+        by_size = (-job.gpu_count, -job.start_time, self.num_started, job)
+        self.keys_for_job[job] = (by_cost, by_size)
+        insort(self.running_by_cost.setdefault(job.priority, []), by_cost)
+        insort(self.running_by_size.setdefault(job.priority, []), by_size)
+
+    def on_preempt(self, plan: "PreemptionPlan"):
+        """计划被执行后调用"""
+        for victim in plan.victims:
+            self.num_preemptions_for_job[victim] = self.num_preemptions_for_job.get(victim, 0) + 1
+            self.remove_running(victim)
+
+    def on_finish(self, job: Job):
+        """任务结束后调用"""
+        self.num_preemptions_for_job.pop(job, None)
+        self.remove_running(job)
+
+    def remove_running(self, job: Job):
+        keys = self.keys_for_job.pop(job, None)
+        if keys is None:
+            return
+        for running, key in zip((self.running_by_cost, self.running_by_size), keys):
+            ordered = running[job.priority]
+            # 序号唯一，比较在job之前就能分出大小
+            del ordered[bisect_left(ordered, key[:3])]
+            if not ordered:
+                del running[job.priority]
+
+    def get_candidates(self, job: Job, now: int) -> List[List[Job]]:
+        """
+        优先级低于job、运行已满min_runtime且抢占次数未达上限的运行中任务的两种抢占顺序
+
+        Returns:
+            List[List[Job]]: [按代价排序, 按GPU数从大到小排序]，同优先级内排序，先抢占最低优先级的，
+            每种顺序最多max_victims个任务
+        """
+        priorities = sorted(priority for priority in self.running_by_cost if priority < job.priority)
+        latest_start_time = now - self.min_runtime
+        by_cost = (
+            running
+            for priority in priorities
+            # 按-start_time升序，运行不足min_runtime的任务在前，直接跳过
+            for _, _, _, running in islice(
+                self.running_by_cost[priority], bisect_left(self.running_by_cost[priority], (-latest_start_time,)), None
+            )
+        )
+        by_size = (
+            running
+            for priority in priorities
+            for _, _, _, running in self.running_by_size[priority]
+            if running.start_time <= latest_start_time
+        )
+        return [
+            list(islice(
+                (
+                    running for running in candidates
+                    if self.num_preemptions_for_job.get(running, 0) < self.max_preemptions_per_job
+                ),
+                self.max_victims,
+            ))
+            for candidates in (by_cost, by_size)
+        ]
+
+    def plan(self, job: Job, now: int) -> Optional[PreemptionPlan]:
+        """
+        Returns:
+            Optional[PreemptionPlan]: 找不到可行的抢占集合，或者job不抢占也能放下时返回None
+        """
+        self.num_plans += 1
+        missing_gpus = job.gpu_count - self.group.total_available_gpus
+        if missing_gpus <= 0 and self.try_allocate(job, [], self.links.get_num_idle_ports()) is not None:
+            return None
+        for candidates in self.get_candidates(job, now):
+            plan = self.plan_greedy(job, now, candidates, missing_gpus)
+            if plan is not None:
+                return plan
+        return None
+
+    def plan_greedy(self, job: Job, now: int, candidates: List[Job], missing_gpus: int) -> Optional[PreemptionPlan]:
+        """按candidates的顺序加入任务直到job可以放下，再去掉不必要的任务"""
+        idle_ports = self.links.get_num_idle_ports()
+        chosen: List[Victim] = []
+        freed_gpus = 0
+        trial = None
+        for running in candidates:
+            victim = self.get_victim(running, now)
+            chosen.append(victim)
+            freed_gpus += running.gpu_count
+            add_ports(idle_ports, victim.links, 1)
+            if freed_gpus < missing_gpus:
+                continue
+            trial = self.try_allocate(job, chosen, idle_ports)
+            if trial is not None:
+                break
+        if trial is None:
+            return None
+        # 去掉多余的任务，代价高的先尝试
+        for victim in sorted(chosen, key=lambda victim: -victim.cost):
+            if freed_gpus - victim.job.gpu_count < missing_gpus:
+                continue
+            rest = [other for other in chosen if other is not victim]
+            add_ports(idle_ports, victim.links, -1)
+            rest_trial = self.try_allocate(job, rest, idle_ports)
+            if rest_trial is None:
+                add_ports(idle_ports, victim.links, 1)
+                continue
+            chosen, trial = rest, rest_trial
+            freed_gpus -= victim.job.gpu_count
+        return PreemptionPlan(job, [victim.job for victim in chosen], sum(victim.cost for victim in chosen), *trial)
+
+    def get_victim(self, running: Job, now: int) -> Victim:
+        try:
+            links = self.links.get_links_for_job(running)
+        except KeyError:
+            # 没有通过Links分配过链路的任务
+            links = to_link_array([])
+        group_ids = link_ports(links)['group']
+        links_per_group = dict(zip(*(array.tolist() for array in np.unique(group_ids, return_counts=True))))
+        return Victim(
+            running,
+            self.group.gpus_for_job[running],
+            links,
+            links_per_group,
+            running.gpu_count * (now - running.start_time),
+        )
+
+    def try_allocate(
+        self, job: Job, victims: List[Victim], idle_ports: np.ndarray
+    ) -> Optional[Tuple[Dict[int, int], List[Tuple[int, int, int, int]], List[Tuple[int, int, int, int, int]], AllocationResult]]:
+        """
+        假设victims都已结束，试着放置job
+
+        Args:
+            idle_ports: victims结束后各group在每个ocs上的空闲端口数，用于上界检查
+
+        Returns:
+            成功时返回 (gpu_allocation, link_demand, used_links, result)，否则None
+        """
+        for victim in victims:
+            self.group.release_gpus(victim.gpu_allocation)
+            for group_id, num_links in victim.links_per_group.items():
+                self.group.update_available_links(group_id, num_links)
+        try:
+            gpu_allocation = {}
+            link_demand = gpu_allocate(job.gpu_count, self.group, gpu_allocation, self.placement)
+            if not gpu_allocation:
+                return None
+            self.group.release_gpus(gpu_allocation)
+            if not link_demand:
+                return gpu_allocation, link_demand, [], AllocationResult.MEETMAX
+            if get_result_bound(IdlePortBound(idle_ports), link_demand) == AllocationResult.FAILURE:
+                return None
+            self.num_trials += 1
+            transaction = self.links.begin()
+            for victim in victims:
+                for group_id, switch_id, mask in link_masks(
+                    victim.links, transaction.num_switch_per_group, idle_ports.shape[1]
+                ):
+                    row = transaction.get_row(group_id, switch_id)
+                    row |= mask
+            used_links = []
+            result = physical_link_allocate(
+                transaction, link_demand, used_links, self.alghrithm, self.links.get_switch_pair_index()
+            )
+            transaction.rollback()
+            if result == AllocationResult.FAILURE:
+                return None
+            return gpu_allocation, link_demand, used_links, result
+        finally:
+            for victim in victims:
+                for group_id, gpus in victim.gpu_allocation.items():
+                    self.group.update_available_gpus(group_id, -gpus)
+                for group_id, num_links in victim.links_per_group.items():
+                    self.group.update_available_links(group_id, -num_links)
+
+
+def add_ports(idle_ports: np.ndarray, links: np.ndarray, delta: int):
+    """把links两端的端口计入（delta=1）或移出（delta=-1）空闲端口数"""
+    ports = link_ports(links)
+    np.add.at(idle_ports, (ports['group'].astype(np.int64), ports['ocs'].astype(np.int64)), delta)
@@ -0,0 +1,200 @@
+import asyncio
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from links import Links
+
+# OCS上的一个交叉连接：连接的两个端口。端口编号 group_id * num_switch_per_group + switch_id，
+# 每个交换机在它所属spine的每个OCS上各有一个端口
+CrossConnect = Tuple[int, int]
+
+
+class OcsBatch(NamedTuple):
+    """发给一个OCS的一次调用：先断开再连接，同一批内断开释放的端口可以被连接复用"""
+
+    disconnects: List[CrossConnect]
+    connects: List[CrossConnect]
+
+    def __len__(self) -> int:
+        return len(self.disconnects) + len(self.connects)
+
+
+class ReconfigPlan:
+    """
+    把一次或多次链路分配、释放、迁移累积成每个OCS上的净变化
+
+    作为Links的change listener使用（见record）。同一个交叉连接先断开再连接（或反过来）
+    会相互抵消，例如释放后又把同样的端口分配给新任务时不需要任何操作。
+
+    claim_ports_for_job占用的单个端口（链路另一端在其它pod的Links中）记在port_changes中，
+    只有和对端的记录配对后才能组成交叉连接，不会出现在get_batches的结果里。
+    """
+
+    def __init__(self, num_switch_per_group: int):
+        self.num_switch_per_group = num_switch_per_group
+        # {ocs_id: {(port_1, port_2): +1 连接 / -1 断开}}，port_1 < port_2
+        self.changes: Dict[int, Dict[CrossConnect, int]] = {}
+        # {ocs_id: {port: +1 占用 / -1 释放}}，只有一端在本Links中的链路
+        self.port_changes: Dict[int, Dict[int, int]] = {}
+        # 累积的原始操作数（抵消前），即逐条下发时的调用次数
+        self.num_link_changes = 0
+
+    def on_connect(self, links: np.ndarray):
+        self.__add(links, 1)
+
+    def on_disconnect(self, links: np.ndarray):
+        self.__add(links, -1)
+
+    def on_claim_ports(self, ports: np.ndarray):
+        self.__add_ports(ports, 1)
+
+    def on_free_ports(self, ports: np.ndarray):
+        self.__add_ports(ports, -1)
+
+    def __add_ports(self, ports: np.ndarray, delta: int):
+        port_ids = (ports['group'].astype(np.int64) * self.num_switch_per_group + ports['switch']).tolist()
+        for ocs_id, port in zip(ports['ocs'].tolist(), port_ids):
+            changes = self.port_changes.setdefault(ocs_id, {})
+            change = changes.get(port, 0) + delta
+            if change == 0:
+                del changes[port]
+            else:
+                changes[port] = change
+
+    def __add(self, links: np.ndarray, delta: int):
+        if len(links) == 0:
+            return
+        src_ports = links['src_group'].astype(np.int64) * self.num_switch_per_group + links['src_switch']
+        dst_ports = links['dst_group'].astype(np.int64) * self.num_switch_per_group + links['dst_switch']
+        port_1 = np.minimum(src_ports, dst_ports).tolist()
+        port_2 = np.maximum(src_ports, dst_ports).tolist()
+        for ocs_id, cross_connect in zip(links['ocs'].tolist(), zip(port_1, port_2)):
+            changes = self.changes.setdefault(ocs_id, {})
+            change = changes.get(cross_connect, 0) + delta
+            if change == 0:
+                del changes[cross_connect]
+            else:
+                changes[cross_connect] = change
+        self.num_link_changes += len(links)
+
+    def get_batches(self) -> Dict[int, OcsBatch]:
+        """{ocs_id: OcsBatch}，只包含有净变化的OCS"""
+        batches = {}
+        for ocs_id, changes in sorted(self.changes.items()):
+            if not changes:
+                continue
+            batches[ocs_id] = OcsBatch(
+                [cross_connect for cross_connect, change in changes.items() if change < 0],
+                [cross_connect for cross_connect, change in changes.items() if change > 0],
+            )
+        return batches
+
+    def clear(self):
+        self.changes.clear()
+        self.port_changes.clear()
+        self.num_link_changes = 0
+
+
+@contextmanager
+def record(links: Links, plan: Optional[ReconfigPlan] = None):
+    """
+    记录期间Links上所有已提交的分配、释放和迁移
+
+    用法:
+        with record(links) as plan:
+            simulator.schedule()
+        await dispatch(plan.get_batches(), controller)
+    """
+    if plan is None:
+        plan = ReconfigPlan(links.get_counters()['num_idle_links_for_switch'].shape[1])
+    links.set_change_listener(plan)
+    try:
+        yield plan
+    finally:
+        links.set_change_listener(None)
+
+
+class OcsController(ABC):
+    """OCS控制器接口：每次调用把一个批次下发给一台OCS，不同OCS的调用可以并发"""
+
+    @abstractmethod
+    async def apply(self, ocs_id: int, batch: OcsBatch):
+        ...
+
+
+class ReconfigurationError(RuntimeError):
+    """部分OCS下发失败，failures是 {ocs_id: 异常}，其余OCS已经下发成功"""
+
+    def __init__(self, failures: Dict[int, BaseException]):
+        super().__init__(f"reconfiguration failed on ocs {sorted(failures)}")
+        self.failures = failures
+
+
+class MockOcsController(OcsController):
+    """
+    进程内的模拟OCS：保存每台OCS的交叉连接，校验端口冲突，每次调用等待
+    latency + 每个操作 operation_latency 秒，用于测试和估计下发耗时
+    """
+
+    def __init__(self, latency: float = 0.005, operation_latency: float = 0.0):
+        self.latency = latency
+        self.operation_latency = operation_latency
+        # {ocs_id: {port: 对端port}}
+        self.cross_connects: Dict[int, Dict[int, int]] = {}
+        self.num_calls = 0
+        self.num_operations = 0
+
+    async def apply(self, ocs_id: int, batch: OcsBatch):
+        self.num_calls += 1
+        self.num_operations += len(batch)
+        await asyncio.sleep(self.latency + self.operation_latency * len(batch))
+        ports = self.cross_connects.setdefault(ocs_id, {})
+        for port_1, port_2 in batch.disconnects:
+            if ports.get(port_1) != port_2:
+                raise ValueError(f"ocs {ocs_id}: ports {port_1} and {port_2} are not connected")
+            del ports[port_1], ports[port_2]
+        for port_1, port_2 in batch.connects:
+            if port_1 in ports or port_2 in ports:
+                raise ValueError(f"ocs {ocs_id}: port {port_1} or {port_2} is already connected")
+            ports[port_1] = port_2
+            ports[port_2] = port_1
+
+
+async def dispatch(
+    batches: Dict[int, OcsBatch], controller: OcsController, max_concurrency: Optional[int] = None
+) -> Dict:
+    """
+    并发地把每台OCS的批次下发给控制器，每台OCS一次调用
+
+    Args:
+        max_concurrency: 同时进行的调用数上限，None表示不限
+
+    Returns:
+        Dict: 调用数、操作数和耗时（秒）
+
+    Raises:
+        ReconfigurationError: 有OCS下发失败时，在所有调用结束后抛出
+    """
+    semaphore = asyncio.Semaphore(max_concurrency) if max_concurrency is not None else None
+
+    async def apply(ocs_id, batch):
+        if semaphore is None:
+            return await controller.apply(ocs_id, batch)
+        async with semaphore:
+            return await controller.apply(ocs_id, batch)
+
+    start = time.perf_counter()
+    ocs_ids = list(batches)
+    results = await asyncio.gather(*(apply(ocs_id, batches[ocs_id]) for ocs_id in ocs_ids), return_exceptions=True)
+    failures = {ocs_id: result for ocs_id, result in zip(ocs_ids, results) if isinstance(result, BaseException)}
+    if failures:
+        raise ReconfigurationError(failures)
+    return {
+        'calls': len(batches),
+        'operations': sum(len(batch) for batch in batches.values()),
+        'elapsed_s': time.perf_counter() - start,
+    }
@@ -0,0 +1,544 @@
+import argparse
+import heapq
+import time
+from collections import deque
+from itertools import islice
+from multiprocessing import Pipe, Process
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+from bitarray import bitarray
+
+from checkpoint import load, save
+from gpu_allocate import GpuPlacement, gpu_allocate
+from groups import Groups
+from jobs import Job, generate_jobs
+from links import PORT_DTYPE, SwitchPairIndex, get_port_ranges, link_ports, to_link_array
+from physical_link_allocate import (
+    AllocationResult,
+    PhysicalLinkeAllocatingAlthrighm,
+    physical_link_allocate,
+)
+from simulator import Simulator, pop_unrunnable_job
+from sweep import Topology, parse_topology
+
+
+class PodShard:
+    """
+    一个pod（连续的一段group）：自己的Groups、Links和调度器，group_id都是pod内的编号
+
+    只放在本pod内的任务由schedule直接启动；跨pod的任务由协调者两阶段提交：
+    read读取状态，reserve校验并占用本pod的GPU和端口，随后commit或abort。
+    端口的占用和释放都经过Links的claim_ports_for_job / free_ports_for_job，
+    会通知change listener并随检查点保存（见save / restore）。
+    """
+
+    def __init__(
+        self,
+        shard_id: int,
+        topology: Topology,
+        alghrithm: PhysicalLinkeAllocatingAlthrighm,
+        placement: GpuPlacement = GpuPlacement.FIRST_FIT,
+    ):
+        self.shard_id = shard_id
+        self.groups, self.links = topology.build()
+        # 本pod内的调度（准入检查、GPU放置、链路分配、统计）与单状态仿真相同
+        self.simulator = Simulator([], self.links, self.groups, alghrithm, placement=placement)
+        # {job_id: job} 本pod内运行的任务
+        self.local_jobs: Dict = {}
+        # {job_id: job} 已reserve未提交 / 已提交的跨pod任务
+        self.reserved_jobs: Dict = {}
+        self.cross_shard_jobs: Dict = {}
+
+    def schedule(self, start_time, jobs: List[Tuple]) -> Tuple[List, int]:
+        """
+        按顺序尝试启动一批任务
+
+        Args:
+            jobs: [(job_id, gpu_count, time), ...]
+
+        Returns:
+            Tuple: (启动的job_id, 本pod的空闲GPU数)
+        """
+        self.simulator.time = start_time
+        started = []
+        for job_id, gpu_count, job_time in jobs:
+            job = Job(gpu_count, job_time, start_time, job_id=job_id)
+            if self.simulator.try_start(job):
+                self.local_jobs[job_id] = job
+                started.append(job_id)
+            else:
+                # 下一轮会用新的Job对象重试，不必记录
+                self.simulator.retried_jobs.discard(job)
+        return started, self.groups.total_available_gpus
+
+    def finish(self, job_ids: List) -> int:
+        """结束任务，返回本pod的空闲GPU数"""
+        for job_id in job_ids:
+            if job_id in self.local_jobs:
+                self.simulator.complete(self.local_jobs.pop(job_id))
+            else:
+                job = self.cross_shard_jobs.pop(job_id)
+                self.links.free_ports_for_job(job)
+                self.groups.free_gpu_for_job(job)
+        return self.groups.total_available_gpus
+
+    def read(self) -> Tuple[List[int], List[int], bytes]:
+        """跨pod任务的第0阶段：各group的空闲GPU、可用链路以及空闲端口位图"""
+        return (
+            [group['available_gpus'] for group in self.groups.groups],
+            [group['available_links'] for group in self.groups.groups],
+            self.links.get_idle_links_bytes(),
+        )
+
+    def reserve(self, job_id, gpu_count, job_time, gpu_allocation: Dict[int, int], ports: np.ndarray) -> bool:
+        """
+        第一阶段：校验GPU和端口仍然空闲并占用它们，返回是否同意提交；不同意时不做任何修改
+
+        Args:
+            gpu_allocation: {pod内group_id: GPU数}
+            ports: 本pod内的链路端点（PORT_DTYPE，pod内编号）
+        """
+        if any(self.groups.get_group(group_id)['available_gpus'] < gpus for group_id, gpus in gpu_allocation.items()):
+            return False
+        job = Job(gpu_count, job_time, job_id=job_id)
+        try:
+            self.links.claim_ports_for_job(job, ports)
+        except ValueError:
+            return False
+        for group_id, gpus in gpu_allocation.items():
+            self.groups.update_available_gpus(group_id, -gpus)
+        self.groups.assign_gpu_for_job(job, gpu_allocation)
+        self.reserved_jobs[job_id] = job
+        return True
+
+    def commit(self, job_id) -> int:
+        """第二阶段：提交，返回本pod的空闲GPU数"""
+        self.cross_shard_jobs[job_id] = self.reserved_jobs.pop(job_id)
+        return self.groups.total_available_gpus
+
+    def abort(self, job_id) -> int:
+        """第二阶段：放弃，归还reserve占用的GPU和端口"""
+        job = self.reserved_jobs.pop(job_id)
+        self.links.free_ports_for_job(job)
+        self.groups.free_gpu_for_job(job)
+        return self.groups.total_available_gpus
+
+    def get_results(self) -> Dict[str, int]:
+        return {result.name: count for result, count in self.simulator.results.items()}
+
+    def save(self, path: str) -> int:
+        """把本pod的状态写入检查点，两阶段提交进行中（有已reserve未提交的任务）时不能保存"""
+        assert not self.reserved_jobs
+        return save(path, self.links, self.groups, self.simulator)
+
+    @classmethod
+    def restore(
+        cls,
+        shard_id: int,
+        path: str,
+        alghrithm: PhysicalLinkeAllocatingAlthrighm,
+        placement: GpuPlacement = GpuPlacement.FIRST_FIT,
+    ) -> "PodShard":
+        """从save写的检查点恢复pod，跨pod任务占用的端口随Links一起恢复"""
+        checkpoint = load(path)
+        shard = cls.__new__(cls)
+        shard.shard_id = shard_id
+        shard.groups = checkpoint.groups
+        shard.links = checkpoint.links
+        shard.simulator = checkpoint.make_simulator([], alghrithm=alghrithm, placement=placement)
+        cross_shard_jobs = shard.links.get_ports_for_jobs()
+        # 跨pod任务由协调者通知结束，不在本pod的事件堆中
+        shard.simulator.events = [event for event in shard.simulator.events if event[2] not in cross_shard_jobs]
+        heapq.heapify(shard.simulator.events)
+        shard.local_jobs = {job.job_id: job for job in checkpoint.running_jobs if job not in cross_shard_jobs}
+        shard.reserved_jobs = {}
+        shard.cross_shard_jobs = {job.job_id: job for job in cross_shard_jobs}
+        return shard
+
+
+def run_shard_worker(connection, *args):
+    """子进程中的pod：依次执行 (方法名, 参数) 命令并返回结果，收到None时退出"""
+    shard = PodShard(*args)
+    connection.send(None)
+    while True:
+        command = connection.recv()
+        if command is None:
+            break
+        method, method_args = command
+        connection.send(getattr(shard, method)(*method_args))
+    connection.close()
+
+
+class ShardHandle:
+    """协调者访问一个pod的句柄：pod在独立的进程中（或调试时在本进程中），send之后用receive取结果"""
+
+    def __init__(self, *args, use_process: bool = True):
+        self.process = None
+        if use_process:
+            self.connection, child_connection = Pipe()
+            self.process = Process(target=run_shard_worker, args=(child_connection, *args), daemon=True)
+            self.process.start()
+        else:
+            self.shard = PodShard(*args)
+            self.result = None
+
+    def wait_ready(self):
+        if self.process is not None:
+            self.connection.recv()
+
+    def send(self, method: str, *args):
+        if self.process is not None:
+            self.connection.send((method, args))
+        else:
+            self.result = getattr(self.shard, method)(*args)
+
+    def receive(self):
+        if self.process is not None:
+            return self.connection.recv()
+        return self.result
+
+    def call(self, method: str, *args):
+        self.send(method, *args)
+        return self.receive()
+
+    def close(self):
+        if self.process is not None:
+            self.connection.send(None)
+            self.process.join()
+
+
+class ShardedSimulator:
+    """
+    按pod分片的调度仿真：group按编号连续地分成num_shards个pod，每个pod在自己的进程中
+    维护Groups和Links并调度放得进本pod的任务，不同pod并行；协调者处理跨pod的任务
+
+    每轮从等待队列前window个任务中，把放得进某个pod的任务分给空闲GPU最多的pod，
+    所有pod同时调度自己的一批；之后协调者依次处理跨pod的任务：读取相关pod的状态，
+    在全局编号上放置GPU、分配链路，再对涉及的pod两阶段提交（reserve，全部同意才commit，
+    否则abort）。
+
+    窗口内第一个放不进单个pod的任务按EASY回填预留GPU：根据运行中任务的结束时间算出
+    它最早可以启动的时刻，之后的任务只有在这个时刻前结束、或只占用预留之外的GPU时才会
+    启动，因此大的跨pod任务不会被后面不断到来的小任务饿死。
+    """
+
+    def __init__(
+        self,
+        jobs: Iterable[Job],
+        topology: Topology,
+        num_shards: int,
+        alghrithm: PhysicalLinkeAllocatingAlthrighm = PhysicalLinkeAllocatingAlthrighm.OPTIMIZE,
+        placement: GpuPlacement = GpuPlacement.FIRST_FIT,
+        window: int = 32,
+        use_processes: bool = True,
+    ):
+        assert topology.num_group % num_shards == 0
+        self.topology = topology
+        self.alghrithm = alghrithm
+        self.placement = placement
+        self.window = window
+        self.pod_size = topology.num_group // num_shards
+        pod_topology = topology._replace(num_group=self.pod_size)
+        self.shards = [
+            ShardHandle(shard_id, pod_topology, alghrithm, placement, use_process=use_processes)
+            for shard_id in range(num_shards)
+        ]
+        for shard in self.shards:
+            shard.wait_ready()
+        # 每个pod最近一次报告的空闲GPU数
+        self.free_gpus = [self.pod_size * topology.gpus_per_group] * num_shards
+        # 所有group的端口范围相同，全局编号上的交换机对索引只需建一次
+        self.switch_pair_index = SwitchPairIndex(
+            [get_port_ranges(topology.num_switch_per_group, topology.num_ocs, topology.num_spine)]
+            * topology.num_group
+        )
+        self.time = 0
+        self.arrivals: Iterator[Job] = iter(jobs)
+        self.next_arrival: Optional[Job] = next(self.arrivals, None)
+        self.pending = deque()
+        # 结束事件堆 [(end_time, 序号, job, 涉及的pod)]
+        self.events: List[Tuple[int, int, Job, Tuple[int, ...]]] = []
+        # {job: 提交序号}，各pod中以提交序号作为任务的键
+        self.job_keys: Dict[Job, int] = {}
+        self.num_submitted = 0
+        self.num_started = 0
+        self.num_finished = 0
+        self.num_rejected = 0
+        self.num_cross_shard = 0
+        # 跨pod任务两阶段提交中有pod不同意而放弃的次数
+        self.num_aborts = 0
+        self.cross_shard_results: Dict[AllocationResult, int] = {result: 0 for result in AllocationResult}
+        self.total_gpus = topology.num_group * topology.gpus_per_group
+        self.gpu_time = 0
+        self.wait_time = 0
+
+    def run(self) -> Dict:
+        """运行到所有任务结束，返回统计信息"""
+        while True:
+            self.submit()
+            self.schedule()
+            job = pop_unrunnable_job(self)
+            if job is not None:
+                del self.job_keys[job]
+                continue
+            if not self.events and self.next_arrival is None:
+                break
+            self.advance()
+        return self.get_stats()
+
+    def submit(self):
+        while self.next_arrival is not None and self.next_arrival.submit_time <= self.time:
+            self.job_keys[self.next_arrival] = self.num_submitted
+            self.pending.append(self.next_arrival)
+            self.num_submitted += 1
+            self.next_arrival = next(self.arrivals, None)
+
+    def schedule(self):
+        free_gpus = list(self.free_gpus)
+        batches: Dict[int, List[Job]] = {}
+        cross_shard_jobs = []
+        # (shadow time, 届时满足预留任务后仍空闲的GPU数)，窗口内还没有放不进单个pod的任务时为None
+        reservation = None
+        for job in islice(self.pending, self.window):
+            ends_in_time = False
+            if reservation is not None:
+                shadow_time, extra_gpus = reservation
+                ends_in_time = self.time + job.time <= shadow_time
+                if not ends_in_time and job.gpu_count > extra_gpus:
+                    continue
+            shard_id = max(range(len(self.shards)), key=lambda shard_id: free_gpus[shard_id])
+            if free_gpus[shard_id] >= job.gpu_count:
+                batches.setdefault(shard_id, []).append(job)
+                free_gpus[shard_id] -= job.gpu_count
+            elif reservation is None:
+                # 本轮能启动时shadow time就是现在，预留之外的GPU是放下它之后剩下的
+                reservation = self.get_reservation(job, sum(free_gpus), batches)
+                if sum(free_gpus) >= job.gpu_count:
+                    cross_shard_jobs.append(job)
+                continue
+            elif sum(free_gpus) >= job.gpu_count:
+                cross_shard_jobs.append(job)
+            else:
+                continue
+            if reservation is not None and not ends_in_time:
+                reservation = (shadow_time, extra_gpus - job.gpu_count)
+        # 各pod并行调度自己的一批
+        for shard_id, batch in batches.items():
+            self.shards[shard_id].send(
+                'schedule', self.time, [(self.job_keys[job], job.gpu_count, job.time) for job in batch]
+            )
+        started = set()
+        for shard_id, batch in batches.items():
+            started_ids, self.free_gpus[shard_id] = self.shards[shard_id].receive()
+            started_ids = set(started_ids)
+            for job in batch:
+                if self.job_keys[job] in started_ids:
+                    self.on_start(job, (shard_id,))
+                    started.add(job)
+        for job in cross_shard_jobs:
+            if self.start_cross_shard(job):
+                started.add(job)
+        if started:
+            self.pending = deque(job for job in self.pending if job not in started)
+
+    def get_reservation(self, head_job: Job, free_gpus: int, batches: Dict[int, List[Job]]) -> Tuple[int, int]:
+        """
+        计算head_job最早可以启动的时刻（shadow time）以及届时多出的GPU
+
+        Args:
+            free_gpus: 分出batches之后各pod空闲GPU数之和
+            batches: 本轮已经分给各pod的任务，按全部启动计算
+
+        Returns:
+            Tuple[int, int]: (shadow_time, 届时满足head_job后仍空闲的GPU数)
+        """
+        ends = [(end_time, job.gpu_count) for end_time, _, job, _ in self.events]
+        ends.extend((self.time + job.time, job.gpu_count) for batch in batches.values() for job in batch)
+        shadow_time = self.time
+        for end_time, gpu_count in sorted(ends):
+            if free_gpus >= head_job.gpu_count:
+                break
+            shadow_time = end_time
+            free_gpus += gpu_count
+        return shadow_time, free_gpus - head_job.gpu_count
+
+    def start_cross_shard(self, job: Job) -> bool:
+        """协调者放置一个跨pod任务并两阶段提交，返回是否启动"""
+        shard_ids = []
+        num_gpus = 0
+        for shard_id in sorted(range(len(self.shards)), key=lambda shard_id: -self.free_gpus[shard_id]):
+            shard_ids.append(shard_id)
+            num_gpus += self.free_gpus[shard_id]
+            if num_gpus >= job.gpu_count:
+                break
+        if num_gpus < job.gpu_count:
+            return False
+        shard_ids.sort()
+        # 第0阶段：读取相关pod的状态，在全局编号上放置GPU、分配链路
+        for shard_id in shard_ids:
+            self.shards[shard_id].send('read')
+        groups = Groups(self.topology.num_group, self.topology.gpus_per_group)
+        idle_links: List[Optional[List[bitarray]]] = [None] * self.topology.num_group
+        row_bytes = self.topology.num_ocs // 8
+        num_switch_per_group = self.topology.num_switch_per_group
+        for shard_id in range(len(self.shards)):
+            offset = shard_id * self.pod_size
+            if shard_id not in shard_ids:
+                for group_id in range(offset, offset + self.pod_size):
+                    groups.update_available_gpus(group_id, -self.topology.gpus_per_group)
+                continue
+            available_gpus, available_links, idle_bytes = self.shards[shard_id].receive()
+            for local_group_id in range(self.pod_size):
+                group_id = offset + local_group_id
+                groups.update_available_gpus(group_id, available_gpus[local_group_id] - self.topology.gpus_per_group)
+                groups.get_group(group_id)['available_links'] = available_links[local_group_id]
+                rows = []
+                for switch_id in range(num_switch_per_group):
+                    start = (local_group_id * num_switch_per_group + switch_id) * row_bytes
+                    row = bitarray(endian='big')
+                    row.frombytes(idle_bytes[start:start + row_bytes])
+                    rows.append(row)
+                idle_links[group_id] = rows
+        gpu_allocation = {}
+        link_demand = gpu_allocate(job.gpu_count, groups, gpu_allocation, self.placement)
+        if not gpu_allocation:
+            return False
+        used_links = []
+        result = AllocationResult.MEETMAX
+        if link_demand:
+            result = physical_link_allocate(idle_links, link_demand, used_links, self.alghrithm, self.switch_pair_index)
+        if result == AllocationResult.FAILURE:
+            self.cross_shard_results[result] += 1
+            return False
+
+        # 第一阶段：每个涉及的pod校验并占用自己的GPU和端口
+        ports = link_ports(to_link_array(used_links)) if used_links else None
+        reservations = {}
+        for shard_id in shard_ids:
+            offset = shard_id * self.pod_size
+            shard_allocation = {
+                group_id - offset: gpus
+                for group_id, gpus in gpu_allocation.items()
+                if offset <= group_id < offset + self.pod_size
+            }
+            shard_ports = np.zeros(0, dtype=PORT_DTYPE)
+            if ports is not None:
+                in_shard = (ports['group'] >= offset) & (ports['group'] < offset + self.pod_size)
+                shard_ports = ports[in_shard].copy()
+                shard_ports['group'] -= offset
+            if shard_allocation or len(shard_ports) > 0:
+                reservations[shard_id] = (shard_allocation, shard_ports)
+        for shard_id, (shard_allocation, shard_ports) in reservations.items():
+            self.shards[shard_id].send(
+                'reserve', self.job_keys[job], job.gpu_count, job.time, shard_allocation, shard_ports
+            )
+        votes = {shard_id: self.shards[shard_id].receive() for shard_id in reservations}
+
+        # 第二阶段：全部同意才提交，否则让已占用的pod放弃
+        decision = 'commit' if all(votes.values()) else 'abort'
+        decided = [shard_id for shard_id, vote in votes.items() if vote]
+        for shard_id in decided:
+            self.shards[shard_id].send(decision, self.job_keys[job])
+        for shard_id in decided:
+            self.free_gpus[shard_id] = self.shards[shard_id].receive()
+        if decision == 'abort':
+            self.num_aborts += 1
+            return False
+        self.num_cross_shard += 1
+        self.cross_shard_results[result] += 1
+        self.on_start(job, tuple(reservations))
+        return True
+
+    def on_start(self, job: Job, shard_ids: Tuple[int, ...]):
+        job.start(self.time)
+        heapq.heappush(self.events, (job.end_time, self.num_started, job, shard_ids))
+        self.num_started += 1
+        self.gpu_time += job.gpu_count * job.time
+        self.wait_time += self.time - job.submit_time
+
+    def advance(self):
+        """跳到下一个事件，通知各pod结束该时刻结束的任务"""
+        next_times = []
+        if self.events:
+            next_times.append(self.events[0][0])
+        if self.next_arrival is not None:
+            next_times.append(self.next_arrival.submit_time)
+        self.time = max(self.time, min(next_times))
+        finished: Dict[int, List] = {}
+        while self.events and self.events[0][0] == self.time:
+            _, _, job, shard_ids = heapq.heappop(self.events)
+            job.end(self.time)
+            self.num_finished += 1
+            job_key = self.job_keys.pop(job)
+            for shard_id in shard_ids:
+                finished.setdefault(shard_id, []).append(job_key)
+        for shard_id, job_ids in finished.items():
+            self.shards[shard_id].send('finish', job_ids)
+        for shard_id in finished:
+            self.free_gpus[shard_id] = self.shards[shard_id].receive()
+
+    def get_stats(self) -> Dict:
+        results = {result.name: count for result, count in self.cross_shard_results.items()}
+        for shard in self.shards:
+            for name, count in shard.call('get_results').items():
+                results[name] += count
+        makespan = self.time
+        return {
+            'makespan': makespan,
+            'started_jobs': self.num_started,
+            'finished_jobs': self.num_finished,
+            'rejected_jobs': self.num_rejected,
+            'cross_shard_jobs': self.num_cross_shard,
+            'cross_shard_aborts': self.num_aborts,
+            'utilization': self.gpu_time / (self.total_gpus * makespan) if makespan > 0 else 0.0,
+            'mean_wait_time': self.wait_time / self.num_started if self.num_started > 0 else 0.0,
+            'results': results,
+        }
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+
+def compare_scaling(
+    topology: Topology, shard_counts: List[int], num_jobs: int = 2000, seed: int = 0, submit_interval: int = 0
+) -> Dict[str, Dict]:
+    """
+    同一任务序列分别用单一状态的Simulator和不同分片数的ShardedSimulator调度，
+    比较墙钟时间与每秒启动的任务数（不含建立拓扑的时间）
+    """
+    report = {}
+    groups, links = topology.build()
+    simulator = Simulator(generate_jobs(num_jobs, seed, submit_interval), links, groups)
+    start = time.perf_counter()
+    stats = simulator.run()
+    report['single'] = {**stats, 'wall_s': time.perf_counter() - start}
+    for num_shards in shard_counts:
+        sharded = ShardedSimulator(generate_jobs(num_jobs, seed, submit_interval), topology, num_shards)
+        start = time.perf_counter()
+        stats = sharded.run()
+        report[f'{num_shards}_shards'] = {**stats, 'wall_s': time.perf_counter() - start}
+        sharded.close()
+    for stats in report.values():
+        stats['jobs_per_second'] = stats['started_jobs'] / stats['wall_s'] if stats['wall_s'] > 0 else 0.0
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="scheduling throughput of sharded pods against the single-state path")
+    parser.add_argument('--topology', type=parse_topology, default=Topology(256, 16, 512))
+    parser.add_argument('--shards', nargs='+', type=int, default=[1, 2, 4, 8])
+    parser.add_argument('--num-jobs', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--submit-interval', type=int, default=0)
+    args = parser.parse_args()
+
+    report = compare_scaling(args.topology, args.shards, args.num_jobs, args.seed, args.submit_interval)
+    for name, stats in report.items():
+        print(
+            f"{name}: {stats['wall_s']:.2f}s, {stats['jobs_per_second']:.0f} jobs/s, "
+            f"started {stats['started_jobs']}, rejected {stats['rejected_jobs']}, "
+            f"cross-shard {stats.get('cross_shard_jobs', 0)}, utilization {stats['utilization']:.3f}, "
+            f"results {stats['results']}"
+        )
@@ -0,0 +1,415 @@
+import heapq
+from collections import deque
+from enum import IntEnum
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from admission import check_link_demand, get_result_bound, has_enough_gpus
+from defrag import defrag
+from gpu_allocate import GpuPlacement, gpu_allocate
+from groups import Groups
+from jobs import Job
+from links import LinkTransaction, Links
+from placement_search import PlacementSearch
+from preempt import PreemptionPlan, PreemptionPlanner
+from upgrade import LinkUpgrader
+from physical_link_allocate import (
+    AllocationResult,
+    PhysicalLinkeAllocatingAlthrighm,
+    physical_link_allocate,
+)
+
+
+class SchedulingPolicy(IntEnum):
+    FIFO = 0  # 队首任务放不下就停止
+    BACKFILL = 1  # EASY回填：为队首任务预留，其后的任务在不推迟队首的前提下先运行
+
+
+def pop_unrunnable_job(scheduler) -> Optional[Job]:
+    """
+    调度后仍有任务等待、却没有运行中的任务时，集群完全空闲也放不下队首任务，
+    该任务永远无法运行：移出等待队列并计入拒绝数，否则返回None
+
+    Args:
+        scheduler: 有pending、events和num_rejected的调度器，如Simulator、ShardedSimulator
+    """
+    if not scheduler.pending or scheduler.events:
+        return None
+    scheduler.num_rejected += 1
+    return scheduler.pending.popleft()
+
+
+class Simulator:
+    """事件驱动的调度仿真：时间直接跳到下一个任务结束事件，开销只与事件数有关"""
+
+    def __init__(
+        self,
+        jobs: Iterable[Job],
+        links: Links,
+        group: Groups,
+        alghrithm: PhysicalLinkeAllocatingAlthrighm = PhysicalLinkeAllocatingAlthrighm.OPTIMIZE,
+        verbose: bool = False,
+        policy: SchedulingPolicy = SchedulingPolicy.FIFO,
+        window: int = 32,
+        placement: GpuPlacement = GpuPlacement.FIRST_FIT,
+        placement_search: Optional[PlacementSearch] = None,
+        defrag_budget: int = 0,
+        upgrade_links_per_event: int = 0,
+        preemption: bool = False,
+    ):
+        self.links = links
+        self.group = group
+        self.alghrithm = alghrithm
+        self.verbose = verbose
+        self.policy = policy
+        self.window = window
+        self.placement = placement
+        # 设置时用推测式放置搜索代替单一的GPU放置策略
+        self.placement_search = placement_search
+        # 一轮调度中出现链路分配失败时，在下一轮前最多迁移多少条链路，0表示不整理
+        self.defrag_budget = defrag_budget
+        self.num_link_failures = 0
+        # 被准入检查直接拒绝（没有试分配链路）的次数
+        self.num_precheck_rejections = 0
+        # 每个组在被拒绝的任务中成为瓶颈的次数（组的空闲链路不足，或它所在的组对可分配链路不足）
+        self.precheck_bottlenecks_for_group = [0] * group.num_groups
+        self.num_reconfigurations = 0
+        self.defrag_capacity_gained = 0
+        # 以MEETMIN启动的任务在其它任务释放链路时补链路，每次释放最多补多少条，0表示不补
+        self.upgrader = LinkUpgrader(links, upgrade_links_per_event) if upgrade_links_per_event > 0 else None
+        # 等待窗口内的任务放不下时抢占优先级更低的运行中任务，被抢占的任务回到队首重新排队
+        self.preemption_planner = PreemptionPlanner(links, group, alghrithm, placement) if preemption else None
+        self.num_preemptions = 0
+        # 被抢占任务已运行、需要重新运行的GPU时间
+        self.preempted_gpu_time = 0
+        self.time = 0
+        # 任务按提交时间顺序惰性读取，内存中只保留已提交未启动的任务
+        self.arrivals: Iterator[Job] = iter(jobs)
+        self.next_arrival: Optional[Job] = next(self.arrivals, None)
+        self.pending = deque()
+        # 已从任务序列中提交的任务数，从检查点恢复时跳过这些任务
+        self.num_submitted = 0
+        # 结束事件堆 [(end_time, 序号, job)]
+        self.events: List[Tuple[int, int, Job]] = []
+        self.num_started = 0
+        self.num_finished = 0
+        self.num_rejected = 0
+        # 至少尝试过一次但未能启动的任务，用于统计首次尝试即启动的比例
+        self.retried_jobs = set()
+        self.num_first_attempt = 0
+        # 启动的任务按MEETMAX/MEETMIN计数，FAILURE是链路分配失败（含准入检查拒绝）的次数
+        self.results: Dict[AllocationResult, int] = {result: 0 for result in AllocationResult}
+        self.total_gpus = sum(
+            group.get_group(group_id)['available_gpus'] for group_id in range(group.num_groups)
+        )
+        self.gpu_time = 0
+        self.wait_time = 0
+
+    def run(self, until: Optional[int] = None) -> Dict:
+        """
+        运行到所有任务结束，返回统计信息
+
+        Args:
+            until: 给出时在仿真时间达到until后停在下一个事件处（该时刻结束的任务已释放，
+                新任务尚未提交和调度），再次调用run()从这里继续，结果与不间断运行相同
+        """
+        while True:
+            self.submit()
+            num_link_failures = self.num_link_failures
+            self.schedule()
+            if self.defrag_budget > 0 and self.pending and self.num_link_failures > num_link_failures:
+                if self.defrag():
+                    self.schedule()
+            if self.reject_unrunnable() is not None:
+                continue
+            if not self.events and self.next_arrival is None:
+                break
+            self.advance()
+            if until is not None and self.time >= until:
+                break
+        return self.get_stats()
+
+    def reject_unrunnable(self) -> Optional[Job]:
+        """拒绝永远无法运行的队首任务并返回它，见pop_unrunnable_job"""
+        job = pop_unrunnable_job(self)
+        if job is not None:
+            self.retried_jobs.discard(job)
+        return job
+
+    def submit(self):
+        """把提交时间已到的任务加入等待队列"""
+        while self.next_arrival is not None and self.next_arrival.submit_time <= self.time:
+            self.pending.append(self.next_arrival)
+            self.num_submitted += 1
+            self.next_arrival = next(self.arrivals, None)
+
+    def schedule(self):
+        """按调度策略启动等待中的任务"""
+        if self.policy == SchedulingPolicy.BACKFILL:
+            window = [self.pending.popleft() for _ in range(min(self.window, len(self.pending)))]
+            started = set(self.schedule_batch(window))
+            self.pending.extendleft(reversed([job for job in window if job not in started]))
+        else:
+            # FIFO：按顺序启动，直到队首任务放不下
+            while self.pending and self.try_start(self.pending[0]):
+                self.pending.popleft()
+        if self.preemption_planner is not None and self.pending:
+            self.preempt()
+
+    def preempt(self):
+        """
+        按优先级从高到低为等待窗口内的任务尝试抢占
+
+        只有优先级高于某个运行中任务、且不抢占就放不下的任务才会尝试；
+        不抢占也能放下的任务仍按调度策略排队，FIFO的顺序不变。
+        """
+        for job in sorted(islice(self.pending, self.window), key=lambda job: -job.priority):
+            # 运行中任务的优先级就是规划器索引的键
+            lowest_priority = min(self.preemption_planner.running_by_cost, default=None)
+            if lowest_priority is None or job.priority <= lowest_priority:
+                break
+            plan = self.preemption_planner.plan(job, self.time)
+            if plan is not None:
+                self.apply_preemption(plan)
+
+    def apply_preemption(self, plan: PreemptionPlan):
+        """结束计划中的任务并把它们放回队首，然后按计划试分配的GPU和链路启动任务"""
+        victims = set(plan.victims)
+        self.events = [event for event in self.events if event[2] not in victims]
+        heapq.heapify(self.events)
+        freed_links = []
+        for victim in plan.victims:
+            if self.upgrader is not None:
+                self.upgrader.unregister(victim)
+                freed_links.append(self.links.get_links_for_job(victim))
+            # 先不为缺链路的任务补链路，保证释放的端口与试分配时一致
+            self.links.free_link_for_job(victim)
+            self.group.free_gpu_for_job(victim)
+            self.gpu_time -= victim.gpu_count * (victim.end_time - self.time)
+            self.preempted_gpu_time += victim.gpu_count * (self.time - victim.start_time)
+            victim.is_running = False
+            # 重新启动时会再计入 启动时刻 - submit_time，先减去提交到被抢占的这一段，
+            # 使wait_time只累计任务实际排队的时间
+            self.wait_time -= self.time - victim.submit_time
+            self.retried_jobs.add(victim)
+        self.num_preemptions += len(plan.victims)
+        self.preemption_planner.on_preempt(plan)
+        job = plan.job
+        for group_id, gpus in plan.gpu_allocation.items():
+            self.group.update_available_gpus(group_id, -gpus)
+        self.group.assign_gpu_for_job(job, plan.gpu_allocation)
+        self.links.allocate_link_for_job(job, plan.used_links)
+        self.start(job, plan.result, plan.link_demand, plan.used_links)
+        self.pending.remove(job)
+        self.pending.extendleft(reversed(sorted(plan.victims, key=lambda victim: victim.submit_time)))
+        if freed_links:
+            self.upgrader.on_release(np.concatenate(freed_links))
+
+    def schedule_batch(self, window: List[Job]) -> List[Job]:
+        """
+        一次尝试放置一个窗口内的任务，整批共用一个链路事务
+
+        先按顺序启动能放下的任务；队首任务放不下时，根据运行中任务的结束时间
+        为它预留GPU（EASY回填），之后的任务只有在预留时刻前结束、或只占用
+        预留之外的GPU时才会被提前启动，因此队首任务不会被饿死。
+
+        Args:
+            window: 按提交顺序排列的等待任务
+
+        Returns:
+            List[Job]: 本轮启动的任务
+        """
+        transaction = self.links.begin()
+        started = []
+        index = 0
+        while index < len(window) and self.try_start(window[index], transaction):
+            started.append(window[index])
+            index += 1
+        if index < len(window) - 1:
+            shadow_time, extra_gpus = self.get_reservation(window[index])
+            for job in window[index + 1:]:
+                ends_in_time = self.time + job.time <= shadow_time
+                if not ends_in_time and job.gpu_count > extra_gpus:
+                    continue
+                if self.try_start(job, transaction):
+                    started.append(job)
+                    if not ends_in_time:
+                        extra_gpus -= job.gpu_count
+        transaction.commit()
+        return started
+
+    def get_reservation(self, head_job: Job) -> Tuple[int, int]:
+        """
+        计算队首任务最早可以启动的时刻（shadow time）以及届时多出的GPU
+
+        Returns:
+            Tuple[int, int]: (shadow_time, 届时满足队首任务后仍空闲的GPU数)
+        """
+        free_gpus = self.group.total_available_gpus
+        shadow_time = self.time
+        for end_time, _, job in sorted(self.events):
+            if free_gpus >= head_job.gpu_count:
+                break
+            shadow_time = end_time
+            free_gpus += job.gpu_count
+        return shadow_time, free_gpus - head_job.gpu_count
+
+    def defrag(self) -> bool:
+        """整理空闲OCS端口，返回是否做了迁移"""
+        report = defrag(self.links, self.defrag_budget).get_report()
+        self.num_reconfigurations += report['reconfigurations']
+        self.defrag_capacity_gained += report['capacity_gained']
+        return report['reconfigurations'] > 0
+
+    def advance(self):
+        """跳到下一个事件（任务结束或任务提交），释放该时刻结束的所有任务"""
+        next_times = []
+        if self.events:
+            next_times.append(self.events[0][0])
+        if self.next_arrival is not None:
+            next_times.append(self.next_arrival.submit_time)
+        self.time = max(self.time, min(next_times))
+        while self.events and self.events[0][0] == self.time:
+            _, _, job = heapq.heappop(self.events)
+            self.finish(job)
+
+    def finish(self, job: Job):
+        """在结束事件处结束任务"""
+        self.release(job)
+        job.end(self.time)
+        self.num_finished += 1
+
+    def complete(self, job: Job):
+        """任务由外部通知结束（如守护进程收到完成消息），不必等到预计的结束时刻"""
+        self.events = [event for event in self.events if event[2] is not job]
+        heapq.heapify(self.events)
+        self.release(job)
+        job.is_running = False
+        self.num_finished += 1
+
+    def release(self, job: Job):
+        """释放任务占用的链路和GPU，并用释放的端口为链路不足的任务补链路"""
+        if self.upgrader is not None:
+            self.upgrader.unregister(job)
+            freed_links = self.links.get_links_for_job(job)
+        self.links.free_link_for_job(job)
+        if self.upgrader is not None:
+            self.upgrader.on_release(freed_links)
+        self.group.free_gpu_for_job(job)
+        if self.preemption_planner is not None:
+            self.preemption_planner.on_finish(job)
+
+    def try_start(self, job: Job, transaction: Optional[LinkTransaction] = None) -> bool:
+        """
+        尝试在当前时刻启动任务：先分配GPU，再在链路事务中分配物理链路
+
+        Args:
+            job: 要启动的任务
+            transaction: 可选的批量事务，任务的链路先提交到该事务，由调用方统一提交
+
+        Returns:
+            bool: 是否启动成功，失败时GPU和链路都已回滚
+        """
+        if self.placement_search is not None:
+            candidate = self.placement_search.search(job.gpu_count, transaction)
+            if candidate is None:
+                self.retried_jobs.add(job)
+                return False
+            candidate.commit(job, self.group)
+            allocation_result = candidate.result
+            link_demand, used_links = candidate.link_demand, candidate.used_links
+        else:
+            if not has_enough_gpus(self.group, job.gpu_count):
+                self.retried_jobs.add(job)
+                return False
+            gpu_allocation = {}
+            link_demand = gpu_allocate(job.gpu_count, self.group, gpu_allocation, self.placement)
+            if not gpu_allocation:
+                self.retried_jobs.add(job)
+                return False
+            used_links = []
+            transaction = self.links.begin() if transaction is None else transaction.begin()
+            allocation_result = AllocationResult.MEETMAX
+            if link_demand and get_result_bound(self.links, link_demand) == AllocationResult.FAILURE:
+                # 准入检查：可分配链路数的上界已经不够，不必试分配
+                allocation_result = AllocationResult.FAILURE
+                self.num_precheck_rejections += 1
+                self.record_precheck_rejection(job, link_demand)
+            elif link_demand:
+                allocation_result = physical_link_allocate(
+                    transaction,
+                    link_demand,
+                    used_links,
+                    self.alghrithm,
+                    self.links.get_switch_pair_index(),
+                )
+            if allocation_result == AllocationResult.FAILURE:
+                transaction.rollback()
+                self.group.release_gpus(gpu_allocation)
+                self.retried_jobs.add(job)
+                self.num_link_failures += 1
+                self.results[AllocationResult.FAILURE] += 1
+                return False
+            transaction.commit(job, used_links)
+            self.group.assign_gpu_for_job(job, gpu_allocation)
+        self.start(job, allocation_result, link_demand, used_links)
+        return True
+
+    def record_precheck_rejection(self, job: Job, link_demand):
+        """只在拒绝时列出瓶颈，通过检查的任务仍然只做提前返回的上界计算"""
+        report = check_link_demand(self.links, link_demand)
+        bottleneck_groups = {group_id for group_id, _, _ in report.bottleneck_groups}
+        for group_id_1, group_id_2, _, _ in report.bottleneck_pairs:
+            bottleneck_groups.update((group_id_1, group_id_2))
+        for group_id in bottleneck_groups:
+            self.precheck_bottlenecks_for_group[group_id] += 1
+        if self.verbose:
+            print(f"Job with {job.gpu_count} GPUs rejected by the link pre-check at time {self.time}: {report.to_dict()}")
+
+    def start(self, job: Job, allocation_result: AllocationResult, link_demand, used_links):
+        """GPU和链路已提交，记录任务启动"""
+        if self.upgrader is not None and allocation_result == AllocationResult.MEETMIN:
+            self.upgrader.register(job, link_demand, used_links)
+        if job in self.retried_jobs:
+            self.retried_jobs.remove(job)
+        else:
+            self.num_first_attempt += 1
+        self.results[allocation_result] += 1
+        job.start(self.time)
+        heapq.heappush(self.events, (job.end_time, self.num_started, job))
+        if self.preemption_planner is not None:
+            self.preemption_planner.on_start(job)
+        self.num_started += 1
+        self.gpu_time += job.gpu_count * job.time
+        self.wait_time += self.time - job.submit_time
+        if self.verbose:
+            print(
+                f"Job {self.num_started - 1} allocated at time {self.time}, remaining jobs: {len(self.pending) - 1}"
+            )
+
+    def get_stats(self) -> Dict:
+        """汇总仿真结果"""
+        makespan = self.time
+        return {
+            'makespan': makespan,
+            'started_jobs': self.num_started,
+            'finished_jobs': self.num_finished,
+            'rejected_jobs': self.num_rejected,
+            'utilization': self.gpu_time / (self.total_gpus * makespan) if makespan > 0 else 0.0,
+            'mean_wait_time': self.wait_time / self.num_started if self.num_started > 0 else 0.0,
+            'link_failures': self.num_link_failures,
+            'precheck_rejections': self.num_precheck_rejections,
+            'precheck_bottleneck_groups': {
+                group_id: count for group_id, count in enumerate(self.precheck_bottlenecks_for_group) if count > 0
+            },
+            'reconfigurations': self.num_reconfigurations,
+            'defrag_capacity_gained': self.defrag_capacity_gained,
+            'links_upgraded': self.upgrader.num_links_added if self.upgrader is not None else 0,
+            'jobs_upgraded_to_max': self.upgrader.num_jobs_completed if self.upgrader is not None else 0,
+            'preemptions': self.num_preemptions,
+            'preempted_gpu_time': self.preempted_gpu_time,
+            'first_attempt_rate': self.num_first_attempt / self.num_started if self.num_started > 0 else 0.0,
+            'results': {result.name: count for result, count in self.results.items()},
+        }
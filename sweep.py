@@ -0,0 +1,175 @@
+import argparse
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+from groups import Groups
+from jobs import generate_jobs
+from links import Links
+from physical_link_allocate import AllocationResult, PhysicalLinkeAllocatingAlthrighm
+from simulator import SchedulingPolicy, Simulator
+
+
+class Topology(NamedTuple):
+    num_group: int = 64
+    num_switch_per_group: int = 16
+    num_ocs: int = 512
+    num_spine: int = 4
+    gpus_per_group: int = 2048
+
+    def build(self):
+        """按拓扑参数创建空闲的 (Groups, Links)"""
+        groups = Groups(self.num_group, self.gpus_per_group)
+        links = Links(
+            groups,
+            num_group=self.num_group,
+            num_switch_per_group=self.num_switch_per_group,
+            num_ocs=self.num_ocs,
+            num_spine=self.num_spine,
+        )
+        return groups, links
+
+
+class SweepCase(NamedTuple):
+    seed: int
+    alghrithm: PhysicalLinkeAllocatingAlthrighm = PhysicalLinkeAllocatingAlthrighm.OPTIMIZE
+    topology: Topology = Topology()
+    num_jobs: int = 200
+    submit_interval: int = 0
+    policy: SchedulingPolicy = SchedulingPolicy.FIFO
+
+
+def run_case(case: SweepCase) -> Dict:
+    """
+    运行一次独立的仿真
+
+    所有状态都在函数内由case构造，任务序列只由seed决定，
+    因此同一个case在任何进程中运行的结果都相同。
+    """
+    groups, links = case.topology.build()
+    jobs = generate_jobs(case.num_jobs, case.seed, case.submit_interval)
+    stats = Simulator(jobs, links, groups, case.alghrithm, policy=case.policy).run()
+    stats['case'] = case
+    return stats
+
+
+def make_cases(
+    seeds: Iterable[int],
+    alghrithms: Iterable[PhysicalLinkeAllocatingAlthrighm] = (PhysicalLinkeAllocatingAlthrighm.OPTIMIZE,),
+    topologies: Iterable[Topology] = (Topology(),),
+    **kwargs,
+) -> List[SweepCase]:
+    """seed、算法和拓扑的笛卡尔积，其余参数（num_jobs等）所有case相同"""
+    return [
+        SweepCase(seed, alghrithm, topology, **kwargs)
+        for topology, alghrithm, seed in itertools.product(topologies, alghrithms, seeds)
+    ]
+
+
+def run_sweep(cases: List[SweepCase], max_workers: Optional[int] = None) -> List[Dict]:
+    """
+    在进程池中并行运行所有case，返回结果的顺序与cases一致
+
+    Args:
+        cases: 要运行的仿真
+        max_workers: 进程数，默认为CPU核数；为1时在当前进程中串行运行
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if max_workers == 1:
+        return [run_case(case) for case in cases]
+    # 每个case的耗时相近，按块分发减少进程间通信
+    chunksize = max(1, len(cases) // (4 * max_workers))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(run_case, cases, chunksize=chunksize))
+
+
+def aggregate(results: List[Dict]) -> Dict:
+    """
+    按 (拓扑, 算法) 汇总多个seed的结果
+
+    Returns:
+        Dict: {(topology, alghrithm): {runs, utilization的平均/最小/最大值, makespan平均值,
+            各分配结果总数（FAILURE是链路分配失败的尝试次数）}}
+    """
+    report = {}
+    for stats in results:
+        case = stats['case']
+        key = (case.topology, case.alghrithm)
+        entry = report.setdefault(
+            key,
+            {
+                'runs': 0,
+                'utilization': [],
+                'makespan': [],
+                'rejected_jobs': 0,
+                'results': {result.name: 0 for result in AllocationResult},
+            },
+        )
+        entry['runs'] += 1
+        entry['utilization'].append(stats['utilization'])
+        entry['makespan'].append(stats['makespan'])
+        entry['rejected_jobs'] += stats['rejected_jobs']
+        for name, count in stats['results'].items():
+            entry['results'][name] += count
+    for entry in report.values():
+        utilization = entry.pop('utilization')
+        makespan = entry.pop('makespan')
+        entry['mean_utilization'] = sum(utilization) / len(utilization)
+        entry['min_utilization'] = min(utilization)
+        entry['max_utilization'] = max(utilization)
+        entry['mean_makespan'] = sum(makespan) / len(makespan)
+    return report
+
+
+def print_report(report: Dict):
+    for (topology, alghrithm), entry in report.items():
+        print(
+            f"groups {topology.num_group} switches {topology.num_switch_per_group} "
+            f"ocs {topology.num_ocs} spines {topology.num_spine} gpus {topology.gpus_per_group} | "
+            f"{alghrithm.name}: runs {entry['runs']}, "
+            f"utilization {entry['mean_utilization']:.4f} "
+            f"[{entry['min_utilization']:.4f}, {entry['max_utilization']:.4f}], "
+            f"makespan {entry['mean_makespan']:.1f}, "
+            + ", ".join(f"{name} {count}" for name, count in entry['results'].items())
+            + f", rejected {entry['rejected_jobs']}"
+        )
+
+
+def parse_topology(text: str) -> Topology:
+    """"64x16x512x4x2048" -> Topology，可以只给前几项"""
+    return Topology(*(int(value) for value in text.split('x')))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="parallel multi-seed simulation sweep")
+    parser.add_argument('--seeds', type=int, default=8, help="run seeds 0..N-1")
+    parser.add_argument(
+        '--alghrithms',
+        nargs='+',
+        default=['OPTIMIZE'],
+        choices=[alghrithm.name for alghrithm in PhysicalLinkeAllocatingAlthrighm],
+    )
+    parser.add_argument(
+        '--topologies',
+        nargs='+',
+        type=parse_topology,
+        default=[Topology()],
+        help="num_group x num_switch_per_group x num_ocs x num_spine x gpus_per_group",
+    )
+    parser.add_argument('--num-jobs', type=int, default=200)
+    parser.add_argument('--submit-interval', type=int, default=0)
+    parser.add_argument('--policy', default='FIFO', choices=[policy.name for policy in SchedulingPolicy])
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    cases = make_cases(
+        range(args.seeds),
+        [PhysicalLinkeAllocatingAlthrighm[name] for name in args.alghrithms],
+        args.topologies,
+        num_jobs=args.num_jobs,
+        submit_interval=args.submit_interval,
+        policy=SchedulingPolicy[args.policy],
+    )
+    print_report(aggregate(run_sweep(cases, args.workers)))
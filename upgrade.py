@@ -0,0 +1,131 @@
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from jobs import Job
+from links import Links, find_idle_switch
+
+
+class LinkUpgrader:
+    """
+    增量带宽升级：记录以MEETMIN启动、链路数低于最佳值的任务，
+    每次有任务释放链路时，只用刚释放的端口为这些任务补链路，不重新分配
+
+    按任务优先级从高到低（同优先级按启动先后）补，每次释放最多补max_links_per_event条。
+    """
+
+    def __init__(self, links: Links, max_links_per_event: int = 256):
+        self.links = links
+        self.max_links_per_event = max_links_per_event
+        # {job: {(group_id_1, group_id_2): 还差的链路数}}，按启动顺序
+        self.missing_links: Dict[Job, Dict[Tuple[int, int], int]] = {}
+        self.num_links_added = 0
+        self.num_jobs_completed = 0
+
+    def register(self, job: Job, link_demand: List[Tuple[int, int, int, int]], used_links):
+        """
+        任务启动后登记缺少的链路
+
+        Args:
+            link_demand: 任务的链路需求 [(group_id_1, group_id_2, min_links, max_links), ...]
+            used_links: 实际分配到的链路，分配器先为每对组分配min_links再追加max_links，
+                因此每对组的目标是 min_links + max_links
+        """
+        granted = {}
+        for src_group_id, _, dst_group_id, _, _ in used_links:
+            granted[(src_group_id, dst_group_id)] = granted.get((src_group_id, dst_group_id), 0) + 1
+        missing = {}
+        for group_id_1, group_id_2, min_demand, max_demand in link_demand:
+            num_missing = min_demand + max_demand - granted.get((group_id_1, group_id_2), 0)
+            if num_missing > 0:
+                missing[(group_id_1, group_id_2)] = num_missing
+        if missing:
+            self.missing_links[job] = missing
+
+    def unregister(self, job: Job):
+        self.missing_links.pop(job, None)
+
+    def on_release(self, freed_links: np.ndarray) -> int:
+        """
+        在链路释放之后调用，用这些端口为缺链路的任务补链路
+
+        Args:
+            freed_links: 刚释放的链路（LINK_DTYPE数组），它们的端口此时已空闲
+
+        Returns:
+            int: 本次补上的链路数
+        """
+        if not self.missing_links or len(freed_links) == 0:
+            return 0
+        # {group_id: (switch_ids, ocs_ids, 是否仍空闲)} 刚释放的端口
+        group_ids = np.concatenate((freed_links['src_group'], freed_links['dst_group'])).astype(np.int64)
+        switch_ids = np.concatenate((freed_links['src_switch'], freed_links['dst_switch'])).astype(np.int64)
+        ocs_ids = np.concatenate((freed_links['ocs'], freed_links['ocs'])).astype(np.int64)
+        freed_ports = {}
+        for group_id in np.unique(group_ids).tolist():
+            in_group = group_ids == group_id
+            freed_ports[group_id] = (switch_ids[in_group], ocs_ids[in_group], np.ones(in_group.sum(), dtype=bool))
+        candidates = sorted(
+            (job for job, missing in self.missing_links.items()
+             if any(group_id in freed_ports for pair in missing for group_id in pair)),
+            key=lambda job: -job.priority,
+        )
+        # 各group在每个ocs上的空闲端口数，补链路时在本地扣减
+        idle_ports = {}
+        # 在事务中试分配，最后按任务提交到Links
+        transaction = self.links.begin()
+        new_links_for_job = {}
+        budget = self.max_links_per_event
+        for job in candidates:
+            missing = self.missing_links[job]
+            new_links = new_links_for_job.setdefault(job, [])
+            for (group_id_1, group_id_2), num_missing in list(missing.items()):
+                for group_id, other_group_id in ((group_id_1, group_id_2), (group_id_2, group_id_1)):
+                    if group_id not in freed_ports or num_missing == 0 or budget == 0:
+                        continue
+                    freed_switch_ids, freed_ocs_ids, still_idle = freed_ports[group_id]
+                    for group in (group_id, other_group_id):
+                        if group not in idle_ports:
+                            idle_ports[group] = self.links.get_num_idle_ports_for_group(group)
+                    # 另一端在同一ocs上还有空闲端口的已释放端口
+                    usable = still_idle & (idle_ports[other_group_id][freed_ocs_ids] > 0)
+                    for port_index in np.flatnonzero(usable).tolist():
+                        ocs_id = int(freed_ocs_ids[port_index])
+                        if idle_ports[other_group_id][ocs_id] == 0:
+                            continue
+                        switch_id = int(freed_switch_ids[port_index])
+                        if not transaction.peek_row(group_id, switch_id)[ocs_id]:
+                            # 已被别的任务从另一端占用
+                            still_idle[port_index] = False
+                            continue
+                        other_switch_id = find_idle_switch(transaction, other_group_id, ocs_id)
+                        transaction.get_row(group_id, switch_id)[ocs_id] = 0
+                        transaction.get_row(other_group_id, other_switch_id)[ocs_id] = 0
+                        still_idle[port_index] = False
+                        idle_ports[group_id][ocs_id] -= 1
+                        idle_ports[other_group_id][ocs_id] -= 1
+                        if group_id == group_id_1:
+                            new_links.append((group_id_1, switch_id, group_id_2, other_switch_id, ocs_id))
+                        else:
+                            new_links.append((group_id_1, other_switch_id, group_id_2, switch_id, ocs_id))
+                        num_missing -= 1
+                        budget -= 1
+                        if num_missing == 0 or budget == 0:
+                            break
+                if num_missing == 0:
+                    del missing[(group_id_1, group_id_2)]
+                else:
+                    missing[(group_id_1, group_id_2)] = num_missing
+            if not missing:
+                del self.missing_links[job]
+                self.num_jobs_completed += 1
+            if budget == 0:
+                break
+        transaction.rollback()
+        num_links_added = 0
+        for job, new_links in new_links_for_job.items():
+            if new_links:
+                self.links.add_links_for_job(job, new_links)
+                num_links_added += len(new_links)
+        self.num_links_added += num_links_added
+        return num_links_added